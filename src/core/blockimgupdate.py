@@ -0,0 +1,434 @@
+# pylint: disable=line-too-long
+"""
+Offline implementation of the updater's block_image_update.
+
+Applies a transfer.list / new.dat(.br) / patch.dat set produced by BlockImageDiff to an image file,
+so generated block OTAs can be verified without flashing a device. Versions 1-4 are supported
+(new, zero, erase, move, bsdiff, imgdiff, stash, free); for version 3+ every source and target
+SHA1 in the transfer list is checked.
+"""
+import bz2
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+import zlib
+
+from .rangelib import RangeSet
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = ["BlockImageUpdate", "bspatch", "imgpatch"]
+
+BLOCK_SIZE = 4096
+# new data is copied into the image in pieces of at most this size
+NEW_DATA_PIECE = 1024 * 1024
+
+DEFAULT_LOGGER = logging.getLogger(__name__)
+
+
+def _offtin(buf, offset):
+    """bsdiff's sign-magnitude 64-bit integer."""
+    value = int.from_bytes(buf[offset:offset + 8], "little")
+    return -(value & 0x7FFFFFFFFFFFFFFF) if value >> 63 else value
+
+
+def _add_bytes(a, b):
+    """Byte-wise a + b (mod 256), computed on big integers instead of per byte."""
+    n = len(a)
+    low = int.from_bytes(b"\x7f" * n, "little")
+    high = int.from_bytes(b"\x80" * n, "little")
+    x = int.from_bytes(a, "little")
+    y = int.from_bytes(b, "little")
+    return (((x & low) + (y & low)) ^ ((x ^ y) & high)).to_bytes(n, "little")
+
+
+def _decompress(kind, data):
+    if kind == 0:
+        return bytes(data)
+    if kind == 1:
+        return bz2.decompress(data)
+    if kind == 2:
+        if brotli is None:
+            raise ValueError("BSDF2 patch uses brotli, but the brotli module is not installed")
+        return brotli.decompress(bytes(data))
+    raise ValueError(f"Unknown BSDF2 compression type {kind}")
+
+
+def bspatch(old, patch, offset=0):
+    """Applies a BSDIFF40 or BSDF2 patch starting at patch[offset] to old; returns the new data."""
+    patch = memoryview(patch)[offset:]
+    magic = bytes(patch[:8])
+    if magic == b"BSDIFF40":
+        kinds = (1, 1, 1)
+    elif magic[:5] == b"BSDF2":
+        kinds = tuple(magic[5:8])
+    else:
+        raise ValueError(f"Unknown bsdiff patch magic {magic!r}")
+    ctrl_len, diff_len, new_size = _offtin(patch, 8), _offtin(patch, 16), _offtin(patch, 24)
+    if ctrl_len < 0 or diff_len < 0 or new_size < 0:
+        raise ValueError("Corrupt bsdiff header")
+    pos = 32
+    ctrl = _decompress(kinds[0], patch[pos:pos + ctrl_len])
+    pos += ctrl_len
+    diff = _decompress(kinds[1], patch[pos:pos + diff_len])
+    pos += diff_len
+    extra = _decompress(kinds[2], patch[pos:])
+
+    old = memoryview(old)
+    out = bytearray()
+    old_pos = diff_pos = extra_pos = 0
+    for i in range(0, len(ctrl), 24):
+        add_len, copy_len, seek = _offtin(ctrl, i), _offtin(ctrl, i + 8), _offtin(ctrl, i + 16)
+        if add_len < 0 or copy_len < 0 or len(out) + add_len + copy_len > new_size:
+            raise ValueError("Corrupt bsdiff control block")
+        # Bytes past the end of old read as zero, as in bspatch.
+        src = bytes(old[max(0, old_pos):max(0, min(old_pos + add_len, len(old)))])
+        if old_pos < 0:
+            src = bytes(min(-old_pos, add_len)) + src
+        src = src.ljust(add_len, b"\0")
+        out += _add_bytes(src, diff[diff_pos:diff_pos + add_len])
+        diff_pos += add_len
+        old_pos += add_len
+        out += extra[extra_pos:extra_pos + copy_len]
+        extra_pos += copy_len
+        old_pos += seek
+    if len(out) != new_size:
+        raise ValueError(f"bsdiff patch produced {len(out)} bytes, expected {new_size}")
+    return bytes(out)
+
+
+CHUNK_NORMAL = 0
+CHUNK_GZIP = 1
+CHUNK_DEFLATE = 2
+CHUNK_RAW = 3
+
+
+def imgpatch(old, patch, offset=0):
+    """Applies an IMGDIFF2 patch starting at patch[offset] to old; returns the new data."""
+    patch = memoryview(patch)[offset:]
+    if bytes(patch[:8]) != b"IMGDIFF2":
+        raise ValueError(f"Unknown imgdiff patch magic {bytes(patch[:8])!r}")
+    old = memoryview(old)
+    num_chunks, = struct.unpack_from("<i", patch, 8)
+    pos = 12
+    out = []
+    for _ in range(num_chunks):
+        chunk_type, = struct.unpack_from("<i", patch, pos)
+        pos += 4
+        if chunk_type == CHUNK_NORMAL:
+            src_start, src_len, patch_offset = struct.unpack_from("<3q", patch, pos)
+            pos += 24
+            out.append(bspatch(old[src_start:src_start + src_len], patch, patch_offset))
+        elif chunk_type == CHUNK_RAW:
+            data_len, = struct.unpack_from("<i", patch, pos)
+            pos += 4
+            out.append(bytes(patch[pos:pos + data_len]))
+            pos += data_len
+        elif chunk_type == CHUNK_DEFLATE:
+            (src_start, src_len, patch_offset, src_expanded_len, tgt_expanded_len,
+             level, method, window_bits, mem_level, strategy) = struct.unpack_from("<5q5i", patch, pos)
+            pos += 60
+            expanded = zlib.decompressobj(-15).decompress(old[src_start:src_start + src_len])
+            if len(expanded) != src_expanded_len:
+                raise ValueError(f"imgdiff source chunk expanded to {len(expanded)} bytes, expected {src_expanded_len}")
+            target = bspatch(expanded, patch, patch_offset)
+            if len(target) != tgt_expanded_len:
+                raise ValueError(f"imgdiff target chunk is {len(target)} bytes, expected {tgt_expanded_len}")
+            compressor = zlib.compressobj(level, method, window_bits, mem_level, strategy)
+            out.append(compressor.compress(target) + compressor.flush())
+        else:
+            raise ValueError(f"Unsupported imgdiff chunk type {chunk_type}")
+    return b"".join(out)
+
+
+class BlockImageUpdate:
+    """
+    Applies a transfer list to an image in place, the way the updater does on a device.
+    The image is mmap'd; with source_image given it is first copied to target_image.
+    new.dat is streamed (plain, .br, .xz, .zst or segmented, via utils.open_new_data) and
+    never loaded whole; stashes are kept in memory and their peak size is checked against
+    the limit declared in the transfer list header.
+    """
+
+    def __init__(self, transfer_list: str, new_data=None, patch_data=None, logger=DEFAULT_LOGGER):
+        """
+        :param transfer_list: path of {name}.transfer.list
+        :param new_data: readable stream of the new data; None opens {name}.new.dat* next to the transfer list
+        :param patch_data: path of {name}.patch.dat; None uses the one next to the transfer list
+        """
+        self.logger = logger
+        with open(transfer_list, "r") as f:
+            lines = [line.rstrip("\n") for line in f]
+        self.version = int(lines[0])
+        if self.version not in (1, 2, 3, 4):
+            raise ValueError(f"Unsupported transfer list version {self.version}")
+        self.total_blocks = int(lines[1])
+        if self.version >= 2:
+            self.stash_entries = int(lines[2])
+            self.stash_max_blocks = int(lines[3])
+            self.commands = [line.split() for line in lines[4:] if line]
+        else:
+            self.stash_entries = self.stash_max_blocks = 0
+            self.commands = [line.split() for line in lines[2:] if line]
+
+        work = os.path.dirname(transfer_list) or "."
+        name = os.path.basename(transfer_list).rsplit(".transfer.list", 1)[0]
+        self._new_data_files = []
+        if new_data is None:
+            from src.core.utils import open_new_data
+            new_data, self._new_data_files = open_new_data(work, name)
+        self.new_data = new_data
+        # Fail before Apply touches the image, not halfway through it at the first new command
+        if new_data is None and any(words[0] == "new" for words in self.commands):
+            raise FileNotFoundError(
+                f"{transfer_list} writes new data, but {os.path.join(work, name)}.new.dat"
+                f"[.br|.xz|.zst] was not found")
+        if patch_data is None:
+            patch_data = os.path.join(work, f"{name}.patch.dat")
+        self.patch_path = patch_data
+
+        self.stashes = {}
+        self.stashed_blocks = 0
+        self.max_stashed_blocks = 0
+        self.blocks_written = 0
+        self._image = None
+
+    def _max_block(self):
+        """Highest block any command touches, to size the image before mapping it."""
+        end = 0
+        for words in self.commands:
+            for word in words[1:]:
+                if "," in word and ":" not in word:
+                    ranges = RangeSet(data=[int(x) for x in word.split(",")[1:]])
+                    if ranges:
+                        end = max(end, ranges.data[-1])
+        return end
+
+    def _read_ranges(self, ranges):
+        mm = self._image
+        return b"".join(mm[s * BLOCK_SIZE:e * BLOCK_SIZE] for s, e in ranges)
+
+    def _write_ranges(self, ranges, data):
+        mm = self._image
+        if len(data) != ranges.size() * BLOCK_SIZE:
+            raise ValueError(f"Have {len(data)} bytes for {ranges.size()} blocks")
+        pos = 0
+        for s, e in ranges:
+            n = (e - s) * BLOCK_SIZE
+            mm[s * BLOCK_SIZE:e * BLOCK_SIZE] = data[pos:pos + n]
+            pos += n
+        self.blocks_written += ranges.size()
+
+    @staticmethod
+    def _parse_ranges(word):
+        values = [int(x) for x in word.split(",")]
+        if values[0] != len(values) - 1:
+            raise ValueError(f"Malformed range string {word!r}")
+        return RangeSet(data=values[1:])
+
+    def _load_source(self, words, pos):
+        """
+        Parses <src_block_count> <src_range> [<src_range_location>] [<stash_id>:<stash_range> ...]
+        (or "-" instead of the source ranges) and returns the assembled source buffer,
+        or None if a stash it needs is missing.
+        """
+        src_blocks = int(words[pos])
+        pos += 1
+        buf = bytearray(src_blocks * BLOCK_SIZE)
+        view = memoryview(buf)
+        if words[pos] != "-":
+            src = self._parse_ranges(words[pos])
+            pos += 1
+            data = self._read_ranges(src)
+            if pos < len(words) and ":" not in words[pos]:
+                # The unstashed blocks go to these locations inside the buffer.
+                locs = self._parse_ranges(words[pos])
+                pos += 1
+                self._scatter(view, locs, data)
+            else:
+                view[:len(data)] = data
+        else:
+            pos += 1
+        for word in words[pos:]:
+            stash_id, ranges = word.split(":", 1)
+            if stash_id not in self.stashes:
+                # Skipped stash (see _run); the caller decides whether the target is already there.
+                return None
+            self._scatter(view, self._parse_ranges(ranges), self.stashes[stash_id])
+        return bytes(buf)
+
+    @staticmethod
+    def _scatter(view, locs, data):
+        pos = 0
+        for s, e in locs:
+            n = (e - s) * BLOCK_SIZE
+            view[s * BLOCK_SIZE:e * BLOCK_SIZE] = data[pos:pos + n]
+            pos += n
+
+    def _stash(self, stash_id, data):
+        if stash_id in self.stashes:
+            return
+        self.stashes[stash_id] = data
+        self.stashed_blocks += len(data) // BLOCK_SIZE
+        self.max_stashed_blocks = max(self.max_stashed_blocks, self.stashed_blocks)
+
+    def _free(self, stash_id):
+        data = self.stashes.pop(stash_id, None)
+        if data is not None:
+            self.stashed_blocks -= len(data) // BLOCK_SIZE
+
+    @staticmethod
+    def _sha1(data):
+        return hashlib.sha1(data).hexdigest()
+
+    def _check(self, what, expected, data, line_no):
+        actual = self._sha1(data)
+        if actual != expected:
+            raise RuntimeError(f"Line {line_no}: {what} SHA1 mismatch, expected {expected}, got {actual}")
+
+    def _cmd_move_or_diff(self, words, line_no, patch):
+        cmd = words[0]
+        if self.version == 1:
+            if cmd == "move":
+                src, tgt = self._parse_ranges(words[1]), self._parse_ranges(words[2])
+            else:
+                src, tgt = self._parse_ranges(words[3]), self._parse_ranges(words[4])
+            source = self._read_ranges(src)
+            src_hash = tgt_hash = None
+        elif cmd == "move":
+            if self.version == 2:
+                tgt_hash, tgt, pos = None, self._parse_ranges(words[1]), 2
+            else:
+                tgt_hash, tgt, pos = words[1], self._parse_ranges(words[2]), 3
+            source = self._load_source(words, pos)
+            src_hash = tgt_hash
+        else:
+            if self.version == 2:
+                src_hash = tgt_hash = None
+                tgt, pos = self._parse_ranges(words[3]), 4
+            else:
+                src_hash, tgt_hash = words[3], words[4]
+                tgt, pos = self._parse_ranges(words[5]), 6
+            source = self._load_source(words, pos)
+
+        if source is None or (src_hash is not None and self._sha1(source) != src_hash):
+            # Already applied (e.g. a resumed update): the target holds the expected data.
+            if tgt_hash is not None and self._sha1(self._read_ranges(tgt)) == tgt_hash:
+                self.logger.info(f"Line {line_no}: {cmd} already applied, skipping")
+                self.blocks_written += tgt.size()
+                return
+            if source is None:
+                raise RuntimeError(f"Line {line_no}: {cmd} needs a stash that was never stashed")
+            self._check("source", src_hash, source, line_no)
+
+        if cmd == "move":
+            target = source
+        else:
+            offset, length = int(words[1]), int(words[2])
+            blob = patch[offset:offset + length]
+            target = bspatch(source, blob) if cmd == "bsdiff" else imgpatch(source, blob)
+        if tgt_hash is not None:
+            self._check("target", tgt_hash, target, line_no)
+        self._write_ranges(tgt, target)
+
+    def _read_new(self, start, end):
+        """Copies new data for blocks [start, end) straight into the image, a bounded piece at a time."""
+        mm = self._image
+        pos, stop = start * BLOCK_SIZE, end * BLOCK_SIZE
+        while pos < stop:
+            chunk = self.new_data.read(min(NEW_DATA_PIECE, stop - pos))
+            if not chunk:
+                raise RuntimeError(f"new data ended {stop - pos} bytes early")
+            mm[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+        self.blocks_written += end - start
+
+    def Apply(self, target_image: str, source_image: str = None) -> dict:
+        """
+        Applies the transfer list to target_image (created if missing). If source_image is
+        given it is copied to target_image first, so the source itself is left untouched.
+        Returns statistics; raises RuntimeError on any hash, stash or data size mismatch.
+        """
+        if source_image is not None and os.path.abspath(source_image) != os.path.abspath(target_image):
+            shutil.copyfile(source_image, target_image)
+        size = self._max_block() * BLOCK_SIZE
+        with open(target_image, "r+b" if os.path.exists(target_image) else "w+b") as f:
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+            if size == 0:
+                return self._stats()
+            patch = b""
+            if any(words[0] in ("bsdiff", "imgdiff") for words in self.commands):
+                with open(self.patch_path, "rb") as pf:
+                    patch = mmap.mmap(pf.fileno(), 0, access=mmap.ACCESS_READ)
+            self._image = mmap.mmap(f.fileno(), 0)
+            try:
+                self._run(patch)
+                self._image.flush()
+            finally:
+                self._image.close()
+                self._image = None
+                if isinstance(patch, mmap.mmap):
+                    patch.close()
+                if self._new_data_files:
+                    self.new_data.close()
+        return self._stats()
+
+    def _run(self, patch):
+        first_line = 4 if self.version >= 2 else 2
+        for line_no, words in enumerate(self.commands, first_line + 1):
+            cmd = words[0]
+            if cmd == "new":
+                tgt = self._parse_ranges(words[1])
+                for s, e in tgt:
+                    self._read_new(s, e)
+            elif cmd == "zero":
+                tgt = self._parse_ranges(words[1])
+                for s, e in tgt:
+                    self._write_ranges(RangeSet(data=(s, e)), bytes((e - s) * BLOCK_SIZE))
+            elif cmd == "erase":
+                # Discarded blocks have undefined contents; nothing to write for a file.
+                pass
+            elif cmd in ("move", "bsdiff", "imgdiff"):
+                self._cmd_move_or_diff(words, line_no, patch)
+            elif cmd == "stash" and self.version >= 2:
+                data = self._read_ranges(self._parse_ranges(words[2]))
+                if self.version >= 3 and self._sha1(data) != words[1]:
+                    # As on a device: a resumed update may have overwritten these blocks already,
+                    # so skip the stash and let the command using it check its target instead.
+                    self.logger.warning(f"Line {line_no}: stash {words[1]} does not match, skipping")
+                    continue
+                self._stash(words[1], data)
+            elif cmd == "free" and self.version >= 2:
+                self._free(words[1])
+            else:
+                raise ValueError(f"Line {line_no}: unknown command {cmd!r} for version {self.version}")
+
+        if self.blocks_written != self.total_blocks:
+            # Like the device updater, only a warning: generators count e.g. identity moves in the total
+            self.logger.warning(f"Wrote {self.blocks_written} blocks, transfer list declares {self.total_blocks}")
+        if self.version >= 2 and self.max_stashed_blocks > self.stash_max_blocks:
+            raise RuntimeError(f"Stash peaked at {self.max_stashed_blocks} blocks, "
+                               f"transfer list declares {self.stash_max_blocks}")
+        if self.new_data is not None and self.new_data.read(1):
+            raise RuntimeError("new data has bytes left over after the last new command")
+        if self.stashes:
+            self.logger.warning(f"{len(self.stashes)} stashes were never freed")
+
+    def _stats(self):
+        return {"version": self.version, "commands": len(self.commands), "blocks_written": self.blocks_written,
+                "max_stashed_blocks": self.max_stashed_blocks}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print(f"Usage: {sys.argv[0]} <name.transfer.list> <target.img> [source.img]")
+        sys.exit(1)
+    print(BlockImageUpdate(sys.argv[1]).Apply(sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else None))
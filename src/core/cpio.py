@@ -12,7 +12,11 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import bz2
+import gzip
+import lzma
 import os.path
+import shutil
 from ctypes import sizeof, c_char, LittleEndianStructure, byref, memmove, string_at
 from enum import Enum
 
@@ -20,8 +24,26 @@ from _ctypes import addressof
 from toml import dump, load
 from .posix import symlink, readlink
 
+try:
+    import lz4.block
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 CPIO_TRAILER_NAME = "TRAILER!!!"
 CPIO_FULL_PERMISSION = 0o7777
+# Entries are copied in chunks of this size
+CPIO_COPY_SIZE = 1 << 20
+# lz4 legacy (kernel) format: magic, then blocks of up to 8 MiB, each behind its LE32 compressed size
+LZ4_LEGACY_MAGIC = b'\x02\x21\x4c\x18'
+LZ4_LEGACY_BLOCK = 8 << 20
+# Ramdisk compressions (as named by gettype/magiskboot) repack can write directly
+COMPRESSIONS = ('gzip', 'zopfli', 'lzma', 'xz', 'bzip2') + (
+    ('lz4', 'lz4_legacy', 'lz4_lg') if lz4 else ()) + (('zstd',) if zstandard else ())
 
 
 class CpioMagicFormat(Enum):
@@ -116,13 +138,168 @@ def pack_c_mode(file_type: int, file_mode: int | str) -> str:
     return f"{file_mode | file_type:08x}"
 
 
-def calc_crc(data):
-    crc = sum(data)
+def calc_crc(data, crc: int = 0):
+    crc += sum(data)
     if crc >= 0xffffffff:
         crc = crc & 0xffffffff
     return crc
 
 
+class Lz4LegacyReader:
+    def __init__(self, file):
+        self.file = file
+        self.buffer = b''
+        # Read position in buffer, the consumed head is only dropped when the next block is appended
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        size = self.file.read(4)
+        if len(size) < 4:
+            self.eof = True
+            return
+        if size == LZ4_LEGACY_MAGIC:
+            return
+        size = int.from_bytes(size, 'little')
+        data = self.file.read(size)
+        if not size or len(data) < size:
+            # An empty block ends the stream, lz4_lg ends with the uncompressed size instead of a block
+            self.eof = True
+            return
+        block = lz4.block.decompress(data, uncompressed_size=LZ4_LEGACY_BLOCK)
+        self.buffer = self.buffer[self.pos:] + block if self.pos < len(self.buffer) else block
+        self.pos = 0
+
+    def read(self, size: int = -1):
+        while (size < 0 or len(self.buffer) - self.pos < size) and not self.eof:
+            self._fill()
+        end = len(self.buffer) if size < 0 else min(self.pos + size, len(self.buffer))
+        data = self.buffer[self.pos:end]
+        self.pos = end
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Lz4LegacyWriter:
+    def __init__(self, file, append_size: bool = False):
+        self.file = file
+        self.append_size = append_size
+        self.buffer = bytearray()
+        self.total = 0
+        self.file.write(LZ4_LEGACY_MAGIC)
+
+    def _flush(self, data):
+        block = lz4.block.compress(bytes(data), mode='high_compression', compression=12, store_size=False)
+        self.file.write(len(block).to_bytes(4, 'little'))
+        self.file.write(block)
+
+    def write(self, data):
+        self.buffer += data
+        self.total += len(data)
+        while len(self.buffer) >= LZ4_LEGACY_BLOCK:
+            self._flush(self.buffer[:LZ4_LEGACY_BLOCK])
+            del self.buffer[:LZ4_LEGACY_BLOCK]
+        return len(data)
+
+    def close(self):
+        if self.buffer:
+            self._flush(self.buffer)
+            self.buffer = bytearray()
+        if self.append_size:
+            self.file.write((self.total & 0xffffffff).to_bytes(4, 'little'))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def detect_compression(filename):
+    # Compression of a ramdisk that open_archive can read, None for a plain (or unreadable) one
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    if magic[:2] == b'\x1f\x8b':
+        return 'gzip'
+    if magic == b'\xfd7zXZ\x00':
+        return 'xz'
+    if magic[:2] == b'\x5d\x00':
+        return 'lzma'
+    if magic[:3] == b'BZh':
+        return 'bzip2'
+    if magic[:4] == b'\x04\x22\x4d\x18' and lz4:
+        return 'lz4'
+    if magic[:4] == LZ4_LEGACY_MAGIC and lz4:
+        return 'lz4_legacy'
+    if magic[:4] == b'\x28\xb5\x2f\xfd' and zstandard:
+        return 'zstd'
+    return None
+
+
+def open_archive(filename):
+    # Compressed ramdisks are decompressed while reading
+    compression = detect_compression(filename)
+    if compression == 'gzip':
+        return gzip.open(filename, 'rb')
+    if compression == 'xz':
+        return lzma.open(filename, 'rb', format=lzma.FORMAT_XZ)
+    if compression == 'lzma':
+        return lzma.open(filename, 'rb', format=lzma.FORMAT_ALONE)
+    if compression == 'bzip2':
+        return bz2.open(filename, 'rb')
+    if compression == 'lz4':
+        return lz4.frame.open(filename, 'rb')
+    if compression == 'lz4_legacy':
+        return Lz4LegacyReader(open(filename, 'rb'))
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+    return open(filename, 'rb')
+
+
+def create_archive(filename, compression: str = None):
+    # Same formats and levels as magiskboot compress=
+    if compression in ('gzip', 'zopfli'):
+        return gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=open(filename, 'wb'), mtime=0)
+    if compression == 'xz':
+        return lzma.open(filename, 'wb', format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, preset=9)
+    if compression == 'lzma':
+        return lzma.open(filename, 'wb', format=lzma.FORMAT_ALONE, preset=9)
+    if compression == 'bzip2':
+        return bz2.open(filename, 'wb', compresslevel=9)
+    if compression == 'lz4' and lz4:
+        return lz4.frame.open(filename, 'wb', compression_level=12)
+    if compression in ('lz4_legacy', 'lz4_lg') and lz4:
+        return Lz4LegacyWriter(open(filename, 'wb'), compression == 'lz4_lg')
+    if compression == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor(level=19).stream_writer(open(filename, 'wb'), closefd=True)
+    if compression and compression != 'unknown':
+        raise ValueError(f"Unsupported compression:{compression}")
+    return open(filename, 'wb')
+
+
+def copy_data(f, o, size: int, crc: int | None = None):
+    # Copy size bytes from f to o (if any) in chunks, summing them up for the Crc format
+    while size > 0:
+        data = f.read(min(CPIO_COPY_SIZE, size))
+        if not data:
+            raise EOFError("Unexpected end of cpio archive")
+        if o is not None:
+            o.write(data)
+        if crc is not None:
+            crc = calc_crc(data, crc)
+        size -= len(data)
+    return crc
+
+
 def extract(filename, outputdir, output_info, check_crc: bool = False):
     info = {}
     if not os.path.exists(outputdir):
@@ -130,7 +307,7 @@ def extract(filename, outputdir, output_info, check_crc: bool = False):
     if not os.path.exists(filename):
         print("No Such File!")
         return 1
-    with open(filename, 'rb') as f:
+    with open_archive(filename) as f:
         while True:
             header = CpioHeader()
             header_size = len(header)
@@ -172,18 +349,22 @@ def extract(filename, outputdir, output_info, check_crc: bool = False):
             output_file = os.path.join(outputdir, name)
             if not os.path.exists(os.path.dirname(output_file)):
                 os.makedirs(os.path.dirname(output_file))
-            file_content = f.read(file_size)
-            if (header.c_magic == CpioMagicFormat.Crc.value) and check_crc:
-                print(f"CRC State:{calc_crc(file_content) == int(header.c_chksum.decode('utf-8'), 16)}")
+            crc = 0 if (header.c_magic == CpioMagicFormat.Crc.value) and check_crc else None
             if file_type == CpioModes.C_ISREG:
                 with open(output_file, 'wb') as o:
-                    o.write(file_content)
-            elif file_type == CpioModes.C_ISDIR:
-                os.makedirs(output_file, exist_ok=True)
+                    crc = copy_data(f, o, file_size, crc)
             elif file_type == CpioModes.C_ISLNK:
+                file_content = f.read(file_size)
+                crc = calc_crc(file_content, crc) if crc is not None else None
                 symlink(file_content.decode('utf-8'), output_file)
             else:
-                print(f"Unsupported Type:{file_type}")
+                crc = copy_data(f, None, file_size, crc)
+                if file_type == CpioModes.C_ISDIR:
+                    os.makedirs(output_file, exist_ok=True)
+                else:
+                    print(f"Unsupported Type:{file_type}")
+            if crc is not None:
+                print(f"CRC State:{crc == int(header.c_chksum.decode('utf-8'), 16)}")
             print(f"Extracted:{name}")
             if file_size % 4:
                 f.read(4 - (file_size % 4))
@@ -208,7 +389,8 @@ def scan_dir(folder: str, return_trailer: bool = True):
         yield CPIO_TRAILER_NAME
 
 
-def repack(input_dir, config_file, output_file: str, magic_type: CpioMagicFormat = None):
+def repack(input_dir, config_file, output_file: str, magic_type: CpioMagicFormat = None, compression: str = None):
+    # compression is one of COMPRESSIONS, the archive is compressed while it is written
     # Fixme:We not allow folder or file that using same inode.So may cause bugs.will fix.lol
     ino_sum = 0
     if not magic_type:
@@ -220,7 +402,7 @@ def repack(input_dir, config_file, output_file: str, magic_type: CpioMagicFormat
     if not os.path.exists(output_dirname) and output_dirname:
         os.makedirs(output_dirname, exist_ok=True)
 
-    with open(output_file, 'wb') as out:
+    with create_archive(output_file, compression) as out:
         header = CpioHeader()
         for entry in scan_dir(input_dir):
             if entry in cpio_info.keys():
@@ -279,7 +461,7 @@ def repack(input_dir, config_file, output_file: str, magic_type: CpioMagicFormat
                 out.write((4 - (len(header) + len(entry.encode('utf-8')) + 1) % 4) * b'\x00')
             if is_file:
                 with open(os.path.join(input_dir, entry), 'rb') as f:
-                    out.write(f.read())
+                    shutil.copyfileobj(f, out, CPIO_COPY_SIZE)
                     if f.tell() % 4:
                         out.write(b'\x00' * (4 - f.tell() % 4))
             if is_link:
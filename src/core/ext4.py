@@ -568,6 +568,23 @@ class Volume:
     def root(self):
         return self.get_inode(Volume.ROOT_INODE, InodeType.DIRECTORY)
 
+    def walk_files(self):
+        """Yields (path, inode) for every regular file, each inode once (hard links are skipped)."""
+        seen = {Volume.ROOT_INODE}
+        dirs = [("", self.root)]
+        while dirs:
+            dir_path, dir_inode = dirs.pop()
+            for entry_name, entry_inode_idx, entry_type in dir_inode.open_dir():
+                if entry_name in ('.', '..') or entry_inode_idx in seen:
+                    continue
+                seen.add(entry_inode_idx)
+                entry_inode = self.get_inode(entry_inode_idx, entry_type)
+                entry_path = f"{dir_path}/{entry_name}"
+                if entry_inode.is_dir:
+                    dirs.append((entry_path, entry_inode))
+                elif entry_inode.is_file:
+                    yield entry_path, entry_inode
+
     @property
     def uuid(self):
         uuid = self.superblock.s_uuid
@@ -783,34 +800,49 @@ class Inode:
 
             offset += dirent.rec_len
 
+    def _extents(self):
+        """Yields the leaf ext4_extent entries of this inode's extent tree."""
+        nodes = queue.Queue()
+        nodes.put_nowait(self.offset + ext4_inode.i_block.offset)
+
+        while nodes.qsize() != 0:
+            header_offset = nodes.get_nowait()
+            header = self.volume.read_struct(ext4_extent_header, header_offset)
+
+            if not self.volume.ignore_magic and header.eh_magic != 0xF30A:
+                raise MagicError(
+                    f"Invalid magic value in extent header at offset 0x{self.inode_idx:X} of"
+                    f" inode {self.inode_idx:d}: 0x{header.eh_magic:04X} (expected 0xF30A)")
+
+            if header.eh_depth != 0:
+                indices = self.volume.read_struct(ext4_extent_idx * header.eh_entries,
+                                                  header_offset + ctypes.sizeof(ext4_extent_header))
+                for idx in indices:
+                    nodes.put_nowait(idx.ei_leaf * self.volume.block_size)
+            else:
+                yield from self.volume.read_struct(ext4_extent * header.eh_entries,
+                                                   header_offset + ctypes.sizeof(ext4_extent_header))
+
+    def block_ranges(self):
+        """Returns the (disk_block_idx, block_count) runs holding this inode's data, in file order.
+
+        Uninitialized extents are included, since their blocks are allocated to
+        the file. Inodes without extents (inline data) have no data blocks.
+        """
+        if (self.inode.i_flags & ext4_inode.EXT4_EXTENTS_FL) == 0:
+            return []
+        mapping = []
+        for extent in self._extents():
+            # Lengths above 32768 mark uninitialized extents.
+            length = extent.ee_len - 32768 if extent.ee_len > 32768 else extent.ee_len
+            mapping.append(MappingEntry(extent.ee_block, extent.ee_start, length))
+        MappingEntry.optimize(mapping)
+        return [(entry.disk_block_idx, entry.block_count) for entry in mapping]
+
     def open_read(self):
         if (self.inode.i_flags & ext4_inode.EXT4_EXTENTS_FL) != 0:
             # Obtain mapping from extents
-            mapping = []  # List of MappingEntry instances
-
-            nodes = queue.Queue()
-            nodes.put_nowait(self.offset + ext4_inode.i_block.offset)
-
-            while nodes.qsize() != 0:
-                header_offset = nodes.get_nowait()
-                header = self.volume.read_struct(ext4_extent_header, header_offset)
-
-                if not self.volume.ignore_magic and header.eh_magic != 0xF30A:
-                    raise MagicError(
-                        f"Invalid magic value in extent header at offset 0x{self.inode_idx:X} of"
-                        f" inode {self.inode_idx:d}: 0x{header.eh_magic:04X} (expected 0xF30A)")
-
-                if header.eh_depth != 0:
-                    indices = self.volume.read_struct(ext4_extent_idx * header.eh_entries,
-                                                      header_offset + ctypes.sizeof(ext4_extent_header))
-                    for idx in indices:
-                        nodes.put_nowait(idx.ei_leaf * self.volume.block_size)
-                else:
-                    extents = self.volume.read_struct(ext4_extent * header.eh_entries,
-                                                      header_offset + ctypes.sizeof(ext4_extent_header))
-                    for extent in extents:
-                        mapping.append(MappingEntry(extent.ee_block, extent.ee_start, extent.ee_len))
-
+            mapping = [MappingEntry(extent.ee_block, extent.ee_start, extent.ee_len) for extent in self._extents()]
             MappingEntry.optimize(mapping)
             return BlockReader(self.volume, len(self), mapping)
         else:
@@ -27,9 +27,14 @@ import sys
 import zlib
 from binascii import crc32
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 
 import dz
 
+# Image data is read (and compressed) in windows of this size
+WINDOW = 16 << 20
+
 # compatibility, Python 3 has SEEK_HOLE/SEEK_DATA, Python 2 does not
 SEEK_HOLE = io.SEEK_HOLE if hasattr(io, "SEEK_HOLE") else 4
 SEEK_DATA = io.SEEK_DATA if hasattr(io, "SEEK_DATA") else 3
@@ -74,6 +79,8 @@ class EXT4SparseChunk(dz.DZStruct):
 
         self.remaining = self.blocks << blockShift
 
+        self.blockShift = blockShift
+
         self.readSize = readSize
 
         self.pipe = pipe
@@ -87,9 +94,7 @@ class EXT4SparseChunk(dz.DZStruct):
                 sys.exit(64)
         elif self.type == self.typeFill:
             buf = self.pipe.read(values['totalSize'] - len(buf))
-            self.buffer = b""
-            while len(self.buffer) < readSize:
-                self.buffer += buf
+            self.buffer = buf * -(-readSize // len(buf))
 
     def __del__(self):
         """
@@ -128,9 +133,9 @@ class EXT4SparseChunk(dz.DZStruct):
 
         elif self.type == self.typeFill:
             if self.remaining < self.readSize:
-                buf = self.buffer[:self.readSize]
+                buf = self.buffer[:self.remaining]
             else:
-                buf = self.buffer
+                buf = self.buffer[:self.readSize]
 
         self.remaining -= len(buf)
 
@@ -373,6 +378,63 @@ class Image2Chunks(dz.DZChunk):
 
         return True
 
+    def writeChunk(self, name, sliceName, chunkName, offset, targetSize, targetAddr, trimCount):
+        """
+		Compress targetSize bytes at offset of the named image into chunkName.chunk,
+		reading WINDOW bytes at a time; independent of any other chunk
+		"""
+
+        md5 = hashlib.md5()
+        crc = crc32(b"")
+        zobj = zlib.compressobj(1)
+        zlen = 0
+
+        with io.FileIO(name, "rb") as image, io.FileIO(chunkName + ".chunk", "wb") as out:
+            image.seek(offset, io.SEEK_SET)
+            out.seek(self._dz_length, io.SEEK_SET)
+
+            remaining = targetSize
+            while remaining > 0:
+                buf = image.read(min(WINDOW, remaining))
+                if not buf:
+                    # past the end of a short image, the device reads zeroes
+                    buf = bytes(min(WINDOW, remaining))
+                remaining -= len(buf)
+                md5.update(buf)
+                crc = crc32(buf, crc)
+                zdata = zobj.compress(buf)
+                zlen += len(zdata)
+                out.write(zdata)
+
+            zdata = zobj.flush(zlib.Z_FINISH)
+            zlen += len(zdata)
+            out.write(zdata)
+
+            values = {
+                'sliceName': sliceName,
+                'chunkName': chunkName.encode("utf8"),
+                'targetSize': targetSize,
+                'dataSize': zlen,
+                'md5': md5.digest(),
+                'targetAddr': targetAddr,
+                'trimCount': trimCount,
+                'crc32': crc & 0xFFFFFFFF,
+                'dev': self.dev,
+            }
+
+            out.seek(0, io.SEEK_SET)
+            out.write(self.packdict(values))
+
+    def writeChunks(self, name, sliceName, chunks):
+        """
+		Compress the planned chunks, (chunkName, offset, targetSize, targetAddr, trimCount) each,
+		concurrently; names and headers only depend on the plan, so output is deterministic
+		"""
+
+        with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+            for future in [executor.submit(self.writeChunk, name, sliceName, *chunk) for chunk in chunks]:
+                future.result()
+
     def makeChunksHoles(self, name):
         """
 		Generate one or more .chunks files for the named file
@@ -388,6 +450,8 @@ class Image2Chunks(dz.DZChunk):
         eof = self.file.seek(0, io.SEEK_END)
         self.file.seek(0, io.SEEK_SET)
 
+        chunks = []
+
         while current < eof:
             hole = (self.file.seek(current, SEEK_HOLE) + self.blockSize - 1) & ~(self.blockSize - 1)
             # Python's handling of this condition is suboptimal
@@ -405,55 +469,18 @@ class Image2Chunks(dz.DZChunk):
                 next = hole
                 trimCount = (next - current) >> self.blockShift
 
-            md5 = hashlib.md5()
-            crc = crc32(b"")
-            zobj = zlib.compressobj(1)
-            self.file.seek(current, io.SEEK_SET)
-
             chunkName = baseName + str(targetAddr) + ".bin"
-            out = io.FileIO(chunkName + ".chunk", "wb")
 
             print("[+] Compressing {:s} to {:s} ({:d} empty blocks)".format(name, chunkName,
                                                                             (next - hole) >> self.blockShift))
 
-            chunkName = chunkName.encode("utf8")
-            out.seek(self._dz_length, io.SEEK_SET)
-            zlen = 0
-
-            for b in range((hole - current) >> self.blockShift):
-                buf = self.file.read(self.blockSize)
-                md5.update(buf)
-                crc = crc32(buf, crc)
-                zdata = zobj.compress(buf)
-                zlen += len(zdata)
-                out.write(zdata)
-
-            zdata = zobj.flush(zlib.Z_FINISH)
-            zlen += len(zdata)
-            out.write(zdata)
-            md5 = md5.digest()
-
-            out.seek(0, io.SEEK_SET)
-
-            values = {
-                'sliceName': sliceName,
-                'chunkName': chunkName,
-                'targetSize': hole - current,
-                'dataSize': zlen,
-                'md5': md5,
-                'targetAddr': targetAddr,
-                'trimCount': trimCount,
-                'crc32': crc & 0xFFFFFFFF,
-                'dev': self.dev,
-            }
-
-            header = self.packdict(values)
-            out.write(header)
-            out.close()
+            chunks.append((chunkName, current, hole - current, targetAddr, trimCount))
 
             current = next
             targetAddr = self.startLBA + (current >> self.blockShift)
 
+        self.writeChunks(name, sliceName, chunks)
+
         print("[+] done\n")
 
     def makeChunksEXT4FS(self, name):
@@ -466,89 +493,53 @@ class Image2Chunks(dz.DZChunk):
         baseName = name.rpartition(".")[0] + "_"
         sliceName = name.rpartition(".")[0].encode("utf8")
 
-        # Check length before closing
-        eof = self.file.seek(0, io.SEEK_END)
-
         # Alas, ext2simg can't take the image as stdin
         self.file.close()
 
-        sparse = EXT4SparseFile(name, 1 << self.blockShift)
-
-        # sigh, Python 2 hack for some variables
-        class nl:
-            yuck = "truly"
+        sparse = EXT4SparseFile(name, WINDOW)
 
-        nl.current = 0
-        nl.targetAddr = self.startLBA
-        nl.trimCount = 0
+        # ext2simg only supplies the layout (and the image CRC32 check), the chunks are
+        # compressed from the image itself, whose contents are what the sparse file describes
+        chunks = []
+        current = 0
+        targetAddr = self.startLBA
+        trimCount = 0
+        dataBlocks = 0
 
-        # local function not used by anyone else
         def complete():
-            #			nonlocal zlen, md5, current, targetAddr, trimCount
-            zdata = zobj.flush(zlib.Z_FINISH)
-            nl.zlen += len(zdata)
-            out.write(zdata)
-            nl.md5 = nl.md5.digest()
-
-            out.seek(0, io.SEEK_SET)
-
-            values = {
-                'sliceName': sliceName,
-                'chunkName': chunkName,
-                'targetSize': dataBlocks << self.blockShift,
-                'dataSize': nl.zlen,
-                'md5': nl.md5,
-                'targetAddr': nl.targetAddr,
-                'trimCount': nl.trimCount,
-                'crc32': crc & 0xFFFFFFFF,
-                'dev': self.dev,
-            }
-
-            nl.header = self.packdict(values)
-            out.write(nl.header)
-            out.close()
-
-            nl.current += nl.trimCount << self.blockShift
-            nl.targetAddr = self.startLBA + (nl.current >> self.blockShift)
-
-            print("({:d} empty blocks)".format(nl.trimCount - dataBlocks))
-
-            nl.trimCount = 0
+            chunkName = baseName + str(targetAddr) + ".bin"
+            print("[+] Compressing {:s} to {:s} ({:d} empty blocks)".format(name, chunkName, trimCount - dataBlocks))
+            chunks.append((chunkName, current, dataBlocks << self.blockShift, targetAddr, trimCount))
 
         for chunk in sparse:
             if chunk.type == EXT4SparseChunk.typeRaw or chunk.type == EXT4SparseChunk.typeFill:
-                if nl.trimCount:
+                if trimCount:
                     complete()
+                    current += trimCount << self.blockShift
+                    targetAddr = self.startLBA + (current >> self.blockShift)
                 dataBlocks = chunk.remaining >> self.blockShift
-                nl.trimCount += dataBlocks
-
-                nl.md5 = hashlib.md5()
-                crc = crc32(b"")
-                zobj = zlib.compressobj(1)
-
-                chunkName = baseName + str(nl.targetAddr) + ".bin"
-                out = io.FileIO(chunkName + ".chunk", "wb")
-
-                sys.stdout.write("[+] Compressing {:s} to {:s} ".format(name, chunkName))
-
-                chunkName = chunkName.encode("utf8")
-                out.seek(self._dz_length, io.SEEK_SET)
-                nl.zlen = 0
+                trimCount = dataBlocks
 
+                # drain the payload, keeping the image CRC32 running
                 for buf in chunk:
-                    nl.md5.update(buf)
-                    crc = crc32(buf, crc)
-                    zdata = zobj.compress(buf)
-                    nl.zlen += len(zdata)
-                    out.write(zdata)
+                    pass
 
             elif chunk.type == EXT4SparseChunk.typeDontCare:
+                blocks = chunk.remaining >> self.blockShift
+                if not trimCount:
+                    # nothing to write before this gap
+                    current += blocks << self.blockShift
+                    targetAddr = self.startLBA + (current >> self.blockShift)
+                    continue
                 # check for EOF, lastWipe overrides
                 if sparse.chunkCount == 0:
-                    nl.trimCount = self.lastWipe - nl.targetAddr
+                    trimCount = self.lastWipe - targetAddr
                 else:
-                    nl.trimCount += chunk.remaining >> self.blockShift
+                    trimCount += blocks
                 complete()
+                current += trimCount << self.blockShift
+                targetAddr = self.startLBA + (current >> self.blockShift)
+                trimCount = 0
 
             elif chunk.type == EXT4SparseChunk.typeCrc32:
                 pass
@@ -556,10 +547,12 @@ class Image2Chunks(dz.DZChunk):
                 print("[!] Error: unknown chunk, type=0x{:04X}".format(chunk.type), file=sys.stderr)
                 sys.exit(64)
 
-        if nl.trimCount:
-            nl.trimCount = self.lastWipe - nl.targetAddr
+        if trimCount:
+            trimCount = self.lastWipe - targetAddr
             complete()
 
+        self.writeChunks(name, sliceName, chunks)
+
         print("[+] done\n")
 
     def makeChunksProbe(self, name):
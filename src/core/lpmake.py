@@ -0,0 +1,517 @@
+# pylint: disable=line-too-long, missing-class-docstring, missing-function-docstring
+# Copyright (C) 2022-2026 The MIO-KITCHEN-SOURCE Project
+#
+# Licensed under the GNU AFFERO GENERAL PUBLIC LICENSE, Version 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.gnu.org/licenses/agpl-3.0.en.html#license-text
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+In-process replacement for AOSP `lpmake`.
+
+Lays out logical partitions inside a super image, serializes the liblp
+geometry and metadata (primary and backup copies, every slot) and streams the
+partition images into a raw or Android sparse output.
+"""
+import hashlib
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing import cpu_count
+from timeit import default_timer as dti
+from typing import Dict, List, Optional, Tuple
+
+from .lpunpack import (LP_METADATA_GEOMETRY_MAGIC, LP_METADATA_GEOMETRY_SIZE, LP_METADATA_HEADER_MAGIC,
+                       LP_PARTITION_ATTR_READONLY, LP_PARTITION_RESERVED_BYTES, LP_SECTOR_SIZE,
+                       LP_TARGET_TYPE_LINEAR, SPARSE_CHUNK_HEADER_SIZE, SPARSE_HEADER_MAGIC, SPARSE_HEADER_SIZE,
+                       SparseChunkHeader, SparseHeader)
+
+LP_METADATA_MAJOR_VERSION = 10
+LP_METADATA_MINOR_VERSION_MIN = 0
+LP_METADATA_VERSION_FOR_UPDATED_ATTR = 1
+LP_METADATA_VERSION_FOR_EXPANDED_HEADER = 2
+LP_METADATA_HEADER_V1_0_SIZE = 128
+LP_METADATA_HEADER_V1_2_SIZE = 256
+LP_HEADER_FLAG_VIRTUAL_AB_DEVICE = (1 << 0)
+LP_METADATA_DEFAULT_PARTITION_NAME = 'default'
+
+DEFAULT_METADATA_SIZE = 65536
+DEFAULT_PARTITION_ALIGNMENT = 1024 * 1024
+DEFAULT_BLOCK_SIZE = 4096
+
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+# Partition images are read in windows of this size; all-zero blocks inside them become holes.
+COPY_WINDOW = 4 * 1024 * 1024
+_ZERO_WINDOW = bytes(COPY_WINDOW)
+
+GEOMETRY_FMT = '<2I32s3I'
+HEADER_FMT = '<IHHI32sI32s'
+TABLE_DESCRIPTOR_FMT = '<3I'
+PARTITION_FMT = '<36s4I'
+EXTENT_FMT = '<QIQI'
+GROUP_FMT = '<36sIQ'
+BLOCK_DEVICE_FMT = '<Q2IQ36sI'
+
+
+class LpMakeError(Exception):
+    """Raised any error building a super image"""
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+def align_up(value: int, alignment: int) -> int:
+    if not alignment:
+        return value
+    return (value + alignment - 1) // alignment * alignment
+
+
+def image_size(path: str) -> int:
+    """Return the expanded size of a raw or Android sparse image."""
+    with open(path, 'rb') as f:
+        header = f.read(SPARSE_HEADER_SIZE)
+    if len(header) == SPARSE_HEADER_SIZE:
+        sparse_header = SparseHeader(header)
+        if sparse_header.magic == SPARSE_HEADER_MAGIC:
+            return sparse_header.total_blks * sparse_header.blk_sz
+    return os.path.getsize(path)
+
+
+def iter_image(path: str, window: int = COPY_WINDOW):
+    """
+    Yield (offset, length, src_offset, data) for a partition image.
+    data is the bytes read from src_offset for raw windows, a 4-byte fill pattern
+    (src_offset is None) for sparse fill chunks and None for don't care chunks.
+    """
+    with open(path, 'rb') as f:
+        header = SparseHeader(f.read(SPARSE_HEADER_SIZE).ljust(SPARSE_HEADER_SIZE, b'\x00'))
+        if header.magic != SPARSE_HEADER_MAGIC:
+            f.seek(0)
+            offset = 0
+            while data := f.read(window):
+                yield offset, len(data), offset, data
+                offset += len(data)
+            return
+        f.seek(header.file_hdr_sz)
+        offset = 0
+        for _ in range(header.total_chunks):
+            chunk = SparseChunkHeader(f.read(SPARSE_CHUNK_HEADER_SIZE))
+            if header.chunk_hdr_sz > SPARSE_CHUNK_HEADER_SIZE:
+                f.seek(header.chunk_hdr_sz - SPARSE_CHUNK_HEADER_SIZE, 1)
+            length = chunk.chunk_sz * header.blk_sz
+            data_size = chunk.total_sz - header.chunk_hdr_sz
+            if chunk.chunk_type == CHUNK_TYPE_RAW:
+                remaining = length
+                while remaining:
+                    src_offset = f.tell()
+                    data = f.read(min(window, remaining))
+                    if not data:
+                        raise LpMakeError(f'{path}: truncated sparse image')
+                    yield offset, len(data), src_offset, data
+                    offset += len(data)
+                    remaining -= len(data)
+            elif chunk.chunk_type == CHUNK_TYPE_FILL:
+                yield offset, length, None, f.read(4)
+                offset += length
+            elif chunk.chunk_type == CHUNK_TYPE_DONT_CARE:
+                yield offset, length, None, None
+                offset += length
+            elif chunk.chunk_type == CHUNK_TYPE_CRC32:
+                f.seek(data_size, 1)
+            else:
+                raise LpMakeError(f'{path}: unknown sparse chunk type 0x{chunk.chunk_type:x}')
+
+
+def is_zero(data: bytes) -> bool:
+    return data == _ZERO_WINDOW[:len(data)]
+
+
+def zero_runs(data: bytes, block_size: int = DEFAULT_BLOCK_SIZE):
+    """Split a window into (relative offset, length, is_zero) runs at block granularity."""
+    if is_zero(data):
+        yield 0, len(data), True
+        return
+    view = memoryview(data)
+    zero_block = _ZERO_WINDOW[:block_size]
+    run_start, run_zero = 0, None
+    for offset in range(0, len(data), block_size):
+        zero = view[offset:offset + block_size] == zero_block[:min(block_size, len(data) - offset)]
+        if zero != run_zero:
+            if run_zero is not None:
+                yield run_start, offset - run_start, run_zero
+            run_start, run_zero = offset, zero
+    yield run_start, len(data) - run_start, run_zero
+
+
+@dataclass
+class SuperGroup:
+    name: str
+    maximum_size: int = 0
+    flags: int = 0
+
+
+@dataclass
+class SuperPartition:
+    name: str
+    group: str
+    size: int = 0
+    image: Optional[str] = None
+    attributes: int = LP_PARTITION_ATTR_READONLY
+    # (first physical sector, number of sectors)
+    extents: List[Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def offset(self) -> int:
+        return self.extents[0][0] * LP_SECTOR_SIZE if self.extents else 0
+
+
+class SuperBuilder:
+    """
+    Build a super image the way `lpmake` does.
+
+    Partitions are allocated in insertion order, each starting at the next
+    `alignment` boundary. Every metadata slot, primary and backup, receives the
+    same serialized metadata.
+    """
+
+    def __init__(self, device_name: str = 'super', metadata_size: int = DEFAULT_METADATA_SIZE,
+                 metadata_slots: int = 2, alignment: int = DEFAULT_PARTITION_ALIGNMENT,
+                 block_size: int = DEFAULT_BLOCK_SIZE, virtual_ab: bool = False):
+        if metadata_size % LP_SECTOR_SIZE:
+            raise LpMakeError('Metadata max size is not sector-aligned.')
+        if metadata_slots < 1:
+            raise LpMakeError('Invalid metadata slot count.')
+        if block_size % LP_SECTOR_SIZE or alignment % block_size:
+            raise LpMakeError('Alignment must be a multiple of the logical block size.')
+        self.device_name = device_name
+        self.metadata_size = metadata_size
+        self.metadata_slots = metadata_slots
+        self.alignment = alignment
+        self.block_size = block_size
+        self.header_flags = LP_HEADER_FLAG_VIRTUAL_AB_DEVICE if virtual_ab else 0
+        self.device_size = 0
+        self.groups: Dict[str, SuperGroup] = {
+            LP_METADATA_DEFAULT_PARTITION_NAME: SuperGroup(LP_METADATA_DEFAULT_PARTITION_NAME)}
+        self.partitions: List[SuperPartition] = []
+
+    @property
+    def metadata_region(self) -> int:
+        return LP_PARTITION_RESERVED_BYTES + (LP_METADATA_GEOMETRY_SIZE + self.metadata_size * self.metadata_slots) * 2
+
+    @property
+    def first_logical_sector(self) -> int:
+        return align_up(self.metadata_region, self.alignment or self.block_size) // LP_SECTOR_SIZE
+
+    def add_group(self, name: str, maximum_size: int = 0):
+        if name in self.groups:
+            raise LpMakeError(f'Group already exists: {name}')
+        self.groups[name] = SuperGroup(name, maximum_size)
+
+    def add_partition(self, name: str, group: str = LP_METADATA_DEFAULT_PARTITION_NAME, image: str = None,
+                      size: int = None, attributes: int = LP_PARTITION_ATTR_READONLY):
+        if group not in self.groups:
+            raise LpMakeError(f'Unknown group: {group}')
+        if any(i.name == name for i in self.partitions):
+            raise LpMakeError(f'Partition already exists: {name}')
+        if len(name.encode('utf-8')) > 36:
+            raise LpMakeError(f'Partition name too long: {name}')
+        content_size = image_size(image) if image else 0
+        if size is None:
+            size = content_size
+        elif content_size > size:
+            raise LpMakeError(f'Image for {name} is larger than its partition ({content_size} > {size})')
+        self.partitions.append(
+            SuperPartition(name, group, align_up(size, self.block_size), image, attributes))
+
+    def minimal_size(self) -> int:
+        """Smallest device size able to hold the metadata and every partition."""
+        return self.first_logical_sector * LP_SECTOR_SIZE + sum(
+            align_up(i.size, self.alignment) for i in self.partitions)
+
+    def layout(self, device_size: int = 0):
+        """Assign extents to every partition. A device_size of 0 means the minimal size."""
+        device_size = device_size or self.minimal_size()
+        if device_size % self.block_size:
+            raise LpMakeError('Block device size must be a multiple of the logical block size.')
+        for group in self.groups.values():
+            used = sum(i.size for i in self.partitions if i.group == group.name)
+            if group.maximum_size and used > group.maximum_size:
+                raise LpMakeError(f'Group {group.name} is too small: {used} > {group.maximum_size}')
+        sector = self.first_logical_sector
+        end = device_size // LP_SECTOR_SIZE
+        for partition in self.partitions:
+            partition.extents = []
+            if not partition.size:
+                continue
+            sector = align_up(sector * LP_SECTOR_SIZE, self.alignment) // LP_SECTOR_SIZE
+            num_sectors = partition.size // LP_SECTOR_SIZE
+            if sector + num_sectors > end:
+                raise LpMakeError(
+                    f'Not enough space on device for partition {partition.name}, need at least {self.minimal_size()} bytes')
+            partition.extents.append((sector, num_sectors))
+            sector += num_sectors
+        self.device_size = device_size
+
+    def serialize_geometry(self) -> bytes:
+        geometry = struct.pack(GEOMETRY_FMT, LP_METADATA_GEOMETRY_MAGIC, struct.calcsize(GEOMETRY_FMT), b'',
+                               self.metadata_size, self.metadata_slots, self.block_size)
+        checksum = hashlib.sha256(geometry).digest()
+        geometry = struct.pack(GEOMETRY_FMT, LP_METADATA_GEOMETRY_MAGIC, struct.calcsize(GEOMETRY_FMT), checksum,
+                               self.metadata_size, self.metadata_slots, self.block_size)
+        return geometry.ljust(LP_METADATA_GEOMETRY_SIZE, b'\x00')
+
+    def serialize_metadata(self) -> bytes:
+        group_index = {name: index for index, name in enumerate(self.groups)}
+        partitions, extents = [], []
+        for partition in self.partitions:
+            partitions.append(struct.pack(PARTITION_FMT, partition.name.encode('utf-8'), partition.attributes,
+                                          len(extents), len(partition.extents), group_index[partition.group]))
+            for sector, num_sectors in partition.extents:
+                extents.append(struct.pack(EXTENT_FMT, num_sectors, LP_TARGET_TYPE_LINEAR, sector, 0))
+        groups = [struct.pack(GROUP_FMT, i.name.encode('utf-8'), i.flags, i.maximum_size) for i in
+                  self.groups.values()]
+        block_devices = [struct.pack(BLOCK_DEVICE_FMT, self.first_logical_sector, self.alignment, 0,
+                                     self.device_size, self.device_name.encode('utf-8'), 0)]
+        tables = b''
+        descriptors = b''
+        for table, fmt in ((partitions, PARTITION_FMT), (extents, EXTENT_FMT), (groups, GROUP_FMT),
+                           (block_devices, BLOCK_DEVICE_FMT)):
+            descriptors += struct.pack(TABLE_DESCRIPTOR_FMT, len(tables), len(table), struct.calcsize(fmt))
+            tables += b''.join(table)
+        minor_version = LP_METADATA_MINOR_VERSION_MIN
+        if any(i.attributes & ~LP_PARTITION_ATTR_READONLY for i in self.partitions):
+            minor_version = LP_METADATA_VERSION_FOR_UPDATED_ATTR
+        header_size = LP_METADATA_HEADER_V1_0_SIZE
+        if self.header_flags:
+            minor_version = LP_METADATA_VERSION_FOR_EXPANDED_HEADER
+            header_size = LP_METADATA_HEADER_V1_2_SIZE
+
+        def pack_header(checksum: bytes) -> bytes:
+            header = struct.pack(HEADER_FMT, LP_METADATA_HEADER_MAGIC, LP_METADATA_MAJOR_VERSION, minor_version,
+                                 header_size, checksum, len(tables), hashlib.sha256(tables).digest()) + descriptors
+            if header_size == LP_METADATA_HEADER_V1_2_SIZE:
+                header += struct.pack('<I', self.header_flags)
+            return header.ljust(header_size, b'\x00')
+
+        header = pack_header(hashlib.sha256(pack_header(b'')).digest())
+        metadata = header + tables
+        if len(metadata) > self.metadata_size:
+            raise LpMakeError(f'Metadata size {len(metadata)} exceeds the maximum of {self.metadata_size} bytes')
+        return metadata
+
+    def serialize_region(self) -> bytes:
+        """Everything in front of the first logical sector."""
+        metadata = self.serialize_metadata().ljust(self.metadata_size, b'\x00')
+        region = bytes(LP_PARTITION_RESERVED_BYTES) + self.serialize_geometry() * 2 + metadata * (
+                self.metadata_slots * 2)
+        return region.ljust(self.first_logical_sector * LP_SECTOR_SIZE, b'\x00')
+
+    def write(self, output: str, sparse: bool = False, workers: int = None):
+        if not self.device_size:
+            self.layout()
+        workers = workers or cpu_count()
+        start = dti()
+        if sparse:
+            _SparseWriter(self, output, workers).write()
+        else:
+            self._write_raw(output, workers)
+        print(f'[Lpmake] Wrote {output} ({self.device_size} bytes) in {dti() - start:.2f}s')
+
+    def _write_raw(self, output: str, workers: int):
+        with open(output, 'wb') as out:
+            out.truncate(self.device_size)
+            out.write(self.serialize_region())
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(self._copy_raw, output, i) for i in self.partitions if i.image and i.extents]:
+                future.result()
+
+    def _copy_raw(self, output: str, partition: SuperPartition):
+        base = partition.offset
+        with open(output, 'r+b') as out:
+            for offset, length, src_offset, data in iter_image(partition.image):
+                if data is None:
+                    continue
+                if src_offset is not None:
+                    view = memoryview(data)
+                    for run, run_length, zero in zero_runs(data, self.block_size):
+                        if not zero:
+                            out.seek(base + offset + run)
+                            out.write(view[run:run + run_length])
+                elif data != b'\x00' * 4:
+                    out.seek(base + offset)
+                    pattern = data * (COPY_WINDOW // 4)
+                    while length:
+                        out.write(pattern[:min(length, COPY_WINDOW)])
+                        length -= min(length, COPY_WINDOW)
+
+
+class _SparseWriter:
+    """
+    Two parallel passes: every partition image is scanned into a list of
+    raw/fill/skip pieces, which fixes the offset of every sparse chunk in the
+    output, then the pieces are copied to their offsets concurrently.
+    """
+
+    def __init__(self, builder: SuperBuilder, output: str, workers: int):
+        self.builder = builder
+        self.output = output
+        self.workers = workers
+        self.block_size = builder.block_size
+
+    def _plan(self, partition: SuperPartition) -> list:
+        """Return [kind, blocks, src_offset, length | pattern] pieces covering the whole partition."""
+        pieces = []
+        if partition.image:
+            for offset, length, src_offset, data in iter_image(partition.image):
+                if src_offset is not None:
+                    runs = [['fill', run_length, None, b'\x00' * 4] if zero else
+                            ['raw', run_length, src_offset + run, run_length]
+                            for run, run_length, zero in zero_runs(data, self.block_size)]
+                elif data is not None:
+                    runs = [['fill', length, None, data]]
+                else:
+                    runs = [['skip', length, None, None]]
+                for piece in runs:
+                    last = pieces[-1] if pieces else None
+                    if last and last[0] == piece[0] == 'raw' and last[2] + last[3] == piece[2]:
+                        last[1] += piece[1]
+                        last[3] += piece[3]
+                    elif last and last[0] == piece[0] != 'raw' and last[3] == piece[3]:
+                        last[1] += piece[1]
+                    else:
+                        pieces.append(piece)
+        # Byte lengths become blocks; a trailing partial raw block is zero-padded on copy.
+        for piece in pieces:
+            piece[1] = align_up(piece[1], self.block_size) // self.block_size
+        padding = partition.size // self.block_size - sum(i[1] for i in pieces)
+        if padding > 0:
+            pieces.append(['fill', padding, None, b'\x00' * 4])
+        return pieces
+
+    @staticmethod
+    def _chunk_size(piece, block_size) -> int:
+        if piece[0] == 'raw':
+            return SPARSE_CHUNK_HEADER_SIZE + piece[1] * block_size
+        if piece[0] == 'fill':
+            return SPARSE_CHUNK_HEADER_SIZE + 4
+        return SPARSE_CHUNK_HEADER_SIZE
+
+    def write(self):
+        builder = self.builder
+        partitions = [i for i in builder.partitions if i.extents]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            plans = list(executor.map(self._plan, partitions))
+        # As in lpmake: a zero fill for the reserved bytes, the geometry and metadata as one raw chunk,
+        # and the unused space after it left to the don't care gap in front of the first partition.
+        reserved = LP_PARTITION_RESERVED_BYTES // self.block_size * self.block_size
+        region = builder.serialize_region()[reserved:align_up(builder.metadata_region, self.block_size)]
+        chunks = 2 if reserved else 1
+        offset = SPARSE_HEADER_SIZE + SPARSE_CHUNK_HEADER_SIZE * chunks + (4 if reserved else 0) + len(region)
+        block = (reserved + len(region)) // self.block_size
+        jobs = []
+        gaps = []
+        for partition, pieces in zip(partitions, plans):
+            start = partition.offset // self.block_size
+            if start > block:
+                gaps.append((offset, start - block))
+                offset += SPARSE_CHUNK_HEADER_SIZE
+                chunks += 1
+            jobs.append((partition, pieces, offset))
+            for piece in pieces:
+                offset += self._chunk_size(piece, self.block_size)
+            chunks += len(pieces)
+            block = start + sum(i[1] for i in pieces)
+        total_blocks = builder.device_size // self.block_size
+        if total_blocks > block:
+            gaps.append((offset, total_blocks - block))
+            offset += SPARSE_CHUNK_HEADER_SIZE
+            chunks += 1
+        with open(self.output, 'wb') as out:
+            out.truncate(offset)
+            out.write(struct.pack('<I4H4I', SPARSE_HEADER_MAGIC, 1, 0, SPARSE_HEADER_SIZE, SPARSE_CHUNK_HEADER_SIZE,
+                                  self.block_size, total_blocks, chunks, 0))
+            if reserved:
+                out.write(struct.pack('<2H2I', CHUNK_TYPE_FILL, 0, reserved // self.block_size,
+                                      SPARSE_CHUNK_HEADER_SIZE + 4) + b'\x00' * 4)
+            out.write(struct.pack('<2H2I', CHUNK_TYPE_RAW, 0, len(region) // self.block_size,
+                                  SPARSE_CHUNK_HEADER_SIZE + len(region)))
+            out.write(region)
+            for gap_offset, blocks in gaps:
+                out.seek(gap_offset)
+                out.write(struct.pack('<2H2I', CHUNK_TYPE_DONT_CARE, 0, blocks, SPARSE_CHUNK_HEADER_SIZE))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for future in [executor.submit(self._copy, *job) for job in jobs]:
+                future.result()
+
+    def _copy(self, partition: SuperPartition, pieces: list, offset: int):
+        src = open(partition.image, 'rb') if partition.image else None
+        with open(self.output, 'r+b') as out:
+            out.seek(offset)
+            for kind, blocks, src_offset, value in pieces:
+                size = self._chunk_size((kind, blocks), self.block_size)
+                if kind == 'raw':
+                    out.write(struct.pack('<2H2I', CHUNK_TYPE_RAW, 0, blocks, size))
+                    src.seek(src_offset)
+                    remaining = value
+                    while remaining:
+                        data = src.read(min(COPY_WINDOW, remaining))
+                        if not data:
+                            raise LpMakeError(f'{partition.image}: unexpected end of file')
+                        out.write(data)
+                        remaining -= len(data)
+                    out.write(bytes(blocks * self.block_size - value))
+                elif kind == 'fill':
+                    out.write(struct.pack('<2H2I', CHUNK_TYPE_FILL, 0, blocks, size) + value)
+                else:
+                    out.write(struct.pack('<2H2I', CHUNK_TYPE_DONT_CARE, 0, blocks, size))
+        if src:
+            src.close()
+
+
+def build_super(output: str, work: str, part_list: list, group_name: str, size: int = 0, super_type: int = 1,
+                attrib: str = 'readonly', block_device_name: str = 'super', sparse: bool = False,
+                metadata_size: int = DEFAULT_METADATA_SIZE, workers: int = None) -> int:
+    """
+    Build a super image from {work}/{part}.img the way the project used to invoke lpmake.
+    super_type: 1 = non-A/B, 2 = virtual A/B, anything else = A/B.
+    A size of 0 selects the minimal size. Returns the size of the written device.
+    """
+    attributes = LP_PARTITION_ATTR_READONLY if attrib == 'readonly' else 0
+    if super_type == 1:
+        builder = SuperBuilder(block_device_name, metadata_size, 2)
+        builder.add_group(group_name, size)
+        for part in part_list:
+            builder.add_partition(part, group_name, os.path.join(work, f'{part}.img'), attributes=attributes)
+    else:
+        builder = SuperBuilder(block_device_name, metadata_size, 3, virtual_ab=super_type == 2)
+        builder.add_group(f'{group_name}_a', size)
+        for part in part_list:
+            builder.add_partition(f'{part}_a', f'{group_name}_a', os.path.join(work, f'{part}.img'),
+                                  attributes=attributes)
+        builder.add_group(f'{group_name}_b', size)
+        for part in part_list:
+            image = os.path.join(work, f'{part}_b.img')
+            builder.add_partition(f'{part}_b', f'{group_name}_b', image if os.path.exists(image) else None,
+                                  attributes=attributes)
+    if not size:
+        size = builder.minimal_size()
+        for name in builder.groups:
+            if name != LP_METADATA_DEFAULT_PARTITION_NAME:
+                builder.groups[name].maximum_size = size
+    builder.layout(size)
+    builder.write(output, sparse, workers)
+    return builder.device_size
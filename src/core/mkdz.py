@@ -28,6 +28,9 @@ from binascii import a2b_hex
 
 import dz
 
+# Chunk files are copied into the DZ file in reads of this size
+COPY_SIZE = 16 << 20
+
 
 class MKDZChunk(dz.DZChunk):
     """
@@ -72,7 +75,7 @@ class MKDZChunk(dz.DZChunk):
 
         buf = b" "
         while len(buf) > 0:
-            buf = input.read(4096)
+            buf = input.read(COPY_SIZE)
             file.write(buf)
 
         input.close()
@@ -88,9 +91,7 @@ class MKDZChunk(dz.DZChunk):
 
         file = io.FileIO(name, "rb")
 
-        self.buffer = file.read(self._dz_length)
-
-        dz_item = self.unpackdict(self.buffer)
+        dz_item = self.unpackdict(file.read(self._dz_length))
 
         self.chunkName = dz_item['chunkName'].rstrip(b'\x00').decode("utf8")
 
@@ -215,8 +216,10 @@ class MKDZFile(dz.DZFile):
 
         md5 = hashlib.md5()
 
+        # headers are read back one at a time rather than kept around for every chunk
         for chunk in self.chunks:
-            md5.update(chunk.buffer)
+            with io.FileIO(chunk.name, "rb") as file:
+                md5.update(file.read(dz.DZChunk._dz_length))
 
         self.md5Header = md5.digest()
 
@@ -246,7 +249,7 @@ class MKDZFile(dz.DZFile):
         self.dz_item['chunkCount'] = len(self.chunks)
 
         # this date code looks like an integer, but is really a string!
-        self.dz_item['oldDateCode'] = str(self.dz_item['oldDateCode'])
+        self.dz_item['oldDateCode'] = str(self.dz_item['oldDateCode']).encode("utf8")
 
         buffer = self.packdict(self.dz_item)
 
@@ -18,22 +18,26 @@ from .crypto import (
     get_aes_key_iv_for_region,
     aes_cbc_decrypt,
     extract_key_from_keymap,
-    decrypt_nt_encode_data
+    decrypt_nt_encode_data,
+    decrypt_nt_encode_stream
 )
 
 from .parser import (
     extract_region_data,
     parse_ntpi_file,
+    parse_ntpi_data,
+    get_region6_view,
     parse_fileindex_xml
 )
 
 from .extractor import (
     init_worker,
     decompress_lzma2_data,
-    split_file_into_segments,
-    process_segment,
-    calculate_optimal_segments,
-    process_large_file_parallel,
+    decompress_lzma2_stream,
+    scan_file_blocks,
+    decode_block,
+    decode_block_data,
+    plan_file_threads,
     process_file_task,
     stage2_extract_files
 )
@@ -56,19 +60,23 @@ __all__ = [
     'aes_cbc_decrypt',
     'extract_key_from_keymap',
     'decrypt_nt_encode_data',
+    'decrypt_nt_encode_stream',
     
     # Parser
     'extract_region_data',
     'parse_ntpi_file',
+    'parse_ntpi_data',
+    'get_region6_view',
     'parse_fileindex_xml',
     
     # Extractor
     'init_worker',
     'decompress_lzma2_data',
-    'split_file_into_segments',
-    'process_segment',
-    'calculate_optimal_segments',
-    'process_large_file_parallel',
+    'decompress_lzma2_stream',
+    'scan_file_blocks',
+    'decode_block',
+    'decode_block_data',
+    'plan_file_threads',
     'process_file_task',
     'stage2_extract_files',
 ]
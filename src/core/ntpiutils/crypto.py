@@ -142,3 +142,44 @@ def decrypt_nt_encode_data(region6_data, offset, key):
     # Calculate offset of next block
     next_offset = data_offset + encrypted_size
     return next_offset, decrypted_data
+
+
+def decrypt_nt_encode_stream(region6_data, offset, key, step=0x100000):
+    """
+    Decrypt a single NTEncode block from Region6 data piece by piece.
+    
+    Same as decrypt_nt_encode_data, but yields the decrypted data in pieces
+    of about step bytes so a block never has to be held in memory at once.
+    
+    Args:
+        region6_data: Region6 data (bytes, mmap or memoryview)
+        offset: Byte offset where the NTEncode block starts
+        key: 32-byte AES key for this block
+        step: Size of the pieces to decrypt, a multiple of the AES block size
+    
+    Yields:
+        Decrypted data, with the PKCS7 padding removed from the last piece
+    """
+    nt_header = NTEncodeHeader.from_buffer_copy(region6_data[offset:offset + ctypes.sizeof(NTEncodeHeader)])
+    if nt_header.magic != b'NTENCODE':
+        raise ValueError(f"Invalid NTEncode magic at offset {offset}")
+    
+    data_offset = offset + ctypes.sizeof(NTEncodeHeader)
+    encrypted_size = nt_header.original_size
+    cipher = AES.new(key, AES.MODE_CBC, bytes(nt_header.iv[:16]))
+    
+    # The last AES block is held back until it is known whether it carries the padding
+    held = b''
+    for pos in range(0, encrypted_size, step):
+        end = min(pos + step, encrypted_size)
+        decrypted_data = held + cipher.decrypt(region6_data[data_offset + pos:data_offset + end])
+        if end < encrypted_size:
+            held = decrypted_data[-AES.block_size:]
+            yield decrypted_data[:-AES.block_size]
+            continue
+        try:
+            decrypted_data = unpad(decrypted_data, AES.block_size)
+        except ValueError:
+            # No padding or invalid padding, keep as is
+            pass
+        yield decrypted_data
@@ -8,35 +8,47 @@ import ctypes
 import time
 import hashlib
 import lzma
+import mmap
 import multiprocessing
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 from .structures import NTEncodeHeader, NTDecompressHeader
-from .crypto import extract_key_from_keymap, decrypt_nt_encode_data
+from .crypto import extract_key_from_keymap, decrypt_nt_encode_stream
 
 
 # ===== Global variables for multiprocessing workers =====
-G_REGION6_DATA = None  # Shared region6 data containing all encrypted file blocks
+G_REGION6_DATA = None  # Region6 view into the worker's own mapping of the .ntpi file
 G_KEYMAP_DATA = None  # Shared keymap data for AES decryption keys
 G_PBAR_LOCK = None  # Lock for synchronized console output
 G_COMPLETED_COUNTER = None  # Atomic counter for tracking completed files
 
+# Decrypted data is fed to the decompressor, and decompressed data to the file, in pieces of this size
+STREAM_STEP = 0x100000
 
-def init_worker(region6_data_blob, keymap_data_blob, pbar_lock, completed_counter):
+
+def init_worker(region6_path, region6_offset, region6_size, keymap_data_blob, pbar_lock, completed_counter):
     """
     Initialize global variables in each worker process.
     
-    This function is called once when each worker process starts,
-    to set up shared data that all workers need access to.
+    This function is called once when each worker process starts. Each
+    worker maps the file holding Region6 itself, so the encrypted blocks
+    are shared through the page cache instead of being copied into every
+    process.
     
     Args:
-        region6_data_blob: Complete Region6 data (encrypted file blocks)
+        region6_path: File containing Region6 (the .ntpi file)
+        region6_offset: Byte offset of Region6 in that file
+        region6_size: Size of Region6
         keymap_data_blob: KeyMap data (AES keys)
         pbar_lock: Multiprocessing lock for synchronized output
         completed_counter: Shared counter for progress tracking
     """
     global G_REGION6_DATA, G_KEYMAP_DATA, G_PBAR_LOCK, G_COMPLETED_COUNTER
-    G_REGION6_DATA = region6_data_blob
+    with open(region6_path, 'rb') as f:
+        region6_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    G_REGION6_DATA = memoryview(region6_map)[region6_offset:region6_offset + region6_size]
     G_KEYMAP_DATA = keymap_data_blob
     G_PBAR_LOCK = pbar_lock
     G_COMPLETED_COUNTER = completed_counter
@@ -57,383 +69,182 @@ def decompress_lzma2_data(decrypted_data):
     Returns:
         Decompressed data as bytes
     """
-    # Validate header size
-    if len(decrypted_data) < ctypes.sizeof(NTDecompressHeader):
-        print(f"Error: Data is too small for NTDecompressHeader")
-        exit(-1)
-    
-    # Validate magic bytes
-    if not decrypted_data.startswith(b'NTENCODE'):
-        print(f"Error: Invalid NTDecompressHeader magic")
-        exit(-1)
-    
-    # Parse decompression header
-    nt_decompress_header = NTDecompressHeader.from_buffer_copy(decrypted_data[:ctypes.sizeof(NTDecompressHeader)])
-    
-    # Compressed data starts at offset 0x70 (112 bytes)
-    data_offset = 0x70
-    if data_offset >= len(decrypted_data):
-        print(f"Error: Data offset exceeds data range in lzma block")
-        exit(-1)
-    
-    compressed_data = decrypted_data[data_offset:]
-    
-    try:
-        # Decompress using LZMA2 algorithm (RAW format)
-        decompressed_data = lzma.decompress(compressed_data, format=lzma.FORMAT_RAW,
-                                            filters=[{"id": lzma.FILTER_LZMA2}])
-        return decompressed_data
-    except lzma.LZMAError as e:
-        print(f"LZMA2 decompression failed: {e}")
-        raise
-    except Exception as e:
-        print(f"Unknown error during decompression: {e}")
-        raise
+    return b''.join(decompress_lzma2_stream([decrypted_data]))
 
 
-def split_file_into_segments(fileinfo, num_segments=4):
+def decompress_lzma2_stream(decrypted_pieces):
     """
-    Split a large file into segments for parallel processing.
+    Decompress LZMA2-compressed data from a decrypted NTEncode block as it is decrypted.
     
-    Each segment contains complete NTEncode blocks. This function scans
-    all block boundaries and divides them evenly by decompressed size.
+    Args:
+        decrypted_pieces: Iterable of decrypted data, starting with NTDecompressHeader
+    
+    Yields:
+        Decompressed data in pieces of at most STREAM_STEP bytes
+    """
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=[{"id": lzma.FILTER_LZMA2}])
+    # Compressed data starts at offset 0x70 (112 bytes), after the NTDecompressHeader
+    header = b''
+    for data in decrypted_pieces:
+        if len(header) < 0x70:
+            needed = 0x70 - len(header)
+            header += data[:needed]
+            data = data[needed:]
+            if len(header) < 0x70:
+                continue
+            if not header.startswith(b'NTENCODE'):
+                raise ValueError("Invalid NTDecompressHeader magic")
+        if decompressor.eof:
+            break
+        try:
+            output = decompressor.decompress(data, max_length=STREAM_STEP)
+            yield output
+            # Large expansions are drained in bounded pieces
+            while not decompressor.eof and not decompressor.needs_input:
+                yield decompressor.decompress(b'', max_length=STREAM_STEP)
+        except lzma.LZMAError as e:
+            raise ValueError(f"LZMA2 decompression failed: {e}")
+    if len(header) < ctypes.sizeof(NTDecompressHeader):
+        raise ValueError("Data is too small for NTDecompressHeader")
+
+
+def scan_file_blocks(fileinfo):
+    """
+    Find the NTEncode blocks of a file in Region6.
     
     Args:
         fileinfo: File metadata dictionary
-        num_segments: Number of segments to create
     
     Returns:
-        List of segment descriptors: [{start_offset, end_offset, start_block_index, num_blocks}, ...]
+        List of (offset, key_index) for each block, in file order
     """
     global G_REGION6_DATA
     
-    offset_start = fileinfo['offset']
-    offset_end = offset_start + fileinfo['length']
-    
-    # Step 1: Scan all block boundaries in this file's region
-    block_boundaries = []  # [(offset, block_index, accumulated_size), ...]
-    current_offset = offset_start
-    block_index = 0
-    accumulated_size = 0
+    offset_end = fileinfo['offset'] + fileinfo['length']
+    blocks = []
+    current_offset = fileinfo['offset']
+    header_size = ctypes.sizeof(NTEncodeHeader)
     
-    while current_offset < offset_end:
-        # Validate header boundaries
-        if current_offset + ctypes.sizeof(NTEncodeHeader) > len(G_REGION6_DATA):
-            break
-        
-        # Parse block header to get size information
-        nt_header = NTEncodeHeader.from_buffer_copy(
-            G_REGION6_DATA[current_offset:current_offset + ctypes.sizeof(NTEncodeHeader)]
-        )
-        
+    while True:
+        if current_offset + header_size > len(G_REGION6_DATA):
+            raise ValueError(f"Block header out of bounds at offset {current_offset}")
+        nt_header = NTEncodeHeader.from_buffer_copy(G_REGION6_DATA[current_offset:current_offset + header_size])
         if nt_header.magic != b'NTENCODE':
-            break
-        
-        # Record this block's starting position and metadata
-        block_boundaries.append((current_offset, block_index, accumulated_size))
-        
-        # Move to next block
-        encrypted_size = nt_header.original_size
-        block_size = ctypes.sizeof(NTEncodeHeader) + encrypted_size
-        current_offset += block_size
-        block_index += 1
-        
-        # Accumulate decompressed size for balanced segmentation
-        accumulated_size += nt_header.processed_size
-    
-    total_blocks = len(block_boundaries)
-    if total_blocks == 0:
-        raise ValueError(f"No valid blocks found for file {fileinfo['name']}")
-    
-    # Step 2: Divide blocks into segments
-    # Goal: Balance each segment's decompressed data size
-    target_size_per_segment = accumulated_size / num_segments
-    
-    segments = []
-    segment_start_idx = 0
-    current_segment_size = 0
-    
-    for i in range(total_blocks):
-        current_segment_size = block_boundaries[i][2] - block_boundaries[segment_start_idx][2]
-        
-        # Decide if current segment should end
-        should_end_segment = False
-        if len(segments) < num_segments - 1:  # Not the last segment yet
-            if current_segment_size >= target_size_per_segment:
-                should_end_segment = True
-        
-        if should_end_segment or i == total_blocks - 1:
-            # Finalize current segment
-            start_offset = block_boundaries[segment_start_idx][0]
-            start_block_idx = block_boundaries[segment_start_idx][1]
-            
-            if i == total_blocks - 1:
-                # Last segment: go to file end
-                end_offset = offset_end
-                num_blocks = total_blocks - segment_start_idx
-            else:
-                # Middle segment: go to next block start
-                end_offset = block_boundaries[i + 1][0] if i + 1 < total_blocks else offset_end
-                num_blocks = i - segment_start_idx + 1
-            
-            segments.append({
-                'start_offset': start_offset,
-                'end_offset': end_offset,
-                'start_block_index': start_block_idx,
-                'num_blocks': num_blocks
-            })
-            
-            # Start next segment
-            segment_start_idx = i + 1
-            current_segment_size = 0
-    
-    return segments
-
-
-def process_segment(fileinfo, segment_info, segment_id):
+            raise ValueError(f"Invalid NTEncode magic at offset {current_offset}")
+        # Key index = file's base key index + block index within file
+        blocks.append((current_offset, fileinfo['keyindex'] + len(blocks)))
+        current_offset += header_size + nt_header.original_size
+        if current_offset >= offset_end:
+            return blocks
+
+
+def decode_block(offset, key_index):
     """
-    Process a single file segment (worker function for parallel processing).
-    
-    This function is called by ThreadPoolExecutor to process one segment
-    of a large file. It decrypts and decompresses all blocks in the segment.
+    Decrypt and decompress one NTEncode block.
     
     Args:
-        fileinfo: File metadata dictionary
-        segment_info: Segment descriptor {start_offset, end_offset, start_block_index, num_blocks}
-        segment_id: Segment identifier (for debugging)
+        offset: Byte offset of the block in Region6
+        key_index: Index of the block's key in the KeyMap
     
-    Returns:
-        Decompressed data for this segment
+    Yields:
+        Decompressed data of the block, piece by piece
     """
     global G_REGION6_DATA, G_KEYMAP_DATA
     
-    start_offset = segment_info['start_offset']
-    end_offset = segment_info['end_offset']
-    start_block_index = segment_info['start_block_index']
-    
-    segment_data = []
-    current_offset = start_offset
-    block_count = 0
-    
-    while current_offset < end_offset:
-        # Calculate key index for current block
-        # Key index = file's base key index + block offset within file
-        current_key_index = fileinfo['keyindex'] + start_block_index + block_count
-        key = extract_key_from_keymap(G_KEYMAP_DATA, current_key_index)
-        
-        # Decrypt current block
-        next_offset, decrypted_data = decrypt_nt_encode_data(G_REGION6_DATA, current_offset, key)
-        
-        # Decompress decrypted data
-        decompressed_data = decompress_lzma2_data(decrypted_data)
-        segment_data.append(decompressed_data)
-        
-        current_offset = next_offset
-        block_count += 1
-    
-    # Concatenate all decompressed blocks in this segment
-    return b''.join(segment_data)
-
-
-def calculate_optimal_segments(file_size):
+    key = extract_key_from_keymap(G_KEYMAP_DATA, key_index)
+    return decompress_lzma2_stream(decrypt_nt_encode_stream(G_REGION6_DATA, offset, key, STREAM_STEP))
+
+
+def decode_block_data(offset, key_index):
     """
-    Calculate optimal number of segments based on file size and CPU cores.
-    
-    This function implements an intelligent segmentation strategy:
-    - Small files (<500MB): No segmentation (sequential processing faster)
-    - Medium files (500MB-1GB): 2 segments
-    - Large files (1GB-2GB): 4 segments
-    - Very large files (2GB-4GB): 6 segments
-    - Huge files (>4GB): 8 segments
-    
-    Segment count is capped at available CPU cores to avoid over-threading.
+    Decrypt and decompress one NTEncode block into memory (thread pool worker).
     
     Args:
-        file_size: File size in bytes
+        offset: Byte offset of the block in Region6
+        key_index: Index of the block's key in the KeyMap
     
     Returns:
-        Optimal number of segments (1-8)
+        List of decompressed pieces of the block
     """
-    cpu_count = os.cpu_count() or 4
-    
-    # Adaptive segmentation strategy based on file size
-    if file_size < 500 * 1024 * 1024:  # < 500MB
-        return 1  # Sequential processing, no overhead
-    elif file_size < 1024 * 1024 * 1024:  # 500MB - 1GB
-        return min(2, cpu_count)
-    elif file_size < 2 * 1024 * 1024 * 1024:  # 1GB - 2GB
-        return min(4, cpu_count)
-    elif file_size < 4 * 1024 * 1024 * 1024:  # 2GB - 4GB
-        return min(6, cpu_count)
-    else:  # > 4GB
-        return min(8, cpu_count)
+    return list(decode_block(offset, key_index))
 
 
-def process_large_file_parallel(fileinfo, files_output_dir, position):
+def plan_file_threads(files_info, process_count):
     """
-    Multi-threaded parallel processing for large files (>= 500MB).
+    Balance extraction across the worker pool by compressed bytes.
     
-    This function splits large files into segments and processes them
-    in parallel using ThreadPoolExecutor, providing 3-4x speedup.
+    Files are handed out largest first, so the pool stays busy until the end.
+    A file larger than the share of one worker also gets threads for its
+    blocks, as many as the shares of Region6 it covers.
     
     Args:
-        fileinfo: File metadata dictionary
-        files_output_dir: Directory to save extracted files
-        position: Progress bar position (for multi-process coordination)
+        files_info: List of file metadata dictionaries
+        process_count: Number of worker processes
     
     Returns:
-        Tuple of (filename, success, message)
+        List of (fileinfo, thread_count), largest file first
     """
-    global G_REGION6_DATA, G_COMPLETED_COUNTER, G_PBAR_LOCK
-    
-    filename = fileinfo['name']
-    expected_size = fileinfo['size']
-    expected_hash = fileinfo['hash'].lower()
-    output_file = files_output_dir / filename
-    
-    try:
-        # Calculate optimal segment count based on file size and CPU
-        num_segments = calculate_optimal_segments(expected_size)
-        segment_start_time = time.time()
-        
-        # Print processing info (synchronized to avoid console corruption)
-        with G_PBAR_LOCK:
-            print(f"\n{'='*80}")
-            print(f"Large File Processing: {filename}")
-            print(f"   File Size: {expected_size/(1024**2):.2f} MB")
-            print(f"   CPU Cores: {os.cpu_count()}, Optimal Segments: {num_segments}")
-            print(f"   Analyzing block structure...")
-        
-        # Split file into segments at block boundaries
-        segments = split_file_into_segments(fileinfo, num_segments)
-        
-        with G_PBAR_LOCK:
-            print(f"   Split into {len(segments)} segments, ~{expected_size/(1024**2)/len(segments):.2f} MB each")
-            for i, seg in enumerate(segments):
-                print(f"     Segment {i+1}: {seg['num_blocks']} blocks")
-            print(f"   Starting {num_segments}-thread parallel processing...")
-        
-        # Process segments in parallel using thread pool
-        with ThreadPoolExecutor(max_workers=num_segments) as executor:
-            futures = []
-            for seg_id, segment_info in enumerate(segments):
-                # Submit each segment to thread pool
-                future = executor.submit(process_segment, fileinfo, segment_info, seg_id)
-                futures.append(future)
-            
-            # Collect results in order (important for correct file reassembly)
-            segment_results = []
-            for seg_id, future in enumerate(futures):
-                with G_PBAR_LOCK:
-                    print(f"   Waiting for segment {seg_id+1}...")
-                seg_data = future.result()
-                segment_results.append(seg_data)
-                with G_PBAR_LOCK:
-                    print(f"   Segment {seg_id+1} completed ({len(seg_data)/(1024**2):.2f} MB)")
-        
-        # Merge all segments into final file
-        with G_PBAR_LOCK:
-            print(f"   Merging all segments...")
-        
-        final_data = b''.join(segment_results)
-        actual_size = len(final_data)
-        
-        # Verify decompressed size matches expected
-        if actual_size != expected_size:
-            with G_PBAR_LOCK:
-                print(f"   Size mismatch: Expected {expected_size/(1024**2):.2f} MB, "
-                      f"Got {actual_size/(1024**2):.2f} MB")
-        
-        # Verify SHA256 hash for data integrity
-        with G_PBAR_LOCK:
-            print(f"   Verifying SHA256...")
-        
-        actual_hash = hashlib.sha256(final_data).hexdigest().lower()
-        if actual_hash != expected_hash:
-            with G_PBAR_LOCK:
-                print(f"   Hash verification failed!")
-            return filename, False, f"Hash mismatch"
-        
-        # Write final data to output file
-        with G_PBAR_LOCK:
-            print(f"   Writing to disk...")
-        
-        with open(output_file, 'wb') as f:
-            f.write(final_data)
-        
-        # Calculate and display performance metrics
-        process_time = time.time() - segment_start_time
-        speed = expected_size / (1024**2) / process_time  # MB/s
-        
-        with G_PBAR_LOCK:
-            print(f"   Completed! Time: {process_time:.2f}s, Speed: {speed:.2f} MB/s")
-            print(f"{'='*80}\n")
-        
-        # Update global completion counter for progress bar
-        with G_COMPLETED_COUNTER.get_lock():
-            G_COMPLETED_COUNTER.value += 1
-        
-        return filename, True, str(output_file)
-        
-    except Exception as e:
-        return filename, False, f"Processing failed: {e}"
+    total = sum(fileinfo['length'] for fileinfo in files_info) or 1
+    cpu_count = os.cpu_count() or 4
+    plan = []
+    for fileinfo in sorted(files_info, key=lambda info: info['length'], reverse=True):
+        share = fileinfo['length'] * process_count / total
+        plan.append((fileinfo, max(1, min(cpu_count, round(share)))))
+    return plan
 
 
-def process_file_task(fileinfo, files_output_dir, position):
+def process_file_task(fileinfo, files_output_dir, thread_count=1):
     """
-    Process a single file (dispatcher function).
+    Extract a single file (worker function).
     
-    Routes to appropriate processing method based on file size:
-    - Small files (<500MB): Sequential processing
-    - Large files (>=500MB): Multi-threaded segmented processing
+    Blocks are decrypted, decompressed, hashed and written in a pipeline, so
+    only a few blocks of the file are in memory at any time. With more than
+    one thread, blocks are decoded in parallel and written in order.
     
     Args:
         fileinfo: File metadata dictionary
         files_output_dir: Directory to save extracted files
-        position: Progress bar position for tqdm
+        thread_count: Number of threads decoding the file's blocks
     
     Returns:
         Tuple of (filename, success, message)
     """
-    global G_REGION6_DATA, G_COMPLETED_COUNTER, G_PBAR_LOCK, G_KEYMAP_DATA
+    global G_COMPLETED_COUNTER, G_PBAR_LOCK
     
-    LARGE_FILE_THRESHOLD = 500 * 1024 * 1024  # 500MB
-    
-    # Route large files to parallel processing
-    if fileinfo['size'] >= LARGE_FILE_THRESHOLD:
-        return process_large_file_parallel(fileinfo, files_output_dir, position)
-    
-    # Small files: Sequential processing (original logic)
-    offset_start = fileinfo['offset']
-    offset_end = offset_start + fileinfo['length']
     filename = fileinfo['name']
     expected_size = fileinfo['size']
     expected_hash = fileinfo['hash'].lower()
     output_file = files_output_dir / filename
 
     try:
-        final_data_list = []
-        process_offset = offset_start
-        index = 0
-        
-        # Create progress bar for this file
-        while True:
-            # Get key for current block
-            key = extract_key_from_keymap(G_KEYMAP_DATA, fileinfo['keyindex'] + index)
-            index += 1
-
-            # Decrypt and decompress current block
-            process_offset, decrypted_data = decrypt_nt_encode_data(G_REGION6_DATA, process_offset, key)
-            decompress_data = decompress_lzma2_data(decrypted_data)
-            final_data_list.append(decompress_data)
-
-            # Check if we've processed all blocks for this file
-            if process_offset >= offset_end:
-                break
-
-        # Combine all decompressed blocks
-        final_data = b''.join(final_data_list)
-        actual_size = len(final_data)
+        blocks = scan_file_blocks(fileinfo)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        sha256 = hashlib.sha256()
+        actual_size = 0
+        with open(output_file, 'wb') as f:
+            if thread_count > 1:
+                # Keep a bounded window of blocks in flight, consume them in file order
+                with ThreadPoolExecutor(max_workers=thread_count) as executor:
+                    pending = deque()
+                    for block in blocks:
+                        pending.append(executor.submit(decode_block_data, *block))
+                        if len(pending) < thread_count * 2:
+                            continue
+                        for data in pending.popleft().result():
+                            sha256.update(data)
+                            f.write(data)
+                            actual_size += len(data)
+                    while pending:
+                        for data in pending.popleft().result():
+                            sha256.update(data)
+                            f.write(data)
+                            actual_size += len(data)
+            else:
+                for block in blocks:
+                    for data in decode_block(*block):
+                        sha256.update(data)
+                        f.write(data)
+                        actual_size += len(data)
 
         # Verify size
         if actual_size != expected_size:
@@ -441,14 +252,10 @@ def process_file_task(fileinfo, files_output_dir, position):
                 print(f"Warning: {filename} size mismatch. Expected {expected_size}, Got {actual_size}")
 
         # Verify hash for data integrity
-        actual_hash = hashlib.sha256(final_data).hexdigest().lower()
-        if actual_hash != expected_hash:
+        if sha256.hexdigest().lower() != expected_hash:
+            os.remove(output_file)
             return filename, False, f"Hash mismatch"
 
-        # Write to output file
-        with open(output_file, 'wb') as f:
-            f.write(final_data)
-
         # Update completion counter
         with G_COMPLETED_COUNTER.get_lock():
             G_COMPLETED_COUNTER.value += 1
@@ -464,7 +271,8 @@ def stage2_extract_files(temp_dir, final_output_dir, all_files=True, process_cou
     Extract and decompress all files from Region6 (Stage 2).
     
     This function coordinates parallel extraction of files using multiprocessing.
-    Large files (>=500MB) are further parallelized with multi-threaded segmentation.
+    Work is balanced by compressed bytes, large files also decode their blocks
+    on several threads (see plan_file_threads).
     
     Args:
         temp_dir: Directory containing extracted region files from Stage 1
@@ -475,19 +283,27 @@ def stage2_extract_files(temp_dir, final_output_dir, all_files=True, process_cou
     Returns:
         True if all files extracted successfully, False otherwise
     """
-    from .parser import parse_fileindex_xml
+    from .parser import parse_fileindex_xml, get_region6_view
     
     print(f"\n=== Stage 2: Extracting Files (Optimized)... ===")
     stage2_start = time.time()
     
+    # Callers pass plain string paths
+    temp_dir = Path(temp_dir)
+    final_output_dir = Path(final_output_dir)
+
     # Verify required input files exist
-    fileindex_path = f"{temp_dir}/FileIndex.xml"
-    keymap_path = f"{temp_dir}/KeyMap.bin"
-    region6_path = f"{temp_dir}/region6block.bin"
-    for path in [fileindex_path, keymap_path, region6_path]:
+    fileindex_path = temp_dir / "FileIndex.xml"
+    keymap_path = temp_dir / "KeyMap.bin"
+    for path in [fileindex_path, keymap_path]:
         if not os.path.exists(path):
             print(f"Error: Required file for stage 2 not found: {path}")
             exit(-1)
+    region6_view = get_region6_view(temp_dir)
+    if region6_view is None:
+        print(f"Error: Required Region6 data for stage 2 not found in {temp_dir}")
+        exit(-1)
+    region6_path, region6_offset, region6_size = region6_view
 
     # Create output directory
     files_output_dir = final_output_dir
@@ -508,64 +324,43 @@ def stage2_extract_files(temp_dir, final_output_dir, all_files=True, process_cou
         print(f"--- Running in test mode: processing only the first file. ---")
         files_info = files_info[:1]
 
-    # Sort by file size: small files first, large files last
-    # This provides better UX (small files complete quickly, large files run in parallel at end)
-    LARGE_FILE_THRESHOLD = 500 * 1024 * 1024  # 500MB
-    small_files = [f for f in files_info if f['size'] < LARGE_FILE_THRESHOLD]
-    large_files = [f for f in files_info if f['size'] >= LARGE_FILE_THRESHOLD]
-    
-    # Reorder: small files first, large files last
-    files_info = small_files + large_files
-    
-    if large_files:
-        print(f"Detected {len(large_files)} large file(s) (>=500MB), will use multi-threaded acceleration")
-        print(f"Strategy: Process {len(small_files)} small files first, then large files")
-    
-    # Load Region6 and KeyMap into memory for fast access
-    print(f"Loading data into memory...")
+    # Only the KeyMap is loaded, workers map Region6 themselves
     try:
-        with open(region6_path, 'rb') as f:
-            region6_data = f.read()
         with open(keymap_path, 'rb') as f:
             keymap_data = f.read()
-    except MemoryError:
-        print(f"Fatal: Out of memory. Please use a machine with more RAM.")
-        exit(1)
     except Exception as e:
         print(f"Fatal: Failed to load required data into memory: {e}")
         exit(1)
 
     # Determine number of worker processes
     PROCESS_COUNT = process_count if process_count else os.cpu_count() or 8
+
+    # Largest files first, the ones bigger than a worker's share decode on several threads
+    plan = plan_file_threads(files_info, PROCESS_COUNT)
+    for fileinfo, thread_count in plan:
+        if thread_count > 1:
+            print(f"{fileinfo['name']}: {fileinfo['length']/(1024**2):.2f} MB compressed, {thread_count} threads")
     
     # Create shared resources for multiprocessing
     manager = multiprocessing.Manager()
     pbar_lock = manager.Lock()  # For synchronized console output
     completed_counter = multiprocessing.Value('i', 0)  # Atomic counter
     
-    # Create total progress bar (always at bottom, below worker progress bars)
-
-
-    # Create task list: each task is (fileinfo, output_dir, progress_bar_position)
+    # Create task list: each task is (fileinfo, output_dir, thread_count)
     tasks = [
-        (fileinfo, files_output_dir, i % PROCESS_COUNT)
-        for i, fileinfo in enumerate(files_info)
+        (fileinfo, files_output_dir, thread_count)
+        for fileinfo, thread_count in plan
     ]
 
     # Create multiprocessing pool and process all files
     with multiprocessing.Pool(
             processes=PROCESS_COUNT,
             initializer=init_worker,
-            initargs=(region6_data, keymap_data, pbar_lock, completed_counter)
+            initargs=(region6_path, region6_offset, region6_size, keymap_data, pbar_lock, completed_counter)
     ) as pool:
-        # Delete local references (data is now shared with workers)
-        del region6_data
-        del keymap_data
-        
         try:
-            # Start async processing of all tasks
-            async_result = pool.starmap_async(process_file_task, tasks)
-            # Monitor progress and update total progress ba
+            # Start async processing of all tasks, one at a time so the largest go first
+            async_result = pool.starmap_async(process_file_task, tasks, chunksize=1)
             # Get results after all tasks complete
             pool_results = async_result.get()
         except KeyboardInterrupt:
@@ -574,9 +369,6 @@ def stage2_extract_files(temp_dir, final_output_dir, all_files=True, process_cou
             pool.terminate()
             pool.join()
             sys.exit(1)
-    
-    # Final progress bar update
-
 
     # Count successes and failures
     success_count = 0
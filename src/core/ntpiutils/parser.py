@@ -3,9 +3,12 @@ NTPI File Parser
 Handles parsing of NTPI file structure and region extraction.
 """
 import ctypes
+import json
+import mmap
 import os.path
 import time
 import xml.etree.ElementTree as ET
+from pathlib import Path
 
 from .structures import (
     NTPIHeader, RegionBlockHeader, get_aesdict_for_version
@@ -13,16 +16,20 @@ from .structures import (
 from .crypto import get_aes_key_iv_for_region, aes_cbc_decrypt
 
 
-def extract_region_data(file_data, region_header, offset, output_dir, keys_dict=None):
+REGION6_VIEW = "region6block.json"
+
+
+def extract_region_data(file_data, region_header, offset, output_dir, keys_dict=None, file_path=None):
     """
     Extract and decrypt a region from the NTPI file.
     
     Args:
-        file_data: Complete NTPI file data in memory
+        file_data: Complete NTPI file data (a memory map of the file)
         region_header: RegionHeader structure for this region
         offset: Byte offset where region data starts
         output_dir: Directory to save extracted files
         keys_dict: Dictionary of AES keys for decryption
+        file_path: Path of the NTPI file, which Region6 is left in
     
     Returns:
         Tuple of (next_offset, next_region_header) or (-1, None) if no more regions
@@ -43,15 +50,19 @@ def extract_region_data(file_data, region_header, offset, output_dir, keys_dict=
         print(f"Error: Region data out of bounds for {region_name}")
         exit(-1)
     
-    # Extract region data
-    region_data = file_data[offset:offset + region_header.region_size]
-    
-    # Region6 contains encrypted file blocks, save as-is for later processing
+    # Region6 contains encrypted file blocks, record where it is for later processing
     if region_header.region_type == 6:
-        output_file = output_dir / "region6block.bin"
-        with open(output_file, 'wb') as f:
-            f.write(region_data)
+        if file_path is None:
+            output_file = output_dir / "region6block.bin"
+            with open(output_file, 'wb') as f:
+                f.write(file_data[offset:offset + region_header.region_size])
+            return -1, None
+        with open(output_dir / REGION6_VIEW, 'w', encoding='utf-8') as f:
+            json.dump({'file': os.path.abspath(file_path), 'offset': offset, 'size': region_header.region_size}, f)
         return -1, None
+
+    # Extract region data
+    region_data = file_data[offset:offset + region_header.region_size]
     
     # Get decryption keys for this region
     key, iv = None, None
@@ -113,15 +124,32 @@ def parse_ntpi_file(file_path, output_dir):
         print(f"Error: Input file not found: {file_path}")
         return False
 
-    # Read entire file into memory
-    with open(file_path, 'rb') as f:
-        file_data = f.read()
-    
     # Validate file size
-    if len(file_data) < ctypes.sizeof(NTPIHeader):
+    if os.path.getsize(file_path) < ctypes.sizeof(NTPIHeader):
         print(f"Error: File is too small to be a valid NTPI file.")
         return False
+
+    # Callers pass plain string paths
+    output_dir = Path(output_dir)
+
+    # Map the file, only the regions that are decrypted get read into memory
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_data:
+        return parse_ntpi_data(file_data, file_path, output_dir, stage1_start)
+
+
+def parse_ntpi_data(file_data, file_path, output_dir, stage1_start):
+    """
+    Parse the NTPI header and extract all regions from the mapped file.
+    
+    Args:
+        file_data: Memory map of the .ntpi file
+        file_path: Path to the .ntpi file
+        output_dir: Directory to save extracted region files
+        stage1_start: Time stage 1 started at
     
+    Returns:
+        True if successful, False otherwise
+    """
     # Parse NTPI header
     ntpi_header = NTPIHeader.from_buffer_copy(file_data[:ctypes.sizeof(NTPIHeader)])
     if not ntpi_header.is_valid():
@@ -156,7 +184,7 @@ def parse_ntpi_file(file_path, output_dir):
     
     while current_region and current_region.region_size > 0:
         region_count += 1
-        result = extract_region_data(file_data, current_region, current_offset, output_dir, keys_dict)
+        result = extract_region_data(file_data, current_region, current_offset, output_dir, keys_dict, file_path)
         if isinstance(result, tuple):
             next_offset, next_region = result
             if next_offset == -1:
@@ -172,6 +200,30 @@ def parse_ntpi_file(file_path, output_dir):
     return True
 
 
+def get_region6_view(temp_dir):
+    """
+    Locate the Region6 data left by stage 1.
+    
+    Stage 1 records where Region6 is in the .ntpi file instead of copying it,
+    older temp directories may still hold a region6block.bin copy.
+    
+    Args:
+        temp_dir: Directory containing extracted region files from Stage 1
+    
+    Returns:
+        Tuple of (file_path, offset, size), or None if stage 1 left no Region6
+    """
+    view_path = os.path.join(temp_dir, REGION6_VIEW)
+    if os.path.exists(view_path):
+        with open(view_path, 'r', encoding='utf-8') as f:
+            view = json.load(f)
+        return view['file'], view['offset'], view['size']
+    block_path = os.path.join(temp_dir, "region6block.bin")
+    if os.path.exists(block_path):
+        return block_path, 0, os.path.getsize(block_path)
+    return None
+
+
 def parse_fileindex_xml(xml_path):
     """
     Parse FileIndex.xml to get information about all files in the archive.
@@ -4,7 +4,11 @@
 
 import hashlib
 import os
+import zlib
 from binascii import unhexlify, hexlify
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from multiprocessing import cpu_count
 from struct import unpack
 
 from Crypto.Cipher import AES
@@ -78,6 +82,14 @@ keytables = [
 ]
 
 
+# Index into keytables of the key that worked for a firmware family (project name or cpu)
+keycache = {}
+
+# Entries are decrypted and copied in buffers of this size
+COPY_SIZE = 0x1000000
+
+
+@lru_cache(maxsize=None)
 def getkey(index):
     kt = keytables[index]
     if len(kt) == 3:
@@ -93,21 +105,110 @@ def getkey(index):
     return aeskey, aesiv
 
 
-def brutekey(rf):
+def brutekey(rf, family=None):
     rf.seek(0)
     encdata = rf.read(16)
-    for keyid in range(0, len(keytables)):
+    keyids = list(range(0, len(keytables)))
+    if family in keycache:
+        keyids.remove(keycache[family])
+        keyids.insert(0, keycache[family])
+    for keyid in keyids:
         aeskey, aesiv = getkey(keyid)
         data = aes_cfb(aeskey, aesiv, encdata, True)
         if data[:3] == b"MMM":
+            if family:
+                keycache[family] = keyid
             return aeskey, aesiv
     print("Unknown key. Please ask the author for support :)")
     exit(0)
 
 
+# What a hdr2 crc may cover: the written file, the entry as stored in the ofp, or its encrypted part
+CRC_COVERAGE = ("output", "stored", "encrypted")
+
 cleancstring = lambda string: string.replace(b"\x00", b"").decode('utf-8')
 
 
+def copytail(rf, wf, start, length, crcs=None):
+    """
+    Copies length bytes at start of rf to the current position of wf. Without crcs this goes
+    through copy_file_range where available, else every running crc32 in crcs is updated on the way.
+    Returns the number of bytes copied.
+    """
+    copied = 0
+    if crcs is None and hasattr(os, 'copy_file_range'):
+        wf.flush()
+        try:
+            while copied < length:
+                count = os.copy_file_range(rf.fileno(), wf.fileno(), length - copied, start + copied)
+                if not count:
+                    break
+                copied += count
+        except OSError:
+            # Unsupported across these filesystems, fall back to copying the rest
+            pass
+        wf.seek(0, os.SEEK_END)
+    rf.seek(start + copied)
+    buf = memoryview(bytearray(min(COPY_SIZE, max(length - copied, 1))))
+    while copied < length:
+        count = rf.readinto(buf[:min(len(buf), length - copied)])
+        if not count:
+            break
+        wf.write(buf[:count])
+        if crcs is not None:
+            for key in crcs:
+                crcs[key] = zlib.crc32(buf[:count], crcs[key])
+        copied += count
+    return copied
+
+
+def extractentry(filename, outdir, aeskey, aesiv, entry):
+    """
+    Writes one hdr2 entry: the first enclength bytes are AES-CFB encrypted, the rest is stored
+    as is. Returns (name, crc status, size).
+
+    A nonzero hdr2 crc is checked as a zlib crc32 over one of CRC_COVERAGE, computed while
+    copying; entries without one keep the copy_file_range tail.
+    """
+    name, start, length, enclength, wfilename, crc = entry
+    print(f"Writing \"{name}\" as \"{outdir}/{wfilename}\"...")
+    crcs = dict.fromkeys(CRC_COVERAGE, 0) if crc else None
+    with open(filename, 'rb') as rf, open(os.path.join(outdir, wfilename), 'wb') as wb:
+        if enclength > 0:
+            rf.seek(start)
+            cipher = AES.new(aeskey, AES.MODE_CFB, IV=aesiv, segment_size=128)
+            remaining = enclength
+            while remaining > 0:
+                encdata = rf.read(min(COPY_SIZE, remaining))
+                if not encdata:
+                    break
+                count = len(encdata)
+                remaining -= count
+                if crcs is not None:
+                    crcs["stored"] = zlib.crc32(encdata, crcs["stored"])
+                if count % 16 != 0:
+                    encdata += b"\x00" * (16 - (count % 16))
+                data = cipher.decrypt(encdata)[:count]
+                wb.write(data)
+                if crcs is not None:
+                    crcs["output"] = zlib.crc32(data, crcs["output"])
+            if crcs is not None:
+                crcs["encrypted"] = crcs["stored"]
+            length -= enclength
+        if length > 0:
+            tail = None if crcs is None else {key: crcs[key] for key in ("output", "stored")}
+            copytail(rf, wb, start + enclength, length, tail)
+            if tail is not None:
+                crcs.update(tail)
+    if crcs is None:
+        status = "empty"
+    else:
+        status = next((f"verified ({key})" for key, value in crcs.items() if value == crc), "bad")
+        if status == "bad":
+            print(f"{wfilename}: crc mismatch (header {crc:08x}, data {crcs['output']:08x}). File might be broken!")
+    return wfilename, status, os.path.getsize(os.path.join(outdir, wfilename))
+
+
 def main(filename, outdir):
     if not os.path.exists(outdir):
         os.mkdir(outdir)
@@ -115,7 +216,6 @@ def main(filename, outdir):
     filesize = os.stat(filename).st_size
     hdrlength = 0x6C
     with open(filename, 'rb') as rf:
-        aeskey, aesiv = brutekey(rf)
         rf.seek(filesize - hdrlength)
         hdr = mtk_shuffle(hdrkey, len(hdrkey), bytearray(rf.read(hdrlength)), hdrlength)
         # _,_,_ = unknownval, reserved, crc
@@ -129,30 +229,24 @@ def main(filename, outdir):
         if prjinfo: print(f"Detected prjinfo:{prjinfo}")
         if cpu: print(f"Detected cpu:{cpu}")
         if flashtype: print(f"Detected flash:{flashtype}")
+        # The header is not AES encrypted, so the family is known before looking for the key
+        aeskey, aesiv = brutekey(rf, prjname or cpu or None)
 
         rf.seek(filesize - hdr2length - hdrlength)
         hdr2 = mtk_shuffle(hdrkey, len(hdrkey), bytearray(rf.read(hdr2length)), hdr2length)
-        for i in range(0, len(hdr2) // 0x60):
-            # _=crc
-            name, start, length, enclength, filename, _ = unpack("<32s Q Q Q 32s Q", hdr2[i * 0x60:(i * 0x60) + 0x60])
-            name = name.replace(b"\x00", b"").decode('utf-8')
-            filename = filename.replace(b"\x00", b"").decode('utf-8')
-            print(f"Writing \"{name}\" as \"{outdir}/{filename}\"...")
-            with open(os.path.join(outdir, filename), 'wb') as wb:
-                if enclength > 0:
-                    rf.seek(start)
-                    encdata = rf.read(enclength)
-                    if enclength % 16 != 0:
-                        encdata += b"\x00" * (16 - (enclength % 16))
-                    data = aes_cfb(aeskey, aesiv, encdata, True)
-                    wb.write(data[:enclength])
-                    length -= enclength
-                while length > 0:
-                    size = 0x200000
-                    if length < size:
-                        size = length
-                    data = rf.read(size)
-                    length -= size
-                    wb.write(data)
-
+    entries = []
+    for i in range(0, len(hdr2) // 0x60):
+        name, start, length, enclength, wfilename, crc = unpack("<32s Q Q Q 32s Q", hdr2[i * 0x60:(i * 0x60) + 0x60])
+        entries.append((cleancstring(name), start, length, enclength, cleancstring(wfilename), crc))
+
+    # Entries are independent, each one is read once and written once
+    with ThreadPoolExecutor(max_workers=min(cpu_count(), 8)) as executor:
+        results = [future.result() for future in
+                   [executor.submit(extractentry, filename, outdir, aeskey, aesiv, entry) for entry in entries]]
+
+    bad = [name for name, status, _ in results if status == "bad"]
+    verified = len([status for _, status, _ in results if status.startswith("verified")])
+    print(f"crc: {verified} verified, {len(bad)} bad, {len(results) - verified - len(bad)} without crc")
+    if bad:
+        print(f"Broken: {', '.join(bad)}")
     print(f"Files successfully decrypted to subdirectory {outdir}")
@@ -3,8 +3,11 @@
 import hashlib
 import os
 import shutil
+import time
 import xml.etree.ElementTree as et
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from struct import unpack
 
 from Crypto.Cipher import AES
@@ -134,94 +137,113 @@ def aes_cfb(data, key, iv):
     return AES.new(key, AES.MODE_CFB, iv=iv, segment_size=128).decrypt(data)
 
 
+# Items are read and written in buffers of this size
+COPY_SIZE = 0x1000000
+# ProFile.xml md5 (and possibly sha256) checksums only cover the start of an item
+HASH_HEAD = 0x40000
+
+
+class HashWriter:
+    """
+    Writes an item while hashing it: md5 and sha256 of the first HASH_HEAD bytes, and sha256
+    of the whole item, so it does not have to be read back to be verified.
+    """
+
+    def __init__(self, wf):
+        self.wf = wf
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.sha256head = hashlib.sha256()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        if self.size < HASH_HEAD:
+            head = data[:HASH_HEAD - self.size]
+            self.md5.update(head)
+            self.sha256head.update(head)
+        self.sha256.update(data)
+        self.wf.write(data)
+        self.size += len(data)
+
+
 def copysub(rf, wf, start, length):
     rf.seek(start)
     rlen = 0
+    buf = memoryview(bytearray(min(COPY_SIZE, max(length, 1))))
     while length > 0:
-        size = length if length < 0x100000 else 0x100000
-        data = rf.read(size)
-        wf.write(data)
-        rlen += len(data)
-        length -= size
+        count = rf.readinto(buf[:min(len(buf), length)])
+        if not count:
+            break
+        wf.write(buf[:count])
+        rlen += count
+        length -= count
     return rlen
 
 
 def copy(filename, wfilename, path, start, length, checksums):
-    print(f"\nExtracting {wfilename}")
     with open(filename, 'rb') as rf:
         with open(os.path.join(path, wfilename), 'wb') as wf:
-            rf.seek(start)
-            wf.write(rf.read(length))
-    checkhashfile(os.path.join(path, wfilename), checksums, True)
+            hw = HashWriter(wf)
+            copysub(rf, hw, start, length)
+    return checkhash(wfilename, hw, checksums, True)
 
 
 def decryptfile(key, iv, filename, path, wfilename, start, length, rlength, checksums, decryptsize=0x40000):
-    print(f"\nExtracting {wfilename}")
-    if rlength == length:
-        tlen = length
-        length = (length // 0x4 * 0x4)
-        if tlen % 0x4 != 0:
-            length += 0x4
-
     with open(filename, 'rb') as rf:
         with open(os.path.join(path, wfilename), 'wb') as wf:
+            hw = HashWriter(wf)
             rf.seek(start)
             size = decryptsize
             if rlength < decryptsize:
                 size = rlength
-            data = rf.read(size)
-            if size % 4:
-                data += (4 - (size % 4)) * b'\x00'
-            outp = aes_cfb(data, key, iv)
-            wf.write(outp[:size])
+            # CFB keeps its state between calls as long as each (but the last) is whole blocks
+            cipher = AES.new(key, AES.MODE_CFB, iv=iv, segment_size=128)
+            remaining = size
+            while remaining > 0:
+                data = rf.read(min(COPY_SIZE, remaining))
+                if not data:
+                    break
+                count = len(data)
+                remaining -= count
+                if count % 4:
+                    data += (4 - (count % 4)) * b'\x00'
+                hw.write(cipher.decrypt(data)[:count])
 
             if rlength > decryptsize:
-                copysub(rf, wf, start + size, rlength - size)
-
-            if rlength % 0x1000 != 0:
-                ...
-                # wf.write(fill)
+                copysub(rf, hw, start + size, rlength - size)
 
-    checkhashfile(os.path.join(path, wfilename), checksums, False)
+    return checkhash(wfilename, hw, checksums, False)
 
 
-def checkhashfile(wfilename, checksums, iscopy):
+def checkhash(wfilename, hw, checksums, iscopy):
+    """
+    Checks the hashes HashWriter computed against the item's; sha256 may cover either the
+    first HASH_HEAD bytes or the whole item. Returns (wfilename, ok, status, size).
+    """
     sha256sum = checksums[0]
     md5sum = checksums[1]
     prefix = "Copy: " if iscopy else "Decrypt: "
-    with open(wfilename, "rb") as rf:
-        size = os.stat(wfilename).st_size
-        md5 = hashlib.md5(rf.read(0x40000))
-        sha256bad = False
-        md5bad = False
-        md5status = "empty"
-        sha256status = "empty"
-        if sha256sum:
-            for x in [0x40000, size]:
-                rf.seek(0)
-                # sha256 = hashlib.sha256(rf.read(x))
-                sha256 = hashlib.sha256()
-                if x == 0x40000:
-                    sha256.update(rf.read(x))
-                if x == size:
-                    for chunk in iter(lambda: rf.read(128 * sha256.block_size), b''):
-                        sha256.update(chunk)
-                if sha256sum != sha256.hexdigest():
-                    sha256bad = True
-                    sha256status = "bad"
-                else:
-                    sha256status = "verified"
-                    break
-        if md5sum:
-            if md5sum != md5.hexdigest():
-                md5bad = True
-                md5status = "bad"
-            else:
-                md5status = "verified"
-        if (sha256bad and md5bad) or (sha256bad and md5sum == "") or (md5bad and sha256sum == ""):
-            print(f"{prefix}error on hashes. File might be broken!")
+    sha256bad = False
+    md5bad = False
+    md5status = "empty"
+    sha256status = "empty"
+    if sha256sum:
+        if sha256sum in (hw.sha256head.hexdigest(), hw.sha256.hexdigest()):
+            sha256status = "verified"
+        else:
+            sha256bad = True
+            sha256status = "bad"
+    if md5sum:
+        if md5sum != hw.md5.hexdigest():
+            md5bad = True
+            md5status = "bad"
         else:
-            print(f"{prefix}success! (md5: {md5status} | sha256: {sha256status})")
+            md5status = "verified"
+    if (sha256bad and md5bad) or (sha256bad and md5sum == "") or (md5bad and sha256sum == ""):
+        print(f"{wfilename}: {prefix}error on hashes. File might be broken!")
+        return wfilename, False, "broken", hw.size
+    print(f"{wfilename}: {prefix}success! (md5: {md5status} | sha256: {sha256status})")
+    return wfilename, True, f"md5: {md5status} | sha256: {sha256status}", hw.size
 
 
 def decryptitem(item, pagesize):
@@ -292,6 +314,8 @@ def main(filename, outdir):
     with open(f"{path}/ProFile.xml", mode="w") as file_handle:
         file_handle.write(xml)
 
+    # Keyed by output name: an item listed twice was simply overwritten by the later entry
+    jobs = {}
     for child in et.fromstring(xml):
         for item in child:
             if "Path" not in item.attrib and "filename" not in item.attrib:
@@ -299,7 +323,8 @@ def main(filename, outdir):
                     wfilename, start, length, rlength, checksums, decryptsize = decryptitem(subitem, pagesize)
                     if wfilename == "" or start == -1:
                         continue
-                    decryptfile(key, iv, filename, path, wfilename, start, length, rlength, checksums, decryptsize)
+                    jobs[wfilename] = (decryptfile, key, iv, filename, path, wfilename, start, length, rlength,
+                                       checksums, decryptsize)
             wfilename, start, length, rlength, checksums, decryptsize = decryptitem(item, pagesize)
             if wfilename == "" or start == -1:
                 continue
@@ -308,9 +333,24 @@ def main(filename, outdir):
             if child.tag in ["Config", "Provision", "ChainedTableOfDigests", "DigestsToSign", "Firmware"]:
                 length = rlength
             if child.tag in ["DigestsToSign", "ChainedTableOfDigests", "Firmware"]:
-                copy(filename, wfilename, path, start, length, checksums)
+                jobs[wfilename] = (copy, filename, wfilename, path, start, length, checksums)
             else:
-                decryptfile(key, iv, filename, path, wfilename, start, length, rlength, checksums, decryptsize)
+                jobs[wfilename] = (decryptfile, key, iv, filename, path, wfilename, start, length, rlength,
+                                   checksums, decryptsize)
+
+    # Items are independent, each one is read once and written once
+    print(f"\nExtracting {len(jobs)} items")
+    begin = time.time()
+    with ThreadPoolExecutor(max_workers=min(cpu_count(), 8)) as executor:
+        results = [future.result() for future in [executor.submit(*job) for job in jobs.values()]]
+    elapsed = max(time.time() - begin, 1e-6)
+
+    total = sum(size for _, _, _, size in results)
+    broken = [name for name, ok, _, _ in results if not ok]
+    print(f"\nVerified {len(results) - len(broken)}/{len(results)} items, "
+          f"{total / 1048576:.1f} MiB in {elapsed:.1f}s ({total / 1048576 / elapsed:.1f} MiB/s)")
+    for name in broken:
+        print(f"Broken: {name}")
     print(f"\nDone. Extracted files to {path}")
 
     # main(filename_, outdir_)
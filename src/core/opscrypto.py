@@ -7,6 +7,8 @@
 import shutil
 
 import os
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, cpu_count
 from struct import pack, unpack
 import xml.etree.ElementTree as et
 import hashlib
@@ -215,55 +217,37 @@ class QCSparse:
 gsbox = lambda offset: int.from_bytes(sbox[offset:offset + 4], 'little')
 
 
+# gsbox(x * 8 + k) for every byte x, so the rounds below are plain table lookups
+T0, T1, T2, T3 = [tuple(gsbox(x * 8 + k) for x in range(256)) for k in range(4)]
+
+
 def key_update(iv1, asbox):
     d = iv1[0] ^ asbox[0]  # 9EE3B5B1
     a = iv1[1] ^ asbox[1]
     b = iv1[2] ^ asbox[2]  # ABD51D58
     c = iv1[3] ^ asbox[3]  # AFCBAFFF
-    e = gsbox(((b >> 0x10) & 0xff) * 8 + 2) ^ gsbox(((a >> 8) & 0xff) * 8 + 3) ^ gsbox((c >> 0x18) * 8 + 1) ^ \
-        gsbox((d & 0xff) * 8) ^ asbox[4]  # 35C2A10B
-
-    h = gsbox(((c >> 0x10) & 0xff) * 8 + 2) ^ gsbox(((b >> 8) & 0xff) * 8 + 3) ^ gsbox((d >> 0x18) * 8 + 1) ^ \
-        gsbox((a & 0xff) * 8) ^ asbox[5]  # 75CF3118
-    i = gsbox(((d >> 0x10) & 0xff) * 8 + 2) ^ gsbox(((c >> 8) & 0xff) * 8 + 3) ^ gsbox((a >> 0x18) * 8 + 1) ^ \
-        gsbox((b & 0xff) * 8) ^ asbox[6]  # 6AD3F5C4
-    a = gsbox(((d >> 8) & 0xff) * 8 + 3) ^ gsbox(((a >> 0x10) & 0xff) * 8 + 2) ^ gsbox((b >> 0x18) * 8 + 1) ^ \
-        gsbox((c & 0xff) * 8) ^ asbox[7]  # D99AC8FB
+    e = T2[(b >> 0x10) & 0xff] ^ T3[(a >> 8) & 0xff] ^ T1[c >> 0x18] ^ T0[d & 0xff] ^ asbox[4]  # 35C2A10B
+    h = T2[(c >> 0x10) & 0xff] ^ T3[(b >> 8) & 0xff] ^ T1[d >> 0x18] ^ T0[a & 0xff] ^ asbox[5]  # 75CF3118
+    i = T2[(d >> 0x10) & 0xff] ^ T3[(c >> 8) & 0xff] ^ T1[a >> 0x18] ^ T0[b & 0xff] ^ asbox[6]  # 6AD3F5C4
+    a = T3[(d >> 8) & 0xff] ^ T2[(a >> 0x10) & 0xff] ^ T1[b >> 0x18] ^ T0[c & 0xff] ^ asbox[7]  # D99AC8FB
 
     g = 8
 
     for _ in range(asbox[0x3c] - 2):
-        d = e >> 0x18  # 35
-        m = h >> 0x10  # cf
-        s = h >> 0x18
-        z = e >> 0x10
-        l = i >> 0x18
-        t = e >> 8
-        e = gsbox(((i >> 0x10) & 0xff) * 8 + 2) ^ gsbox(((h >> 8) & 0xff) * 8 + 3) ^ \
-            gsbox((a >> 0x18) * 8 + 1) ^ gsbox((e & 0xff) * 8) ^ asbox[g]  # B67F2106, 82508918
-        h = gsbox(((a >> 0x10) & 0xff) * 8 + 2) ^ gsbox(((i >> 8) & 0xff) * 8 + 3) ^ \
-            gsbox(d * 8 + 1) ^ gsbox((h & 0xff) * 8) ^ asbox[g + 1]  # 85813F52
-        i = gsbox((z & 0xff) * 8 + 2) ^ gsbox(((a >> 8) & 0xff) * 8 + 3) ^ \
-            gsbox(s * 8 + 1) ^ gsbox((i & 0xff) * 8) ^ asbox[g + 2]  # C8022573
-        a = gsbox((t & 0xff) * 8 + 3) ^ gsbox((m & 0xff) * 8 + 2) ^ \
-            gsbox(l * 8 + 1) ^ gsbox((a & 0xff) * 8) ^ asbox[g + 3]  # AD34EC55
+        e, h, i, a = (
+            T2[(i >> 0x10) & 0xff] ^ T3[(h >> 8) & 0xff] ^ T1[a >> 0x18] ^ T0[e & 0xff] ^ asbox[g],
+            T2[(a >> 0x10) & 0xff] ^ T3[(i >> 8) & 0xff] ^ T1[e >> 0x18] ^ T0[h & 0xff] ^ asbox[g + 1],
+            T2[(e >> 0x10) & 0xff] ^ T3[(a >> 8) & 0xff] ^ T1[h >> 0x18] ^ T0[i & 0xff] ^ asbox[g + 2],
+            T3[(e >> 8) & 0xff] ^ T2[(h >> 0x10) & 0xff] ^ T1[i >> 0x18] ^ T0[a & 0xff] ^ asbox[g + 3])
         g = g + 4
-    # a=6DB8AA0E
-    # b=ABD51D58
-    # c=AFCBAFFF
-    # d=51
-    # e=AC402324
-    # h=B2D24440
-    # i=CC2ADF24
-    # t=510805
-    return [(gsbox(((i >> 0x10) & 0xff) * 8) & 0xff0000) ^ (gsbox(((h >> 8) & 0xff) * 8 + 1) & 0xff00) ^
-            (gsbox((a >> 0x18) * 8 + 3) & 0xff000000) ^ gsbox((e & 0xff) * 8 + 2) & 0xFF ^ asbox[g],
-            (gsbox(((a >> 0x10) & 0xff) * 8) & 0xff0000) ^ (gsbox(((i >> 8) & 0xff) * 8 + 1) & 0xff00) ^
-            (gsbox((e >> 0x18) * 8 + 3) & 0xff000000) ^ (gsbox((h & 0xff) * 8 + 2) & 0xFF) ^ asbox[g + 3],
-            (gsbox(((e >> 0x10) & 0xff) * 8) & 0xff0000) ^ (gsbox(((a >> 8) & 0xff) * 8 + 1) & 0xff00) ^
-            (gsbox((h >> 0x18) * 8 + 3) & 0xff000000) ^ (gsbox((i & 0xff) * 8 + 2) & 0xFF) ^ asbox[g + 2],
-            (gsbox(((h >> 0x10) & 0xff) * 8) & 0xff0000) ^ (gsbox(((e >> 8) & 0xff) * 8 + 1) & 0xff00) ^
-            (gsbox((i >> 0x18) * 8 + 3) & 0xff000000) ^ (gsbox((a & 0xff) * 8 + 2) & 0xFF) ^ asbox[g + 1]]
+    return [(T0[(i >> 0x10) & 0xff] & 0xff0000) ^ (T1[(h >> 8) & 0xff] & 0xff00) ^
+            (T3[a >> 0x18] & 0xff000000) ^ (T2[e & 0xff] & 0xFF) ^ asbox[g],
+            (T0[(a >> 0x10) & 0xff] & 0xff0000) ^ (T1[(i >> 8) & 0xff] & 0xff00) ^
+            (T3[e >> 0x18] & 0xff000000) ^ (T2[h & 0xff] & 0xFF) ^ asbox[g + 3],
+            (T0[(e >> 0x10) & 0xff] & 0xff0000) ^ (T1[(a >> 8) & 0xff] & 0xff00) ^
+            (T3[h >> 0x18] & 0xff000000) ^ (T2[i & 0xff] & 0xFF) ^ asbox[g + 2],
+            (T0[(h >> 0x10) & 0xff] & 0xff0000) ^ (T1[(e >> 8) & 0xff] & 0xff00) ^
+            (T3[i >> 0x18] & 0xff000000) ^ (T2[a & 0xff] & 0xFF) ^ asbox[g + 1]]
 
 
 def key_custom(inp, rkey, outlength=0, encrypt=False):
@@ -335,18 +319,60 @@ def extractxml(filename, key):
         return outp[:xmllength].decode('utf-8')
 
 
+# Data is encrypted and decrypted in windows of this size
+CRYPT_WINDOW = 0x400000
+
+
+def decrypt_window(task):
+    """
+    Decrypt length bytes at offset of filename, where the encrypted item begins at start.
+    Each 16 byte block's keystream only depends on the previous ciphertext block (the key for
+    the first one), so any window can be decrypted on its own, in another process.
+    """
+    filename, start, offset, length, rkey, asbox = task
+    with open(filename, 'rb') as rf:
+        if offset > start:
+            rf.seek(offset - 0x10)
+            rkey = unpack("<4I", rf.read(0x10))
+        else:
+            rf.seek(offset)
+        data = rf.read(length)
+    # The last block is zero padded, exactly as key_custom does
+    data += b"\x00" * (-len(data) % 0x10)
+    words = unpack(f"<{len(data) // 4}I", data)
+    stream = []
+    for pos in range(0, len(words), 4):
+        rkey = key_update(rkey, asbox)
+        stream.extend(rkey)
+        rkey = words[pos:pos + 4]
+    stream = int.from_bytes(pack(f"<{len(stream)}I", *stream), 'little')
+    return (int.from_bytes(data, 'little') ^ stream).to_bytes(len(data), 'little')[:length]
+
+
 def decryptfile(rkey, filename, path, wfilename, start, length):
     sha256 = hashlib.sha256()
     print(f"Extracting {wfilename}")
-    with mmap_io(filename, 'rb') as rf:
-        rf.seek(start)
-        data = rf.read(length)
-        if length % 4:
-            data += (4 - (length % 4)) * b'\x00'
-        outp = key_custom(data, rkey, 0)
-        sha256.update(outp[:length])
-        with mmap_io(os.path.join(path, wfilename), 'wb', length) as wf:
-            wf.write(outp[:length])
+    if length < 0x10:
+        # Too short for the block mode, key_custom handles it with the sbox
+        with open(filename, 'rb') as rf:
+            rf.seek(start)
+            data = rf.read(length)
+        data += (-length % 4) * b'\x00'
+        windows = [bytes(key_custom(data, rkey, 0)[:length])]
+        pool = None
+    else:
+        tasks = [(filename, start, offset, min(CRYPT_WINDOW, start + length - offset), tuple(rkey), tuple(mbox))
+                 for offset in range(start, start + length, CRYPT_WINDOW)]
+        pool = Pool(min(cpu_count(), len(tasks))) if len(tasks) > 1 else None
+        windows = pool.imap(decrypt_window, tasks) if pool else map(decrypt_window, tasks)
+    try:
+        with open(os.path.join(path, wfilename), 'wb') as wf:
+            for outp in windows:
+                sha256.update(outp)
+                wf.write(outp)
+    finally:
+        if pool:
+            pool.terminate()
     if length % 0x1000 > 0:
         sha256.update(b"\x00" * (0x1000 - (length % 0x1000)))
     return sha256.hexdigest()
@@ -362,33 +388,60 @@ def encryptsubsub(rkey, data, wf):
 
 
 def encryptsub(rkey, rf, wf):
-    return encryptsubsub(rkey, rf.read(), wf)
+    """
+    Encrypt rf to its end into wf, CRYPT_WINDOW at a time, carrying the chain from one window
+    to the next so the output is identical to a single key_custom call. Returns bytes written.
+    """
+    data = rf.read(CRYPT_WINDOW)
+    if len(data) < 0x10:
+        # Too short for the block mode, key_custom handles it with the sbox
+        return encryptsubsub(rkey, data, wf)
+    rkey = tuple(rkey)
+    total = 0
+    while data:
+        length = len(data)
+        data += b"\x00" * (-length % 0x10)
+        words = unpack(f"<{len(data) // 4}I", data)
+        outp = []
+        for pos in range(0, len(words), 4):
+            k = key_update(rkey, mbox)
+            rkey = (words[pos] ^ k[0], words[pos + 1] ^ k[1], words[pos + 2] ^ k[2], words[pos + 3] ^ k[3])
+            outp.extend(rkey)
+        wf.write(pack(f"<{len(outp)}I", *outp)[:length])
+        total += length
+        data = rf.read(CRYPT_WINDOW)
+    return total
 
 
 def encryptfile(key, filename, wfilename):
     print(f"Encrypting {filename}")
-    with mmap_io(filename, 'rb') as rf:
-        filesize = os.stat(filename).st_size
-        with mmap_io(wfilename, 'wb', filesize) as wf:
+    with open(filename, 'rb') as rf:
+        with open(wfilename, 'wb') as wf:
             return encryptsub(key, rf, wf)
 
 
 def calc_digest(filename):
-    with mmap_io(filename, 'rb') as rf:
-        data = rf.read()
-        sha256 = hashlib.sha256()
-        sha256.update(data)
-        if len(data) % 0x1000 > 0:
-            sha256.update(b"\x00" * (0x1000 - (len(data) % 0x1000)))
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(filename, 'rb') as rf:
+        while data := rf.read(0x100000):
+            sha256.update(data)
+            size += len(data)
+    if size % 0x1000 > 0:
+        sha256.update(b"\x00" * (0x1000 - (size % 0x1000)))
     return sha256.hexdigest()
 
 
-def copysub(rf, wf, start, length):
+def copysub(rf, wf, start, length, sha256=None):
     rf.seek(start)
     rlen = 0
     while length > 0:
         size = length if length < 0x100000 else 0x100000
         data = rf.read(size)
+        if not data:
+            break
+        if sha256 is not None:
+            sha256.update(data)
         wf.write(data)
         rlen += len(data)
         length -= size
@@ -396,63 +449,63 @@ def copysub(rf, wf, start, length):
 
 
 def copyfile(filename, path, wfilename, start, length):
+    """Copy an item out of the package, returning its sha256 (padded as calc_digest does)"""
     print(f"Extracting {wfilename}")
-    with mmap_io(filename, 'rb') as rf:
-        with mmap_io(os.path.join(path, wfilename), 'wb', length) as wf:
-            return copysub(rf, wf, start, length)
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as rf:
+        with open(os.path.join(path, wfilename), 'wb') as wf:
+            rlen = copysub(rf, wf, start, length, sha256)
+    if rlen % 0x1000 > 0:
+        sha256.update(b"\x00" * (0x1000 - (rlen % 0x1000)))
+    return sha256.hexdigest()
 
 
-def encryptitem(key, item, directory, pos, wf):
+def planitem(item, directory, pos):
+    """
+    Record where item goes in the package, starting at pos. Returns its file (None if it has
+    none) and the position following it, so every item's place is known before any is written.
+    """
     try:
         filename = item.attrib["Path"]
     except:
         filename = item.attrib["filename"]
-    if filename == "":
-        return item, pos
+    if not filename:
+        return None, pos
     filename = os.path.join(directory, filename)
     start = pos // 0x200
     item.attrib["FileOffsetInSrc"] = str(start)
+
     size = os.stat(filename).st_size
     item.attrib["SizeInByteInSrc"] = str(size)
     sectors = size // 0x200
     if (size % 0x200) != 0:
         sectors += 1
     item.attrib["SizeInSectorInSrc"] = str(sectors)
-    with mmap_io(filename, 'rb') as rf:
-        rlen = encryptsub(key, rf, wf)
-        pos += rlen
-        if (rlen % 0x200) != 0:
-            sublen = 0x200 - (rlen % 0x200)
-            wf.write(b'\x00' * sublen)
-            pos += sublen
-    return item, pos
+    return filename, pos + sectors * 0x200
 
 
-def copyitem(item, directory, pos, wf):
-    try:
-        filename = item.attrib["Path"]
-    except:
-        filename = item.attrib["filename"]
-    if not filename:
-        return item, pos
-    filename = os.path.join(directory, filename)
-    start = pos // 0x200
-    item.attrib["FileOffsetInSrc"] = str(start)
+def encryptitem(key, filename, outfilename, pos):
+    with open(filename, 'rb') as rf, open(outfilename, 'r+b') as wf:
+        wf.seek(pos)
+        return encryptsub(key, rf, wf)
 
-    size = os.stat(filename).st_size
-    item.attrib["SizeInByteInSrc"] = str(size)
-    sectors = size // 0x200
-    if (size % 0x200) != 0:
-        sectors += 1
-    item.attrib["SizeInSectorInSrc"] = str(sectors)
-    with mmap_io(filename, 'rb') as rf:
-        rlen = copysub(rf, wf, 0, size)
-        pos += rlen
-        if (rlen % 0x200) != 0:
-            sublen = 0x200 - (rlen % 0x200)
-            wf.write(b'\x00' * sublen)
-            pos += sublen
-    return item, pos
+
+def copyitem(filename, outfilename, pos):
+    with open(filename, 'rb') as rf, open(outfilename, 'r+b') as wf:
+        size = os.fstat(rf.fileno()).st_size
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    count = os.copy_file_range(rf.fileno(), wf.fileno(), size - copied, copied, pos + copied)
+                    if not count:
+                        break
+                    copied += count
+            except OSError:
+                # Unsupported across these filesystems, fall back to copying the rest
+                pass
+        wf.seek(pos + copied)
+        return copied + copysub(rf, wf, copied, size - copied)
 
 
 def main(args):
@@ -522,8 +575,7 @@ def main(args):
                         # slength = int(item.attrib["SizeInSectorInSrc"]) * 0x200
                         length = int(item.attrib["SizeInByteInSrc"])
                         sha256 = item.attrib["Sha256"]
-                        copyfile(filename, path, wfilename, start, length)
-                        csha256 = calc_digest(os.path.join(path, wfilename))
+                        csha256 = copyfile(filename, path, wfilename, start, length)
                         if sha256 != csha256 and not sparse:
                             print("Sha256 fail.")
                     else:
@@ -537,8 +589,7 @@ def main(args):
                                 # slength = int(subitem.attrib["SizeInSectorInSrc"]) * 0x200
                                 length = int(subitem.attrib["SizeInByteInSrc"])
                                 sha256 = subitem.attrib["Sha256"]
-                                copyfile(filename, path, wfilename, start, length)
-                                csha256 = calc_digest(os.path.join(path, wfilename))
+                                csha256 = copyfile(filename, path, wfilename, start, length)
                                 if sha256 != csha256 and not sparse:
                                     print("Sha256 fail.")
             # else:
@@ -562,29 +613,43 @@ def main(args):
         firmware = None
         if os.path.exists(outfilename):
             os.remove(outfilename)
+        # Every item's place follows from the file sizes, so they can all be written concurrently
+        jobs = []
+        pos = 0
+        for child in root:
+            if child.tag == "BasicInfo":
+                if "Project" in child.attrib:
+                    projid = child.attrib["Project"]
+                if "Version" in child.attrib:
+                    firmware = child.attrib["Version"]
+            if child.tag == "SAHARA":
+                for item in child:
+                    if item.tag == "File":
+                        itemfile, nextpos = planitem(item, directory, pos)
+                        if itemfile:
+                            jobs.append((encryptitem, key, itemfile, outfilename, pos))
+                        pos = nextpos
+            elif child.tag == "UFS_PROVISION":
+                for item in child:
+                    if item.tag == "File":
+                        itemfile, nextpos = planitem(item, directory, pos)
+                        if itemfile:
+                            jobs.append((copyitem, itemfile, outfilename, pos))
+                        pos = nextpos
+            elif "Program" in child.tag:
+                for item in child:
+                    for subitem in [item] if "filename" in item.attrib else item:
+                        itemfile, nextpos = planitem(subitem, directory, pos)
+                        if itemfile:
+                            jobs.append((copyitem, itemfile, outfilename, pos))
+                        pos = nextpos
         with open(outfilename, 'wb') as wf:
-            pos = 0
-            for child in root:
-                if child.tag == "BasicInfo":
-                    if "Project" in child.attrib:
-                        projid = child.attrib["Project"]
-                    if "Version" in child.attrib:
-                        firmware = child.attrib["Version"]
-                if child.tag == "SAHARA":
-                    for item in child:
-                        if item.tag == "File":
-                            item, pos = encryptitem(key, item, directory, pos, wf)
-                elif child.tag == "UFS_PROVISION":
-                    for item in child:
-                        if item.tag == "File":
-                            item, pos = copyitem(item, directory, pos, wf)
-                elif "Program" in child.tag:
-                    for item in child:
-                        if "filename" in item.attrib:
-                            item, pos = copyitem(item, directory, pos, wf)
-                        else:
-                            for subitem in item:
-                                subitem, pos = copyitem(subitem, directory, pos, wf)
+            wf.truncate(pos)
+        with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+            for future in [executor.submit(*job) for job in jobs]:
+                future.result()
+        with open(outfilename, 'r+b') as wf:
+            wf.seek(pos)
             try:
                 configpos = pos // 0x200
                 with open(settings, 'rb') as rf:
@@ -621,10 +686,12 @@ def main(args):
                 hdr += bytes(firmware, 'utf-8')
                 hdr += b"\x00" * (0x200 - len(hdr))
                 wf.write(hdr)
+                wf.flush()
                 with open(outfilename, 'rb') as rt:
                     with open("md5sum_pack.md5", 'wb') as wt:
                         mt = hashlib.md5()
-                        mt.update(rt.read())
+                        while data := rt.read(0x100000):
+                            mt.update(data)
                         wt.write(bytes(mt.hexdigest(), 'utf-8') + b" " + bytes(os.path.basename(outfilename), 'utf-8'))
                 print("Done. Created " + outfilename)
             except Exception as e:
@@ -14,9 +14,50 @@ import os
 import shutil
 import stat
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 
 from Crypto.Cipher import AES
 
+# Encrypted data is read, decrypted and written in windows of about this size
+WINDOW = 0x400000
+
+
+def decryptwindow(key, rfilename, wfilename, offset, size, outpos, outsize, stride):
+    """
+    Decrypts size bytes at offset of rfilename into outpos of wfilename, keeping outsize bytes.
+    The data is a run of units of stride bytes that each start with one AES-ECB block, the heads
+    of the whole window are decrypted with a single call.
+    """
+    with open(rfilename, 'rb') as rr:
+        rr.seek(offset)
+        data = bytearray(rr.read(size))
+    ctx = AES.new(key, AES.MODE_ECB)
+    full = len(data) - len(data) % 16
+    if stride == 16:
+        data[:full] = ctx.decrypt(bytes(data[:full]))
+    else:
+        # A trailing head shorter than a block cannot be decrypted and is kept as is
+        starts = [pos for pos in range(0, len(data), stride) if pos + 16 <= len(data)]
+        heads = ctx.decrypt(b"".join(data[pos:pos + 16] for pos in starts))
+        for i, pos in enumerate(starts):
+            data[pos:pos + 16] = heads[i * 16:i * 16 + 16]
+    with open(wfilename, 'r+b') as wf:
+        wf.seek(outpos)
+        wf.write(data[:outsize])
+
+
+def decryptwindows(key, rfilename, wfilename, windows, outlength):
+    """
+    Creates wfilename with outlength bytes and fills it from windows, a list of
+    (offset, size, outpos, outsize, stride) as taken by decryptwindow, in parallel.
+    """
+    with open(wfilename, 'wb') as wf:
+        wf.truncate(outlength)
+    with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+        for future in [executor.submit(decryptwindow, key, rfilename, wfilename, *window) for window in windows]:
+            future.result()
+
 
 def main(file_arg):
     keys = [
@@ -80,30 +121,25 @@ def main(file_arg):
                 shutil.rmtree(path, onerror=lambda _, fn, __: del_rw(fn))
 
     def decryptfile(key, rfilename):
-        with open(rfilename, 'rb') as rr, open(rfilename + ".tmp", 'wb') as wf:
+        # Whole file is ECB encrypted, with the plain size in the header
+        with open(rfilename, 'rb') as rr:
             rr.seek(0x10)
             dsize = int(rr.read(0x10).replace(b"\x00", b"").decode('utf-8'), 10)
-            rr.seek(0x1050)
-            flen = os.stat(rfilename).st_size - 0x1050
-
-            ctx = AES.new(key, AES.MODE_ECB)
-            while dsize > 0:
-                size = 0x4000 if flen > 0x4000 else flen
-                data = rr.read(size)
-                if dsize < size:
-                    size = dsize
-                if not len(data):
-                    break
-                dr = ctx.decrypt(data)
-                wf.write(dr[:size])
-                flen -= size
-                dsize -= size
+        flen = os.stat(rfilename).st_size - 0x1050
+        size = min((dsize + 0xF) // 0x10 * 0x10, flen)
+        outlength = min(dsize, size)
+        windows = [(0x1050 + pos, min(WINDOW, size - pos), pos, max(min(WINDOW, outlength - pos), 0), 0x10)
+                   for pos in range(0, size, WINDOW)]
+        decryptwindows(key, rfilename, rfilename + ".tmp", windows, outlength)
         os.remove(rfilename)
         os.rename(rfilename + ".tmp", rfilename)
 
     def decryptfile2(key, rfilename, wfilename):
-        with open(rfilename, 'rb') as rr, open(wfilename, 'wb') as wf:
-            ctx = AES.new(key, AES.MODE_ECB)
+        # Blocks of 0x40000 bytes behind a 0x50 byte header, each 0x4000 bytes start with an ECB block
+        windows = []
+        outpos = 0
+        filesize = os.stat(rfilename).st_size
+        with open(rfilename, 'rb') as rr:
             bstart = 0
             goon = True
             while goon:
@@ -117,20 +153,11 @@ def main(file_arg):
                 bdsize = int(rr.read(0x10).replace(b"\x00", b"").decode('utf-8'), 10)
                 if bdsize < 0x40000:
                     goon = False
-                rr.seek(0x50 + bstart)
-                while bdsize > 0:
-                    data = rr.read(0x10)
-                    if not len(data):
-                        break
-                    size = bdsize if bdsize < 0x10 else 0x10
-                    wf.write(ctx.decrypt(data)[:size])
-                    bdsize -= 0x10
-                    data = rr.read(0x3FF0)
-                    if not len(data):
-                        break
-                    bdsize -= 0x3FF0
-                    wf.write(data)
+                size = min((bdsize + 0xF) // 0x10 * 0x10, max(filesize - bstart - 0x50, 0))
+                windows.append((bstart + 0x50, size, outpos, min(bdsize, size), 0x4000))
+                outpos += min(bdsize, size)
                 bstart = bstart + 0x40000 + 0x50
+        decryptwindows(key, rfilename, wfilename, windows, outpos)
         return 0
 
     def mode2(filename):
@@ -202,20 +229,14 @@ def main(file_arg):
             if key == -1:
                 print("Unknown AES key, reverse key from recovery first!")
                 return 1
-            ctx = AES.new(key, AES.MODE_ECB)
             filename = file_arg[:-4] + "zip"
-            with open(filename, 'wb') as wf:
-                fr.seek(0x1050)
-                print("Decrypting...")
-                while True:
-                    data = fr.read(16)
-                    if not len(data):
-                        break
-                    wf.write(ctx.decrypt(data))
-                    data = fr.read(0x4000)
-                    if not len(data):
-                        break
-                    wf.write(data)
+            print("Decrypting...")
+            # Units of one ECB block followed by 0x4000 plain bytes, windows hold whole units
+            size = os.stat(file_arg).st_size - 0x1050
+            window = WINDOW // 0x4010 * 0x4010
+            decryptwindows(key, file_arg, filename,
+                           [(0x1050 + pos, min(window, size - pos), pos, min(window, size - pos), 0x4010)
+                            for pos in range(0, size, window)], size)
             print("DONE!!")
             return 0
         elif magic[:2] == b"PK":
@@ -1,6 +1,24 @@
 import os
 import logging
 
+# Sector sizes a GPT header is looked for at, eMMC first, then UFS
+SECTOR_SIZES = (512, 4096)
+# Ranges are read in pieces of this size instead of one LBA per read
+READ_SIZE = 4 * 1024 * 1024
+
+
+def detect_sector_size(filename, default=512):
+    """
+    Return the sector size whose LBA 1 holds a GPT header signature, or default if none does
+    """
+    with open(filename, 'rb') as f:
+        for sector_size in SECTOR_SIZES:
+            f.seek(sector_size)
+            if f.read(8) == b'EFI PART':
+                return sector_size
+    return default
+
+
 class GPTFile(object):
     """
     Simple wrapper to abstract accessing blocks of a file using LBA
@@ -54,8 +72,25 @@ class GPTFile(object):
         return data
 
     def blocks_in_range(self, lba_start, nr_blocks):
-        for i in range(0, nr_blocks):
-            yield self.read_blocks(lba_start + i, 1)
+        for data, _ in self.chunks_in_range(lba_start, nr_blocks):
+            for i in range(0, len(data), self._blocksz):
+                yield data[i:i + self._blocksz]
+
+    def chunks_in_range(self, lba_start, nr_blocks, chunk_size=READ_SIZE):
+        """
+        Read a range of LBAs in chunks of whole blocks, yielding (data, offset in the range) pairs
+        """
+        step = max(chunk_size // self._blocksz, 1)
+        for i in range(0, nr_blocks, step):
+            yield self.read_blocks(lba_start + i, min(step, nr_blocks - i)), i * self._blocksz
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def total_blocks(self):
+        return self._total_blocks
 
     @property
     def sector_size(self):
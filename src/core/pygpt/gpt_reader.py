@@ -1,12 +1,50 @@
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 
-from src.core.pygpt.gpt_file import GPTFile
+from src.core.pygpt.gpt_file import GPTFile, READ_SIZE, detect_sector_size
 from src.core.pygpt.partition_table_header import PartitionTableHeader
 
+# Runs of zeros at least this long are left as holes in the dumped partitions
+HOLE_SIZE = 1024 * 1024
+
+
+def dump_partition(filename, first_byte, length, out_file):
+    """
+    Copy length bytes at first_byte of the image to out_file with large sequential reads.
+
+    All-zero pieces are skipped with a seek, so the output is sparse where the filesystem allows.
+    Returns the number of bytes the image actually held.
+    """
+    copied = 0
+    with open(filename, 'rb') as fin, open(out_file, 'wb') as fout:
+        fin.seek(first_byte)
+        while copied < length:
+            data = fin.read(min(READ_SIZE, length - copied))
+            if not data:
+                break
+            view = memoryview(data)
+            for i in range(0, len(data), HOLE_SIZE):
+                end = min(i + HOLE_SIZE, len(data))
+                if data.count(0, i, end) == end - i:
+                    fout.seek(end - i, os.SEEK_CUR)
+                else:
+                    fout.write(view[i:end])
+            copied += len(data)
+        fout.truncate(copied)
+    return copied
+
 
 class GPTReader(object):
-    def __init__(self, filename, sector_size=512, little_endian=True):
+    def __init__(self, filename, sector_size=None, little_endian=True):
+        """
+        Without a sector_size, 512 (eMMC) and 4096 (UFS) byte sectors are probed for the header
+        """
+        if sector_size is None:
+            sector_size = detect_sector_size(filename)
         self._filename = filename
+        self.skipped = []
         self._sector_size = sector_size
         self._file = GPTFile(filename, sector_size)
         self._pth = PartitionTableHeader(self._file, little_endian)
@@ -19,6 +57,44 @@ class GPTReader(object):
     def block_reader(self):
         return self._file
 
+    @property
+    def sector_size(self):
+        return self._sector_size
+
+    def dump(self, output_dir, suffix='.img', workers=None):
+        """
+        Write every valid partition to output_dir, returning {partition name: output file}.
+
+        Partitions are read in on-disk order, each one sequentially, several at once.
+        Partitions sharing a name keep the last one, as the per-block dump used to.
+        Partitions the image does not contain (e.g. a primary GPT dump alone) are not written,
+        their names are left in self.skipped.
+        """
+        image_size = os.path.getsize(self._filename)
+        self.skipped = []
+        jobs = {}
+        for partition in self._pth.valid_entries():
+            name = partition.name if partition.name else str(partition.partition_id)
+            jobs[name] = partition
+        outputs = {}
+        with ThreadPoolExecutor(max_workers=workers or min(cpu_count(), 4)) as executor:
+            futures = []
+            for name, partition in sorted(jobs.items(), key=lambda item: item[1].first_block):
+                if partition.first_block * self._sector_size >= image_size:
+                    logging.warning('{}: not contained in the image, skipped'.format(name))
+                    self.skipped.append(name)
+                    continue
+                out_file = os.path.join(output_dir, f'{name}{suffix}')
+                length = partition.length * self._sector_size
+                futures.append((name, out_file, length, executor.submit(
+                    dump_partition, self._filename, partition.first_block * self._sector_size, length, out_file)))
+            for name, out_file, length, future in futures:
+                copied = future.result()
+                if copied != length:
+                    logging.warning('{}: image ends {} bytes early'.format(name, length - copied))
+                outputs[name] = out_file
+        return outputs
+
 def _setup_logging(verbose):
     """
     Set logging verbosity, 
@@ -34,7 +110,7 @@ def main():
 
     parser = argparse.ArgumentParser(description='Test reading a GPT file image')
     parser.add_argument('-v', '--verbose', help='verbose output', action='store_true')
-    parser.add_argument('-S', '--sector-size', help='Sector size (in bytes) for LBA', type=int, default=512)
+    parser.add_argument('-S', '--sector-size', help='Sector size (in bytes) for LBA, probed when omitted', type=int, default=None)
     parser.add_argument('-O', '--output-dir', help='Output directory to write each partition to', type=str, default='')
     parser.add_argument('-b', '--burst', help='Break the partitions out into individual files', action='store_true')
     parser.add_argument('image', help='The image to analyze the GPT from')
@@ -53,17 +129,9 @@ def main():
         print('guid/type={} first-block={} size={} name={}'.format(
             partition.partition_type, partition.first_block, partition.length, partition.name))
 
-        if args.burst:
-            file_base_name = partition.name
-            if '' == file_base_name:
-                file_base_name = str(partition.partition_id)
-
-            out_file = os.path.join(args.output_dir, '{}.bin'.format(partition.name))
-            logging.debug('Writing partition to file {}'.format(out_file))
-
-            with open(out_file, 'wb+') as fout:
-                for block in reader.block_reader.blocks_in_range(partition.first_block, partition.length):
-                    fout.write(block)
+    if args.burst:
+        for name, out_file in reader.dump(args.output_dir, '.bin').items():
+            logging.debug('Wrote partition {} to file {}'.format(name, out_file))
 
 if __name__ == '__main__':
     main()
@@ -13,6 +13,22 @@ PARTITION_TABLE_DEFAULT_LENGTH = 92
 
 PARTITION_TABLE_DEFAULT_PARTITION_ENTRY_SIZE = 128
 
+class GPTCopy(object):
+    """
+    One parsed copy (primary or backup) of the partition table header and its entry array
+    """
+    def __init__(self, label, raw_hdr, raw_entries, entries_ok):
+        self.label = label
+        (self.current_lba, self.backup_lba, self.first_usable, self.last_usable, uuid_raw, self.partition_start,
+         self.nr_part_entries, self.part_entry_sz, self.part_entries_crc) = struct.unpack('<QQQQ16sQLLL', raw_hdr[24:92])
+        self.disk_uuid = uuid.UUID(bytes=uuid_raw)
+        self.raw_entries = raw_entries
+        self.entries_ok = entries_ok
+
+    def entries(self):
+        return [self.raw_entries[i:i + self.part_entry_sz] for i in range(0, len(self.raw_entries), self.part_entry_sz)]
+
+
 class PartitionTableHeader(object):
     """
     Class that represents a partition table header and the associated partition entry array
@@ -27,6 +43,8 @@ class PartitionTableHeader(object):
         self._gptfile = gptfile
         self._backup_pth = False
         self._partitions = []
+        # CRC failures and primary/backup disagreements, as readable messages
+        self.problems = []
         self._load_pth()
 
     def valid_entries(self):
@@ -35,21 +53,32 @@ class PartitionTableHeader(object):
                 continue
             yield partition
 
+    @property
+    def is_backup(self):
+        return self._backup_pth
+
     def _append_partition_entry(self, raw_entry):
         new_partition = PartitionTableEntry(raw_entry)
         logging.debug('Part: {}'.format(new_partition))
         self._partitions.append(new_partition)
 
-    def _parse_pth(self, pth_raw):
+    def _problem(self, message):
+        logging.warning(message)
+        self.problems.append(message)
+
+    def _parse_pth(self, pth_raw, label):
         magic, revision, hdr_sz, hdr_crc32 = struct.unpack('<8sLLL', pth_raw[0:20])
         logging.debug('Magic: {} revision: {} length: 0x{} bytes, crc32: {:08x}'.format(magic, revision, hdr_sz, hdr_crc32))
 
         if magic != b'EFI PART':
             logging.debug('This is not an EFI partition, aborting')
-            return False
+            return None
 
         if hdr_sz != PARTITION_TABLE_DEFAULT_LENGTH:
             logging.warning('EFI partition is {} bytes long, normally expecting {}, proceed with caution'.format(hdr_sz, PARTITION_TABLE_DEFAULT_LENGTH))
+        if not PARTITION_TABLE_DEFAULT_LENGTH <= hdr_sz <= len(pth_raw):
+            self._problem('{} GPT header size {} is out of range'.format(label, hdr_sz))
+            return None
 
         # Check the CRC32 of the header, first zeroing out the crc32 value
         raw_hdr = bytearray(pth_raw[0:hdr_sz])
@@ -61,56 +90,96 @@ class PartitionTableHeader(object):
         hdr_crc32_calc = zlib.crc32(raw_hdr)
 
         if hdr_crc32_calc != hdr_crc32:
-            logging.debug('Header CRC calculation mismatch, skipping this header')
-            return False
+            self._problem('{} GPT header CRC mismatch (stored {:08x}, calculated {:08x})'.format(label, hdr_crc32, hdr_crc32_calc))
+            return None
 
         # Get the current LBA as a sanity check
-        current_lba, backup_lba, first_lba, last_lba, uuid_raw, partition_start, self._nr_part_entries, self._part_entry_sz, part_entries_crc = struct.unpack('<QQQQ16sQLLL', raw_hdr[24:])
-        self._disk_uuid = uuid.UUID(bytes=uuid_raw)
+        current_lba, backup_lba, first_lba, last_lba, uuid_raw, partition_start, nr_part_entries, part_entry_sz, part_entries_crc = struct.unpack('<QQQQ16sQLLL', raw_hdr[24:92])
         logging.debug('Current: {} Backup: {} First Usable: {} Last Usable: {} UUID: {}'.format(
-            current_lba, backup_lba, first_lba, last_lba, self._disk_uuid))
+            current_lba, backup_lba, first_lba, last_lba, uuid.UUID(bytes=uuid_raw)))
         logging.debug('  Partition LBA Start: {} Number of Entries: {} Size of an entry: {} crc32 of entries {:08x}'.format(
-            partition_start, self._nr_part_entries, self._part_entry_sz, part_entries_crc))
+            partition_start, nr_part_entries, part_entry_sz, part_entries_crc))
 
-        if self._part_entry_sz != PARTITION_TABLE_DEFAULT_PARTITION_ENTRY_SIZE:
-            logging.debug('Unsupported partition entry size: {}'.format(self._part_entry_sz))
-            return False
+        if part_entry_sz != PARTITION_TABLE_DEFAULT_PARTITION_ENTRY_SIZE:
+            logging.debug('Unsupported partition entry size: {}'.format(part_entry_sz))
+            return None
 
         # Now we're ready to load the partition entries
-        nr_blocks = math.ceil((self._nr_part_entries * self._part_entry_sz)/self._gptfile.sector_size)
-        raw_partition_data = self._gptfile.read_blocks(partition_start, nr_blocks)
-
+        entries_sz = nr_part_entries * part_entry_sz
+        nr_blocks = math.ceil(entries_sz / self._gptfile.sector_size)
+        try:
+            raw_partition_data = self._gptfile.read_blocks(partition_start, nr_blocks)[:entries_sz]
+        except Exception as e:
+            self._problem('{} GPT partition entries at LBA {} cannot be read: {}'.format(label, partition_start, e))
+            return None
+
+        # The CRC covers exactly the entry array, not the padding up to the end of its last block
         part_entries_crc_calc = zlib.crc32(raw_partition_data)
-
-        if part_entries_crc_calc != part_entries_crc:
-            logging.debug('Error: partition table CRC calculation failed, aborting.')
-
-        raw_entries = [raw_partition_data[i:i + self._part_entry_sz] for i in range(0, len(raw_partition_data), self._part_entry_sz)]
-
-        for entry in raw_entries:
-            self._append_partition_entry(entry)
-
-        return True
+        entries_ok = part_entries_crc_calc == part_entries_crc
+        if not entries_ok:
+            self._problem('{} GPT partition entries CRC mismatch (stored {:08x}, calculated {:08x})'.format(
+                label, part_entries_crc, part_entries_crc_calc))
+
+        return GPTCopy(label, raw_hdr, raw_partition_data, entries_ok)
+
+    def _read_pth(self, lba, label):
+        try:
+            pth_raw = self._gptfile.read_blocks(lba, 1)
+        except Exception as e:
+            logging.debug('{} GPT header at LBA {} cannot be read: {}'.format(label, lba, e))
+            return None
+        return self._parse_pth(pth_raw, label)
+
+    def _compare(self, primary, backup):
+        """
+        Report where the backup GPT disagrees with the primary one
+        """
+        if primary.current_lba != backup.backup_lba or primary.backup_lba != backup.current_lba:
+            self._problem('Primary GPT (LBA {}, backup at {}) and backup GPT (LBA {}, primary at {}) do not point at each other'.format(
+                primary.current_lba, primary.backup_lba, backup.current_lba, backup.backup_lba))
+        for field in ('first_usable', 'last_usable', 'disk_uuid', 'nr_part_entries', 'part_entry_sz'):
+            if getattr(primary, field) != getattr(backup, field):
+                self._problem('Primary and backup GPT differ in {}: {} != {}'.format(
+                    field, getattr(primary, field), getattr(backup, field)))
+        if primary.raw_entries != backup.raw_entries:
+            for index, (a, b) in enumerate(zip(primary.entries(), backup.entries())):
+                if a != b:
+                    self._problem('Primary and backup GPT differ at entry {}: {!r} != {!r}'.format(
+                        index, PartitionTableEntry(a), PartitionTableEntry(b)))
 
     def _find_load_pth(self):
         # Start with the main PTH
-        pth_raw = self._gptfile.read_blocks(PARTITION_TABLE_HEADER_DEFAULT_BLOCK, 1)
-
-        if self._parse_pth(pth_raw):
-            return
-
-        # Try the backup PTH
-        pth_raw = self._gptfile.read_blocks(PARTITION_TABLE_HEADER_BACKUP_BLOCK, 1)
-
-        if self._parse_pth(pth_raw):
+        primary = self._read_pth(PARTITION_TABLE_HEADER_DEFAULT_BLOCK, 'Primary')
+
+        # The backup PTH is where the primary says it is, or at the last block of a resized image
+        backup = None
+        if primary is not None and primary.backup_lba < self._gptfile.total_blocks:
+            backup = self._read_pth(primary.backup_lba, 'Backup')
+        if backup is None:
+            backup = self._read_pth(PARTITION_TABLE_HEADER_BACKUP_BLOCK, 'Backup')
+
+        if primary is not None and backup is not None:
+            self._compare(primary, backup)
+        elif primary is not None:
+            self._problem('Backup GPT is missing or invalid')
+
+        # A copy with intact entries wins, a damaged primary is still better than nothing
+        if primary is not None and (primary.entries_ok or backup is None or not backup.entries_ok):
+            chosen = primary
+        elif backup is not None:
+            chosen = backup
             self._backup_pth = True
-            return
+        else:
+            raise Exception('Could not find a GPT in the given file, aborting.')
 
-        raise Exception('Could not find a GPT in the given file, aborting.')
+        self._disk_uuid = chosen.disk_uuid
+        self._nr_part_entries = chosen.nr_part_entries
+        self._part_entry_sz = chosen.part_entry_sz
+        for entry in chosen.entries():
+            self._append_partition_entry(entry)
 
     def _load_pth(self):
         """
         Load a partition table from the currently mapped GPTFile
         """
         self._find_load_pth()
-
@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from array import array
+from bisect import bisect_left, bisect_right
 from heapq import merge
-from itertools import cycle
-from typing import (List, Tuple, Union, Iterator, Optional, TypeVar,
+from itertools import compress, cycle, islice, repeat
+from operator import lt, ne, sub
+from typing import (Iterable, List, Tuple, Union, Iterator, Optional, TypeVar,
                     Type)
 
 __all__ = ["RangeSet"]
@@ -23,6 +26,15 @@ __all__ = ["RangeSet"]
 # allowing for correct type inference with subclasses.
 _RS = TypeVar('_RS', bound='RangeSet')
 
+# Sentinels bounding the complement of a set; block numbers never reach them.
+_MIN = -(1 << 63)
+_MAX = (1 << 63) - 1
+
+
+def _add(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    """Adds two cached sizes, either of which may not be known yet."""
+    return None if a is None or b is None else a + b
+
 
 class RangeSet:
     """Represents a set of non-overlapping integer ranges.
@@ -31,15 +43,19 @@ class RangeSet:
     contiguous runs. It provides methods for standard set operations like
     union, intersection, and subtraction.
 
-    Internally, the ranges are stored as a sorted tuple of integers, where each
-    pair of integers represents a half-open interval `[start, end)`.
-    For example, the tuple `(10, 20, 30, 35)` represents the integer ranges
+    Internally, the ranges are stored as a sorted `array('q')` of integers,
+    where each pair of integers represents a half-open interval `[start, end)`.
+    For example, the boundaries `10, 20, 30, 35` represent the integer ranges
     [10, 19] and [30, 34].
+
+    Set operations locate boundaries with bisect and copy whole runs of
+    boundaries as array slices, so their cost follows the number of ranges in
+    the smaller operand rather than a Python-level sweep over both.
     """
 
     def __init__(
         self,
-        data: Optional[Union[str, Tuple[int, ...], List[int]]] = None
+        data: Optional[Union[str, Tuple[int, ...], List[int], array]] = None
     ) -> None:
         """Initializes a RangeSet.
 
@@ -47,38 +63,81 @@ class RangeSet:
             data: The data to initialize the set. Can be one of:
                 - A string of space-separated numbers and ranges, e.g.,
                   "10-19 30". Ranges are inclusive.
-                - A tuple or list of integers representing pre-sorted,
+                - A tuple, list or array of integers representing pre-sorted,
                   non-overlapping `[start, end)` boundaries, e.g., `(10, 20, 30, 31)`.
                   Input is normalized, so overlapping or unsorted data like
                   `(30, 40, 10, 20)` will be handled correctly.
                 - None, to create an empty RangeSet.
         """
-        self.data: Tuple[int, ...]
+        self.data: array
         self.monotonic: bool
 
         if isinstance(data, str):
             self._parse_internal(data)
         elif data:
-            if not isinstance(data, (list, tuple)):
-                raise TypeError("Input must be a string, tuple, list, or None.")
+            if not isinstance(data, (list, tuple, array)):
+                raise TypeError("Input must be a string, tuple, list, array, or None.")
             if len(data) % 2 != 0:
                 raise ValueError(
                     "Input tuple/list must have an even number of elements.")
             # The 'monotonic' flag is only meaningful when parsing a string,
             # as it relates to the order of tokens in the text.
             self.monotonic = False
-            # Normalize the input by sorting all boundary points and then
-            # merging any overlapping or adjacent ranges.
-            sorted_data = sorted(data)
-            self.data = tuple(self._remove_pairs(sorted_data))
+            self.data = self._normalize(data)
         else:  # data is None or empty
-            self.data = ()
+            self.data = array('q')
             self.monotonic = True  # An empty set is considered monotonic.
+        # Computed on the first size() call, or passed in by set operations.
+        self._size: Optional[int] = None
+
+    @classmethod
+    def _from_array(cls: Type[_RS], data: array, size: Optional[int] = None) -> _RS:
+        """Wraps boundaries that are already sorted and merged, skipping normalization.
+
+        When `size` is not known it is computed on the first size() call.
+        """
+        rs = cls.__new__(cls)
+        rs.data = data
+        # Matches the constructor, which only treats empty data as monotonic.
+        rs.monotonic = not data
+        rs._size = size
+        return rs
+
+    @classmethod
+    def from_blocks(cls: Type[_RS], blocks: Iterable[int]) -> _RS:
+        """Builds a RangeSet from individual block numbers.
+
+        Consecutive blocks are coalesced into one range, so this is much
+        cheaper than passing a `(b, b + 1)` pair per block. Duplicates are
+        ignored and the input does not need to be sorted.
+
+        Example:
+            RangeSet.from_blocks([3, 4, 5, 9, 1]) -> RangeSet("1 3-5 9")
+        """
+        blocks = list(blocks)
+        if not all(map(lt, blocks, islice(blocks, 1, None))):
+            blocks = sorted(set(blocks))
+        if not blocks:
+            return cls()
+        # A range breaks wherever the gap to the next block is not 1; find
+        # those points with C-level map/compress instead of a Python loop.
+        breaks = list(map(ne, map(sub, islice(blocks, 1, None), blocks), repeat(1)))
+        starts = array('q', [blocks[0]])
+        starts.extend(compress(islice(blocks, 1, None), breaks))
+        ends = array('q', map((1).__add__, compress(blocks, breaks)))
+        ends.append(blocks[-1] + 1)
+        out = array('q', bytes(16 * len(starts)))
+        out[0::2] = starts
+        out[1::2] = ends
+        return cls._from_array(out, len(blocks))
 
     def __iter__(self) -> Iterator[Tuple[int, int]]:
         """Iterates over the [start, end) tuples of the ranges."""
-        for i in range(0, len(self.data), 2):
-            yield self.data[i], self.data[i + 1]
+        return zip(self.data[0::2], self.data[1::2])
+
+    def __len__(self) -> int:
+        """Returns the number of ranges (not integers) in the set."""
+        return len(self.data) // 2
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, RangeSet):
@@ -119,7 +178,7 @@ class RangeSet:
     def _parse_internal(self, text: str) -> None:
         """Parses a string and initializes instance attributes."""
         if not text.strip():
-            self.data = ()
+            self.data = array('q')
             self.monotonic = True
             return
 
@@ -146,8 +205,16 @@ class RangeSet:
             except ValueError as e:
                 raise ValueError(f"Invalid token '{part}': {e}") from e
 
-        points.sort()
-        self.data = tuple(self._remove_pairs(points))
+        self.data = self._normalize(points)
+
+    @classmethod
+    def _normalize(cls, points: Iterable[int]) -> array:
+        """Sorts boundary points and merges adjacent ranges into an array."""
+        points = sorted(points)
+        if all(map(lt, points, islice(points, 1, None))):
+            # Already strictly increasing: nothing to merge.
+            return array('q', points)
+        return array('q', cls._remove_pairs(points))
 
     @staticmethod
     def _remove_pairs(source: List[int]) -> Iterator[int]:
@@ -202,102 +269,87 @@ class RangeSet:
             return "0,"
         return str(len(self.data)) + "," + ",".join(map(str, self.data))
 
-    def _set_op(self, other: 'RangeSet',
-                start_z: int, end_z: int) -> 'RangeSet':
-        """Generic sweep-line algorithm for set operations."""
-        out_data = []
-        z = 0
-        # Create iterators of (point, delta) tuples for the sweep-line.
-        # Delta is +1 for a start point and -1 for an end point.
-        self_events = zip(self.data, cycle((+1, -1)))
-        other_events = zip(other.data, cycle((+1, -1)))
-
-        for point, delta in merge(self_events, other_events):
-            z_before = z
-            z += delta
-            if z_before == start_z and z > start_z:
-                out_data.append(point)
-            elif z_before == end_z and z < end_z:
-                out_data.append(point)
-        return self.__class__(data=tuple(out_data))
+    def _complement(self) -> array:
+        """Returns the boundaries of everything outside this set, bounded by sentinels."""
+        out = array('q', (_MIN,))
+        out.extend(self.data)
+        out.append(_MAX)
+        return out
+
+    @staticmethod
+    def _intersect_arrays(a: array, b: array) -> array:
+        """Intersects two normalized boundary arrays.
+
+        Walks the ranges of the smaller array and bisects into the larger one.
+        Boundaries of the larger array that fall strictly inside a range are
+        copied as one slice; the range's own endpoints are added when they lie
+        inside a range of the larger array (odd bisect index).
+        """
+        if len(a) > len(b):
+            a, b = b, a
+        out = array('q')
+        if not a or not b or a[-1] <= b[0] or b[-1] <= a[0]:
+            return out
+        lo = 0
+        for s, e in zip(a[0::2], a[1::2]):
+            i = bisect_right(b, s, lo)
+            j = bisect_left(b, e, i)
+            if i & 1:
+                out.append(s)
+            out.extend(b[i:j])
+            if j & 1:
+                out.append(e)
+            lo = j
+        return out
 
     def union(self: _RS, other: _RS) -> _RS:
         """Returns the union of this set and another.
 
-        A new range in the union starts when the number of active ranges goes
-        from 0 to 1, and ends when it goes from 1 to 0.
+        Computed as the complement of the intersection of both complements.
         """
-        out_data = []
-        z = 0
-        self_events = zip(self.data, cycle((+1, -1)))
-        other_events = zip(other.data, cycle((+1, -1)))
-
-        for point, delta in merge(self_events, other_events):
-            if z == 0 and delta == +1:  # A new range begins
-                out_data.append(point)
-            elif z == 1 and delta == -1:  # A combined range ends
-                out_data.append(point)
-            z += delta
-        return self.__class__(data=tuple(out_data))
+        if not other.data:
+            return self._from_array(self.data[:], self._size)
+        if not self.data:
+            return self._from_array(other.data[:], other._size)
+        if self.data[-1] < other.data[0]:
+            return self._from_array(self.data + other.data, _add(self._size, other._size))
+        if other.data[-1] < self.data[0]:
+            return self._from_array(other.data + self.data, _add(self._size, other._size))
+        out = self._intersect_arrays(self._complement(), other._complement())
+        return self._from_array(out[1:-1])
 
     def intersect(self: _RS, other: _RS) -> _RS:
-        """Returns the intersection of this set and another.
-
-        A new range in the intersection starts when the number of active ranges
-        goes from 1 to 2, and ends when it goes from 2 to 1.
-        """
-        out_data = []
-        z = 0
-        self_events = zip(self.data, cycle((+1, -1)))
-        other_events = zip(other.data, cycle((+1, -1)))
-
-        for point, delta in merge(self_events, other_events):
-            if z == 1 and delta == +1:  # Overlap begins
-                out_data.append(point)
-            elif z == 2 and delta == -1:  # Overlap ends
-                out_data.append(point)
-            z += delta
-        return self.__class__(data=tuple(out_data))
+        """Returns the intersection of this set and another."""
+        return self._from_array(self._intersect_arrays(self.data, other.data))
 
     def subtract(self: _RS, other: _RS) -> _RS:
         """Returns the set of integers in `self` but not in `other`.
 
-        This is implemented by inverting the effect of `other`'s ranges on
-        the sweep-line counter. A range starts when `self` starts while not
-        inside `other`, and ends when `self` ends.
+        Computed as the intersection of `self` with the complement of `other`.
         """
-        out_data = []
-        z = 0
-        # Invert the delta for `other`: a start point decreases z, an end
-        # point increases it. This effectively subtracts `other`'s regions.
-        self_events = zip(self.data, cycle((+1, -1)))
-        other_events = zip(other.data, cycle((-1, +1)))
-
-        for point, delta in merge(self_events, other_events):
-            if z == 0 and delta == +1:  # Start of a self-range, outside other
-                out_data.append(point)
-            elif z == 1 and delta == -1:  # End of a self-range
-                out_data.append(point)
-            z += delta
-        return self.__class__(data=tuple(out_data))
+        if not self.data or not other.data or \
+                other.data[-1] <= self.data[0] or self.data[-1] <= other.data[0]:
+            return self._from_array(self.data[:], self._size)
+        return self._from_array(self._intersect_arrays(self.data, other._complement()))
 
     def overlaps(self, other: 'RangeSet') -> bool:
         """Returns True if the sets have any integers in common."""
-        z = 0
-        self_events = zip(self.data, cycle((+1, -1)))
-        other_events = zip(other.data, cycle((+1, -1)))
-
-        for _, delta in merge(self_events, other_events):
-            z += delta
-            # If z reaches 2, it means a point is covered by ranges from
-            # both sets, so an overlap exists.
-            if z == 2:
+        a, b = self.data, other.data
+        if len(a) > len(b):
+            a, b = b, a
+        if not a or a[-1] <= b[0] or b[-1] <= a[0]:
+            return False
+        for s, e in zip(a[0::2], a[1::2]):
+            i = bisect_right(b, s)
+            if i & 1 or (i < len(b) and b[i] < e):
                 return True
         return False
 
     def size(self) -> int:
-        """Returns the total number of integers in all ranges."""
-        return sum(e - s for s, e in self)
+        """Returns the total number of integers in all ranges (cached)."""
+        if self._size is None:
+            self._size = sum(self.data[1::2]) - sum(self.data[0::2])
+        return self._size
 
     def map_within(self: _RS, other: _RS) -> _RS:
         """Maps ranges from `other` into the contiguous space of `self`.
@@ -352,7 +404,7 @@ class RangeSet:
                 mapped_point = self_offset + (point - self_active_start)
                 out_data.append(mapped_point)
 
-        return self.__class__(data=tuple(out_data))
+        return self.__class__(data=out_data)
 
     def extend(self: _RS, n: int) -> _RS:
         """Returns a new set with each range extended by `n` on both sides.
@@ -369,19 +421,18 @@ class RangeSet:
         if n < 0:
             raise ValueError("Cannot extend by a negative value.")
         if n == 0 or not self.data:
-            return self.__class__(data=self.data)
+            return self._from_array(self.data[:])
 
-        # Create a string representation of all the extended ranges.
-        # This is an efficient way to leverage the robust parsing and merging
-        # logic in the constructor.
-        extended_ranges = []
+        # Grow every range, then merge the ones that now touch or overlap.
+        out = array('q')
         for s, e in self:
             s_ext = max(0, s - n)
-            e_ext = e + n
-            # to_string expects inclusive end, so e_ext-1
-            extended_ranges.append(f"{s_ext}-{e_ext-1}")
-
-        return self.parse(" ".join(extended_ranges))
+            if out and s_ext <= out[-1]:
+                out[-1] = e + n
+            else:
+                out.append(s_ext)
+                out.append(e + n)
+        return self._from_array(out)
 
     def first(self: _RS, n: int) -> _RS:
         """Returns a new set containing the first `n` integers from this set.
@@ -398,11 +449,11 @@ class RangeSet:
         if n < 0:
             raise ValueError("Number of integers 'n' cannot be negative.")
         if n == 0:
-            return self.__class__(data=())
+            return self.__class__()
         if self.size() <= n:
-            return self.__class__(data=self.data)
+            return self._from_array(self.data[:], self._size)
 
-        out_data = []
+        out_data = array('q')
         count = 0
         for s, e in self:
             size = e - s
@@ -416,4 +467,74 @@ class RangeSet:
                 out_data.extend((s, e))
                 count += size
 
-        return self.__class__(data=tuple(out_data))
+        return self._from_array(out_data, n)
+
+
+def benchmark(cls: Type[RangeSet] = RangeSet, files: int = 20000,
+              total_blocks: int = 2 << 20, seed: int = 0) -> dict:
+    """Times common RangeSet operations on a synthetic ext4-like file map.
+
+    `cls` can be any class with the RangeSet interface, so an older
+    implementation can be measured against the same workload. Returns a dict
+    of operation name -> seconds.
+    """
+    import random
+    import time
+
+    rng = random.Random(seed)
+    span = total_blocks // files
+    file_map = []
+    pos = 0
+    for _ in range(files):
+        size = rng.randint(1, span)
+        data = []
+        # Up to four extents per file with small gaps, as ext4 allocates them.
+        cuts = sorted(rng.sample(range(1, size), min(size - 1, 3))) if size > 1 else []
+        for s, e in zip([0] + cuts, cuts + [size]):
+            data.extend((pos + s, pos + e))
+            pos += rng.randint(0, 1)
+        pos += size + rng.randint(0, span // 4)
+        file_map.append(data)
+    care_map = cls(data=(0, pos))
+    # Zero blocks as LoadFileBlockMap collects them: sorted, in runs.
+    blocks = [b for b in range(pos) if (b >> 6) % 3]
+
+    results = {}
+
+    def timed(name, func):
+        start = time.perf_counter()
+        value = func()
+        results[name] = time.perf_counter() - start
+        return value
+
+    sets = timed("construct", lambda: [cls(data=d) for d in file_map])
+    timed("union (accumulate 2000)", lambda: _accumulate(cls(), sets[:2000]))
+    files_union = timed("union (pairwise tree)", lambda: _union_tree(sets))
+    remaining = timed("subtract (care_map - files)", lambda: care_map.subtract(files_union))
+    timed("intersect (file & care_map)", lambda: [rs.intersect(care_map) for rs in sets])
+    timed("intersect (pairwise neighbours)", lambda: [a.intersect(b) for a, b in zip(sets, sets[1:])])
+    timed("overlaps (pairwise neighbours)", lambda: [a.overlaps(b) for a, b in zip(sets, sets[1:])])
+    timed("size", lambda: [rs.size() for rs in sets] + [remaining.size(), files_union.size()])
+    timed("to_string_raw", lambda: [rs.to_string_raw() for rs in sets] + [files_union.to_string_raw()])
+    if hasattr(cls, "from_blocks"):
+        timed("from_blocks (zero block list)", lambda: cls.from_blocks(blocks))
+    else:
+        timed("from_blocks (zero block list)", lambda: cls(data=[v for b in blocks for v in (b, b + 1)]))
+    return results
+
+
+def _accumulate(acc, sets):
+    for rs in sets:
+        acc = acc.union(rs)
+    return acc
+
+
+def _union_tree(sets):
+    while len(sets) > 1:
+        sets = [a.union(b) for a, b in zip(sets[0::2], sets[1::2])] + sets[len(sets) & ~1:]
+    return sets[0]
+
+
+if __name__ == "__main__":
+    for op, seconds in benchmark().items():
+        print(f"{op:34s} {seconds * 1000:10.1f} ms")
@@ -14,7 +14,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import io
+import mmap
 import os
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from struct import unpack_from
 from typing import Literal
 
 Romfs_types = {
@@ -28,17 +33,105 @@ Romfs_types = {
     7: "fifo",
     8: "exec"
 }
+# File contents are copied with buffers of this size where copy_file_range is unavailable
+COPY_SIZE = 0x100000
+
+
+def _align16(offset):
+    return (offset + 15) & ~15
+
+
+def copy_range(source, offset, size, output):
+    """Copies size bytes at offset of the source image into a new file at output."""
+    with open(source, 'rb') as rf, open(output, 'wb') as wf:
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    count = os.copy_file_range(rf.fileno(), wf.fileno(), size - copied, offset + copied)
+                    if not count:
+                        break
+                    copied += count
+            except OSError:
+                # Unsupported across these filesystems, fall back to buffered copy for the rest
+                pass
+        rf.seek(offset + copied)
+        wf.seek(copied)
+        buf = memoryview(bytearray(min(COPY_SIZE, max(size - copied, 1))))
+        while copied < size:
+            count = rf.readinto(buf[:min(len(buf), size - copied)])
+            if not count:
+                break
+            wf.write(buf[:count])
+            copied += count
+    return copied
+
 
 class RomfsNode:
     def __init__(self, node_type: Literal["dir", "file", "hlink", "block", "unknown"]):
         self.type = node_type
         self.children = []
-        self.data = b""
+        # Contents stay in the image, only where they are is kept
+        self.source = ''
+        self.offset = 0
+        self.size = 0
         self.entry_start = -1
         self.name = ""
         self.checksum = ''
         self.info = ''
 
+    @property
+    def data(self):
+        if not self.size:
+            return b""
+        with open(self.source, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.size)
+
+
+class RomfsFile(io.RawIOBase):
+    """Read-only, seekable view of one file inside a romfs image."""
+
+    def __init__(self, source, offset, size):
+        super().__init__()
+        self._fd = open(source, 'rb')
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.pos = offset
+        return offset
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        self._fd.seek(self.offset + self.pos)
+        n = self._fd.readinto(memoryview(b)[:n])
+        self.pos += n
+        return n
+
+    def close(self):
+        self._fd.close()
+        super().close()
+
+
 class RomfsParse:
     def __init__(self, path) -> None:
         self.file = path
@@ -49,119 +142,138 @@ class RomfsParse:
 
         self.root_node : RomfsNode = RomfsNode('unknown')
         self.all_nodes = []
+        self.headers = {}
         self.init()
+
     @staticmethod
-    def read_volume_name(fp):
-        i = 16
-        name = b""
-        origin_seek = fp.tell()
-        fp.seek(i)
-        data_i = fp.read(1)
-        while int.from_bytes(data_i) != 0:
-            name += data_i
-            data_i = fp.read(1)
-            i += 1
-        fp.seek(origin_seek)
-        if i % 16 == 0:
-            return i, name.decode("utf-8")
-        else:
-            return (i // 16 + 1) * 16, name.decode("utf-8")
+    def read_volume_name(data):
+        end = data.find(b"\x00", 16)
+        if end < 0:
+            raise TypeError("not a romfs bin")
+        return _align16(end + 1), data[16:end].decode("utf-8")
 
     @staticmethod
-    def read_filename(fp, entry_start):
-        origin_seek = fp.tell()
+    def read_filename(data, entry_start):
         start = entry_start + 16
-        filename_start = start
-        name = b""
-        while True:
-            fp.seek(filename_start)
-            data = fp.read(16)
-            name += data
-            if name.find(b"\x00") > -1:
-                break
-            filename_start += 16
-
-        name = name[:name.find(b"\x00")]
-        filename_end = start + len(name) + 1
-        fp.seek(origin_seek)
-        if filename_end % 16 == 0:
-            return filename_end, name.decode("utf-8")
-        else:
-            return (filename_end // 16 + 1) * 16, name.decode("utf-8")
-
-    def view_one_level(self, fp, entry_start):
-        origin_seek = fp.tell()
+        end = data.find(b"\x00", start)
+        if end < 0:
+            raise TypeError(f"unterminated name at {entry_start:#x}")
+        return _align16(end + 1), data[start:end].decode("utf-8")
+
+    def view_one_level(self, data, entry_start):
         nodes = []
-        while entry_start != 0:
-            fp.seek(entry_start)
-            next_entry = int.from_bytes(fp.read(4), byteorder="big")
-            info = int.from_bytes(fp.read(4), byteorder="big")
-            size = int.from_bytes(fp.read(4), byteorder="big")
-            checksum = int.from_bytes(fp.read(4), byteorder="big")
-            data_begin, filename = self.read_filename(fp, entry_start)
+        seen = set()
+        while entry_start != 0 and entry_start not in seen:
+            seen.add(entry_start)
+            next_entry, info, size, checksum = unpack_from(">4I", data, entry_start)
+            data_begin, filename = self.read_filename(data, entry_start)
             node = RomfsNode(Romfs_types.get(next_entry & 0b111, 'unknown'))
             node.entry_start = entry_start
-            fp.seek(data_begin)
-            node.data = fp.read(size)
+            node.source = self.file
+            node.offset = data_begin
+            # Only files, symlinks carry data, the size field means something else for the rest
+            node.size = size if node.type in ("file", "symlink") else 0
             node.name = filename
             node.checksum = checksum
             node.info = info
             nodes.append(node)
-            next_entry >>= 4
-            next_entry <<= 4
-            entry_start = next_entry
-        fp.seek(origin_seek)
+            self.headers[entry_start] = node
+            entry_start = next_entry & ~0b1111
         return nodes
 
     def init(self):
         with open(self.file, 'rb') as f:
             if f.read(8) != b"-rom1fs-":
                 raise TypeError("not a romfs bin")
-            system_size = int.from_bytes(f.read(4), byteorder="big")
-            self.size = system_size
-            entry_start, volume_name = self.read_volume_name(f)
-            root_node = RomfsNode("dir")
-            root_node.name = volume_name
-            self.volume_name = volume_name
-            root_node.entry_start = entry_start
-            path_nodes = [root_node]  # 获取根节点作为目录节点集中的第一个元素
-            all_nodes = [root_node]
-            while len(path_nodes) > 0:
-                node = path_nodes.pop()  # 从目录节点集中弹出一个元素
-                node_entry = node.entry_start
-                f.seek(node_entry +  4)
-                data = f.read(4)
-                next_entry = int.from_bytes(data, byteorder="big")
-                once_nodes = self.view_one_level(f, next_entry)  # 遍历这个目录节点的所属文件
-                all_nodes += once_nodes
-                node.children = once_nodes
-                for _ in once_nodes:
-                    if _.type == "dir" and _.name != ".":
-                        # 如果目录下还有子目录，添加到目录节点集
-                        path_nodes.append(_)
+            # The whole tree is walked from one mapping instead of a seek and read per field
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                system_size = unpack_from(">I", data, 8)[0]
+                self.size = system_size
+                entry_start, volume_name = self.read_volume_name(data)
+                root_node = RomfsNode("dir")
+                root_node.name = volume_name
+                root_node.source = self.file
+                self.volume_name = volume_name
+                root_node.entry_start = entry_start
+                path_nodes = [root_node]  # 获取根节点作为目录节点集中的第一个元素
+                all_nodes = [root_node]
+                while len(path_nodes) > 0:
+                    node = path_nodes.pop()  # 从目录节点集中弹出一个元素
+                    next_entry = unpack_from(">I", data, node.entry_start + 4)[0]
+                    once_nodes = self.view_one_level(data, next_entry)  # 遍历这个目录节点的所属文件
+                    all_nodes += once_nodes
+                    node.children = once_nodes
+                    for _ in once_nodes:
+                        if _.type == "dir" and _.name not in ['.', '..']:
+                            # 如果目录下还有子目录，添加到目录节点集
+                            path_nodes.append(_)
             self.nodes = len(all_nodes)
             # 返回根节点与所有节点集
             self.root_node = root_node
             self.all_nodes = all_nodes
 
-    def __extract(self, root_node, prefix="."):
-        path = os.path.join(prefix, root_node.name)
-        if root_node.name in ['.', '..']:
-            return
-        if root_node.type == "file":
-            with open(path, "wb") as f:
-                f.write(root_node.data)
-                f.flush()
-        elif root_node.type == "dir" and root_node.name != ".":
-            os.makedirs(path, exist_ok=True)
-        else:
-            print(root_node.type, root_node.name, root_node.data)
+    def lookup(self, path) -> RomfsNode:
+        """Returns the node at path (relative to the volume root), following hard links."""
+        parents = []
+        node = self.root_node
+        for part in path.replace("\\", "/").split("/"):
+            if part in ['', '.']:
+                continue
+            if part == '..':
+                # The "." and ".." entries may link to themselves, so they are resolved by name
+                node = parents.pop() if parents else self.root_node
+                continue
+            for child in node.children:
+                if child.name == part:
+                    parents.append(node)
+                    node = child
+                    break
+            else:
+                raise FileNotFoundError(path)
+            seen = set()
+            while node.type == "hlink" and node.info in self.headers and node.info not in seen:
+                seen.add(node.info)
+                node = self.headers[node.info]
+        return node
 
-        for c in root_node.children:
-            self.__extract(c, path)
+    def listdir(self, path='') -> list:
+        node = self.lookup(path)
+        if node.type != "dir":
+            raise NotADirectoryError(path)
+        return [c.name for c in node.children if c.name not in ['.', '..']]
+
+    def open(self, path):
+        """Opens one file of the image for reading, without extracting anything else."""
+        node = self.lookup(path)
+        if node.type not in ("file", "symlink"):
+            raise IsADirectoryError(path) if node.type == "dir" else OSError(f"{path} is a {node.type}")
+        return io.BufferedReader(RomfsFile(self.file, node.offset, node.size), COPY_SIZE)
+
+    def extract_file(self, path, output):
+        node = self.lookup(path)
+        if node.type != "file":
+            raise OSError(f"{path} is a {node.type}")
+        return copy_range(self.file, node.offset, node.size, output)
 
     def extract(self, prefix='.'):
-        self.__extract(self.root_node, prefix)
+        # Directories are created while walking, file contents are copied concurrently afterwards
+        jobs = []
+        stack = [(self.root_node, prefix)]
+        while stack:
+            node, parent = stack.pop()
+            path = os.path.join(parent, node.name)
+            if node.name in ['.', '..']:
+                continue
+            if node.type == "file":
+                jobs.append((node, path))
+            elif node.type == "dir":
+                os.makedirs(path, exist_ok=True)
+            else:
+                print(node.type, node.name, node.data)
+            stack.extend((c, path) for c in reversed(node.children))
+        with ThreadPoolExecutor(max_workers=min(cpu_count(), 8)) as executor:
+            for future in [executor.submit(copy_range, self.file, n.offset, n.size, p) for n, p in jobs]:
+                future.result()
 
     def __print_struct(self, root_node, depth=0):
         if (root_node.type == "dir" and root_node.name != ".") or (root_node.type == "file"):
@@ -174,4 +286,3 @@ class RomfsParse:
 
     def __repr__(self):
         return f"(Romfs, volume_name = {self.volume_name}, size = {self.size}, nodes_number = {self.nodes})"
-
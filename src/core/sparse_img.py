@@ -12,10 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import os
 import struct
-import sys
 from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
 
 from . import rangelib
 
@@ -166,21 +168,8 @@ class SparseImage:
                 to_read -= this_read
 
     def LoadFileBlockMap(self, fn, clobbered_blocks):
-        remaining = self.care_map
         self.file_map = out = {}
-
-        with open(fn) as f:
-            for line in f:
-                fn, ranges = line.split(None, 1)
-                ranges = rangelib.RangeSet.parse(ranges)
-                out[fn] = ranges
-                assert ranges.size() == ranges.intersect(remaining).size()
-
-                # Currently we assume that blocks in clobbered_blocks are not part of
-                # any file.
-                assert not clobbered_blocks.overlaps(ranges)
-                remaining = remaining.subtract(ranges)
-
+        remaining = LoadBlockMapFile(fn, out, self.care_map, clobbered_blocks)
         remaining = remaining.subtract(clobbered_blocks)
 
         # For all the remaining blocks in the care_map (ie, those that
@@ -189,61 +178,266 @@ class SparseImage:
         # (Zero blocks are handled specially because (1) there are usually
         # a lot of them and (2) bsdiff handles files with long sequences of
         # repeated bytes especially poorly.)
+        zero_blocks, nonzero_blocks = self._ClassifyBlocks(remaining)
+        AddSpecialDomains(out, zero_blocks, nonzero_blocks, clobbered_blocks)
 
-        zero_blocks = []
-        nonzero_blocks = []
-        if sys.version_info[:2] >= (3, 0):
-            reference = bytes('\0' * self.blocksize, encoding="UTF-8")
-        else:
-            reference = '\0' * self.blocksize
-
-        # Workaround for bug 23227672. For squashfs, we don't have a system.map. So
-        # the whole system image will be treated as a single file. But for some
-        # unknown bug, the updater will be killed due to OOM when writing back the
-        # patched image to flash (observed on lenok-userdebug MEA49). Prior to
-        # getting a real fix, we evenly divide the non-zero blocks into smaller
-        # groups (currently 1024 blocks or 4MB per group).
-        # Bug: 23227672
-        MAX_BLOCKS_PER_GROUP = 1024
-        nonzero_groups = []
+    def _ClassifyBlocks(self, ranges):
+        """Splits ranges into (zero, nonzero) RangeSets.
 
+    Fill chunks are classified as a whole; raw chunk data is read in windows
+    of up to SCAN_WINDOW bytes instead of one block at a time."""
+        zero_data = []
+        nonzero_data = []
+        window = max(1, SCAN_WINDOW // self.blocksize)
         f = self.simg_f
-        for s, e in remaining:
-            for b in range(s, e):
-                idx = bisect_right(self.offset_index, b) - 1
-                chunk_start, _, filepos, fill_data = self.offset_map[idx]
-                if filepos is not None:
-                    filepos += (b - chunk_start) * self.blocksize
-                    f.seek(filepos, os.SEEK_SET)
-                    data = f.read(self.blocksize)
+        for s, e in ranges:
+            while s < e:
+                idx = bisect_right(self.offset_index, s) - 1
+                chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
+                end = min(e, chunk_start + chunk_len, s + window)
+                if filepos is None:
+                    (zero_data if fill_data == b"\0\0\0\0" else nonzero_data).extend((s, end))
                 else:
-                    if fill_data == reference[:4]:  # fill with all zeros
-                        data = reference
-                    else:
-                        data = None
-
-                if data == reference:
-                    zero_blocks.append(b)
-                    zero_blocks.append(b + 1)
+                    f.seek(filepos + (s - chunk_start) * self.blocksize, os.SEEK_SET)
+                    for run_start, run_end, is_zero in ZeroRuns(f.read((end - s) * self.blocksize), s,
+                                                                self.blocksize):
+                        (zero_data if is_zero else nonzero_data).extend((run_start, run_end))
+                s = end
+        return rangelib.RangeSet(data=zero_data), rangelib.RangeSet(data=nonzero_data)
+
+
+class SparseReader(io.RawIOBase):
+    """Read-only, seekable view of the expanded contents of a SparseImage.
+
+  Don't-care regions read as zeros. Wrap it in io.BufferedReader when callers
+  expect read(n) to return n bytes across chunk boundaries."""
+
+    def __init__(self, image):
+        super().__init__()
+        self.image = image
+        self.size = image.total_blocks * image.blocksize
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.pos = offset
+        return offset
+
+    def readinto(self, b):
+        image = self.image
+        bs = image.blocksize
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        block = self.pos // bs
+        idx = bisect_right(image.offset_index, block) - 1
+        if idx < 0 or block >= image.offset_map[idx][0] + image.offset_map[idx][1]:
+            # Don't-care gap up to the next chunk.
+            next_start = image.offset_map[idx + 1][0] if idx + 1 < len(image.offset_map) else image.total_blocks
+            n = min(n, next_start * bs - self.pos)
+            b[:n] = bytes(n)
+        else:
+            chunk_start, chunk_len, filepos, fill_data = image.offset_map[idx]
+            offset = self.pos - chunk_start * bs
+            n = min(n, chunk_len * bs - offset)
+            if filepos is not None:
+                image.simg_f.seek(filepos + offset, os.SEEK_SET)
+                data = image.simg_f.read(n)
+                n = len(data)
+            else:
+                data = (fill_data * ((offset % 4 + n + 3) // 4 + 1))[offset % 4:offset % 4 + n]
+            b[:n] = data
+        self.pos += n
+        return n
+
+
+# Bytes classified per read (and per worker task in RawImage).
+SCAN_WINDOW = 64 * 1024 * 1024
+MAX_BLOCKS_PER_GROUP = 512
+
+
+def ZeroRuns(data, first_block, blocksize):
+    """Returns [(start, end, is_zero), ...] runs for the blocks in data.
+
+  A short last block is treated as zero-padded. The whole buffer is checked
+  at once first, which is the common case for unused space."""
+    if data.count(0) == len(data):
+        return [(first_block, first_block + (len(data) + blocksize - 1) // blocksize, True)]
+    runs = []
+    view = memoryview(data)
+    zero_block = bytes(blocksize)
+    run_start, run_zero = first_block, None
+    for i in range(0, len(data), blocksize):
+        piece = view[i:i + blocksize]
+        zero = piece == zero_block if len(piece) == blocksize else not any(piece)
+        if zero != run_zero:
+            if run_zero is not None:
+                runs.append((run_start, first_block + i // blocksize, run_zero))
+            run_start, run_zero = first_block + i // blocksize, zero
+    runs.append((run_start, first_block + (len(data) + blocksize - 1) // blocksize, run_zero))
+    return runs
+
+
+def LoadBlockMapFile(fn, out, care_map, clobbered_blocks):
+    """Reads a "path ranges" block map into out; returns the care_map blocks no file claims."""
+    remaining = care_map
+    with open(fn) as f:
+        for line in f:
+            # Comment lines, e.g. the image stamp ext4_block_map writes first
+            if line.startswith('#'):
+                continue
+            name, ranges = line.split(None, 1)
+            ranges = rangelib.RangeSet.parse(ranges)
+            out[name] = ranges
+            assert ranges.size() == ranges.intersect(remaining).size()
+
+            # Currently we assume that blocks in clobbered_blocks are not part of
+            # any file.
+            assert not clobbered_blocks.overlaps(ranges)
+            remaining = remaining.subtract(ranges)
+    return remaining
+
+
+def AddSpecialDomains(out, zero_blocks, nonzero_blocks, clobbered_blocks):
+    """Adds the __ZERO, __NONZERO-n and __COPY domains to a file map."""
+    assert zero_blocks or nonzero_blocks or clobbered_blocks
+
+    if zero_blocks:
+        out["__ZERO"] = zero_blocks
+    # Workaround for bug 23227672. For squashfs, we don't have a system.map. So
+    # the whole system image will be treated as a single file. But for some
+    # unknown bug, the updater will be killed due to OOM when writing back the
+    # patched image to flash (observed on lenok-userdebug MEA49). Prior to
+    # getting a real fix, we evenly divide the non-zero blocks into smaller
+    # groups (currently 512 blocks or 2MB per group).
+    # Bug: 23227672
+    group = []
+    group_size = 0
+    index = 0
+    for s, e in nonzero_blocks:
+        while s < e:
+            take = min(e - s, MAX_BLOCKS_PER_GROUP - group_size)
+            group.extend((s, s + take))
+            group_size += take
+            s += take
+            if group_size == MAX_BLOCKS_PER_GROUP:
+                out[f"__NONZERO-{index:d}"] = rangelib.RangeSet(data=group)
+                index += 1
+                group, group_size = [], 0
+    if group:
+        out[f"__NONZERO-{index:d}"] = rangelib.RangeSet(data=group)
+    if clobbered_blocks:
+        out["__COPY"] = clobbered_blocks
+
+
+class RawImage:
+    """Wraps a raw (non-sparse) image file into an image object for BlockImageDiff.
+
+  The zero / non-zero classification that SparseImage.LoadFileBlockMap does
+  is done here by scanning large windows of the file in parallel, skipping
+  holes reported by SEEK_DATA without reading them. The resulting file_map
+  matches what SparseImage produces for the same image converted with
+  img2simg, so the generated transfer list is identical. file_map_fn is an
+  optional block map in the format LoadFileBlockMap reads.
+  """
+
+    # Bytes read per chunk by ReadRangeSet.
+    READ_CHUNK = 16 * 1024 * 1024
+
+    def __init__(self, image_fn, clobbered_blocks=None, blocksize=4096, threads=None, file_map_fn=None):
+        self.simg_f = open(image_fn, "rb")
+        self.blocksize = blocksize
+        self.file_size = os.path.getsize(image_fn)
+        self.total_blocks = (self.file_size + blocksize - 1) // blocksize
+        self.care_map = rangelib.RangeSet(data=(0, self.total_blocks))
+        # A partial last block reads as zero-padded, as img2simg would store it.
+        self.clobbered_blocks = rangelib.RangeSet(data=clobbered_blocks)
+        self.extended = rangelib.RangeSet()
+        print(f"Total of {self.total_blocks:d} {blocksize:d}-byte blocks in raw image {image_fn}.")
+        self.file_map = self._build_file_map(image_fn, threads or os.cpu_count() or 1, file_map_fn)
+
+    def _data_blocks(self):
+        """Blocks that may hold data; everything else is a hole and reads as zero."""
+        fd = self.simg_f.fileno()
+        if not hasattr(os, "SEEK_DATA"):
+            return self.care_map
+        bs = self.blocksize
+        data = []
+        pos = 0
+        try:
+            while pos < self.file_size:
+                try:
+                    start = os.lseek(fd, pos, os.SEEK_DATA)
+                except OSError:
+                    # ENXIO: only a hole is left.
+                    break
+                end = os.lseek(fd, start, os.SEEK_HOLE)
+                start, block_end = start // bs, (end + bs - 1) // bs
+                # Segments that share a block are merged here.
+                if data and start <= data[-1]:
+                    data[-1] = block_end
                 else:
-                    nonzero_blocks.append(b)
-                    nonzero_blocks.append(b + 1)
-
-                    if len(nonzero_blocks) >= MAX_BLOCKS_PER_GROUP:
-                        nonzero_groups.append(nonzero_blocks)
-                        # Clear the list.
-                        nonzero_blocks = []
-
-        if nonzero_blocks:
-            nonzero_groups.append(nonzero_blocks)
-            nonzero_blocks = []
-
-        assert zero_blocks or nonzero_groups or clobbered_blocks
-
-        if zero_blocks:
-            out["__ZERO"] = rangelib.RangeSet(data=zero_blocks)
-        if nonzero_groups:
-            for i, blocks in enumerate(nonzero_groups):
-                out[f"__NONZERO-{i:d}"] = rangelib.RangeSet(data=blocks)
-        if clobbered_blocks:
-            out["__COPY"] = clobbered_blocks
+                    data.extend((start, block_end))
+                pos = end
+        except OSError:
+            return self.care_map
+        return rangelib.RangeSet(data=data)
+
+    def _scan_window(self, image_fn, start, end):
+        bs = self.blocksize
+        with open(image_fn, "rb") as f:
+            f.seek(start * bs)
+            return ZeroRuns(f.read((end - start) * bs), start, bs)
+
+    def _build_file_map(self, image_fn, threads, file_map_fn):
+        out = {}
+        remaining = self.care_map
+        if file_map_fn:
+            remaining = LoadBlockMapFile(file_map_fn, out, remaining, self.clobbered_blocks)
+        remaining = remaining.subtract(self.clobbered_blocks)
+
+        to_scan = remaining.intersect(self._data_blocks())
+        window = max(1, SCAN_WINDOW // self.blocksize)
+        windows = [(start, min(e, start + window)) for s, e in to_scan for start in range(s, e, window)]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            scanned = list(executor.map(lambda w: self._scan_window(image_fn, *w), windows))
+        nonzero = rangelib.RangeSet(
+            data=[i for runs in scanned for first, last, zero in runs if not zero for i in (first, last)])
+        # Holes and scanned zero runs are everything left over.
+        zero_blocks = remaining.subtract(nonzero)
+
+        AddSpecialDomains(out, zero_blocks, nonzero, self.clobbered_blocks)
+        return out
+
+    def ReadRangeSet(self, ranges):
+        f = self.simg_f
+        chunk_blocks = max(1, self.READ_CHUNK // self.blocksize)
+        for s, e in ranges:
+            for start in range(s, e, chunk_blocks):
+                length = (min(e, start + chunk_blocks) - start) * self.blocksize
+                f.seek(start * self.blocksize, os.SEEK_SET)
+                data = f.read(length)
+                yield data if len(data) == length else data.ljust(length, b"\0")
+
+    def TotalSha1(self, include_clobbered_blocks=False):
+        ranges = self.care_map
+        if not include_clobbered_blocks:
+            ranges = ranges.subtract(self.clobbered_blocks)
+        h = sha1()
+        for data in self.ReadRangeSet(ranges):
+            h.update(data)
+        return h.hexdigest()
@@ -7,22 +7,39 @@
 # Based on the app_structure file in split_up_data.pl by McSpoon
 
 
+from binascii import crc_hqx
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from os import makedirs, path
 from string import printable
 from struct import unpack
 
+# Images are copied in buffers of this size (a multiple of any block size)
+COPY_SIZE = 16 << 20
+# Bit reversal of every byte value, crc_hqx computes the unreflected form of the CRC
+_REVERSE = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+# (path, size, mtime) -> entries, so get_parts and extract do not scan the same file again
+_index_cache = {}
 
-def extract(source, out_dir: str, flist: list):
-    byte_num = 4
-    img_files = []
 
-    try:
-        makedirs(out_dir, exist_ok=True)
-    finally:
-        ...
-    if not path.exists(source):
-        print('The File Not Exist!')
-        return
+def crc16(data) -> int:
+    """CRC-16/X-25 of data, the per block checksum in the header's CRC table."""
+    crc = crc_hqx(bytes(data).translate(_REVERSE), 0xFFFF)
+    return int(f'{crc:016b}'[::-1], 2) ^ 0xFFFF
+
+
+def read_index(source):
+    """
+    Read all entry headers of an UPDATE.APP in one pass, seeking over the images.
+    Returns a list of (filename, offset, file_size, block_size, crc_data).
+    """
+    st = path.getsize(source), path.getmtime(source)
+    key = path.abspath(source)
+    if key in _index_cache and _index_cache[key][0] == st:
+        return _index_cache[key][1]
+
+    byte_num = 4
+    entries = []
     with open(source, 'rb') as f:
         while True:
             i = f.read(byte_num)
@@ -43,67 +60,88 @@ def extract(source, out_dir: str, flist: list):
             except Exception or BaseException:
                 filename = ''
 
-            f.seek(22, 1)
-            # Its Crc_data
-            f.read(header_size - 98)
-
-            if not flist or filename in flist:
-                if filename in img_files:
-                    filename = f'{filename}_2'
-
-                print(f'Extracting {filename}.img ...')
-                try:
-                    with open(f'{out_dir}/{filename}.img', 'wb') as o:
-                        while file_size > 0:
-                            chunk = min(10240, file_size)
-
-                            o.write(f.read(chunk))
-                            file_size -= chunk
-                except Exception as e:
-                    print(f'ERROR: Failed to create {filename}.img:%s\n' % e)
-                    return
-
-                img_files.append(filename)
-            else:
-                f.seek(file_size, 1)
+            f.seek(18, 1)
+            block_size = list(unpack('<H', f.read(2)))[0]
+            f.seek(2, 1)
+            crc_data = f.read(header_size - 98)
+            entries.append((filename, f.tell(), file_size, block_size, crc_data))
+            f.seek(file_size, 1)
 
             x_bytes = byte_num - f.tell() % byte_num
             if x_bytes < byte_num:
                 f.seek(x_bytes, 1)
 
-    print('Extraction complete')
-
-
-def get_parts(source):
-    byte_num = 4
-
-    with open(source, 'rb') as f:
-        while True:
-            i = f.read(byte_num)
-
-            if not i:
+    _index_cache[key] = (st, entries)
+    return entries
+
+
+def extract_image(source, out_file, offset, file_size, block_size, crc_data):
+    """
+    Copy one image out of UPDATE.APP, checking every block against the CRC table on the way.
+    Returns the indexes of the blocks that do not match, or None if there is no usable table.
+    """
+    verify = block_size > 0 and len(crc_data) == -(-file_size // block_size) * 2
+    crcs = unpack(f'<{len(crc_data) // 2}H', crc_data[:len(crc_data) // 2 * 2]) if verify else ()
+    bad = []
+    block = 0
+    size = COPY_SIZE - COPY_SIZE % block_size if verify else COPY_SIZE
+    with open(source, 'rb') as f, open(out_file, 'wb') as o:
+        f.seek(offset)
+        while file_size > 0:
+            data = f.read(min(size, file_size))
+            if not data:
                 break
-            elif i != b'\x55\xAA\x5A\xA5':
-                continue
-
-            header_size = list(unpack('<L', f.read(byte_num)))[0]
-            f.seek(16, 1)
-            file_size = list(unpack('<L', f.read(byte_num)))[0]
-            f.seek(32, 1)
+            o.write(data)
+            file_size -= len(data)
+            if verify:
+                data = memoryview(data)
+                for pos in range(0, len(data), block_size):
+                    if crc16(data[pos:pos + block_size]) != crcs[block]:
+                        bad.append(block)
+                    block += 1
+    return bad if verify else None
+
+
+def extract(source, out_dir: str, flist: list, verify: bool = True):
+    img_files = []
+    jobs = []
 
+    try:
+        makedirs(out_dir, exist_ok=True)
+    finally:
+        ...
+    if not path.exists(source):
+        print('The File Not Exist!')
+        return
+    for filename, offset, file_size, block_size, crc_data in read_index(source):
+        if not flist or filename in flist:
+            if filename in img_files:
+                filename = f'{filename}_2'
+            img_files.append(filename)
+            jobs.append((filename, offset, file_size, block_size, crc_data if verify else b''))
+
+    with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+        futures = []
+        for filename, offset, file_size, block_size, crc_data in jobs:
+            print(f'Extracting {filename}.img ...')
+            futures.append(executor.submit(extract_image, source, f'{out_dir}/{filename}.img', offset, file_size,
+                                           block_size, crc_data))
+        for (filename, *_), future in zip(jobs, futures):
             try:
-                filename = str(f.read(16).decode())
-                filename = ''.join(f for f in filename if f in printable).lower()
-            except Exception or BaseException:
-                filename = ''
+                bad = future.result()
+            except Exception as e:
+                print(f'ERROR: Failed to create {filename}.img:%s\n' % e)
+                continue
+            if bad:
+                print(f'WARNING: {filename}.img: {len(bad)} block(s) fail CRC check: '
+                      f'{", ".join(str(i) for i in bad[:10])}{" ..." if len(bad) > 10 else ""}')
+            elif bad is not None:
+                print(f'{filename}.img: CRC verified')
 
-            f.seek(22, 1)
-            # Its Crc_data
-            f.read(header_size - 98)
-            f.seek(file_size, 1)
+    print('Extraction complete')
 
-            x_bytes = byte_num - f.tell() % byte_num
-            if x_bytes < byte_num:
-                f.seek(x_bytes, 1)
-            if filename:
-                yield filename
+
+def get_parts(source):
+    for filename, *_ in read_index(source):
+        if filename:
+            yield filename
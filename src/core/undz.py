@@ -4,21 +4,24 @@
 
   Please do not distribute without permission from the author of this software.
 """
+import hashlib
 import os
 import sys
 import zlib
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from struct import *
 
+# Compressed bytes read, and decompressed bytes produced, per step; bounds memory per worker
+READ_SIZE = 1 << 20
+
 
 class DZFileTools:
     """
     LGE Compressed DZ File tools
     """
 
-    # Setup variables
-    partitions = []
-
     dz_header = b"\x32\x96\x18\x74"
     dz_sub_header = b"\x30\x12\x95\x78"
     dz_sub_len = 512
@@ -31,15 +34,16 @@ class DZFileTools:
     #   ('itemName', ('formatString', collapse))
     dz_sub_dict = OrderedDict([
         ('header', ('4s', False)),
-        ('type', ('32s', True)),
-        ('name', ('64s', True)),
-        ('unknown', ('I', False)),
-        ('length', ('I', False)),
-        ('checksum', ('16s', False)),
-        ('spacer1', ('I', False)),
-        ('spacer2', ('I', False)),
-        ('spacer3', ('I', False)),
-        ('pad', ('376s', True))
+        ('type', ('32s', True)),  # slice (partition) name
+        ('name', ('64s', True)),  # chunk name
+        ('target_size', ('I', False)),  # decompressed bytes
+        ('length', ('I', False)),  # compressed bytes
+        ('checksum', ('16s', False)),  # MD5 of the decompressed data
+        ('target_addr', ('I', False)),  # first block written, on the flash device
+        ('trim_count', ('I', False)),  # blocks covered up to the next chunk
+        ('dev', ('I', False)),
+        ('crc32', ('I', False)),  # CRC32 of the decompressed data
+        ('pad', ('372s', True))
     ])
 
     # Generate the formatstring for struct.unpack()
@@ -48,9 +52,18 @@ class DZFileTools:
     # Generate list of items that can be collapsed (truncated)
     dz_collapsibles = list(zip(list(dz_sub_dict.keys()), [x[1] for x in list(dz_sub_dict.values())]))
 
-    def __init__(self, input_, output, extract_id: int = -1, extract_all: bool = False, listonly: bool = False):
+    def __init__(self, input_, output, extract_id: int = -1, extract_all: bool = False, listonly: bool = False,
+                 threads: int = None, offset: int = 0, length: int = None, block_shift: int = None):
+        """
+        offset and length select a DZ file embedded in a larger one (e.g. a KDZ), which is read in place.
+        block_shift is log2 of the flash block size; when None it is taken from a .dz.params in output,
+        as written for mkdz, or else guessed from the chunk headers.
+        """
         self.outdir = output
-        self.openFile(input_)
+        self.block_shift = block_shift
+        self.partitions = []
+        self.threads = threads or cpu_count()
+        self.openFile(input_, offset, length)
         self.partList = self.getPartitions()
 
         if listonly:
@@ -107,7 +120,7 @@ class DZFileTools:
 
             # Would seeking the file to the end of the compressed data
             # bring us to the end of the file, or beyond it?
-            if int(self.infile.tell()) + int(dz_sub['length']) >= int(self.dz_length):
+            if int(self.infile.tell()) + int(dz_sub['length']) >= self.dz_start + int(self.dz_length):
                 break
 
             # Seek to next DZ header
@@ -116,47 +129,160 @@ class DZFileTools:
         # Make partition list
         return [(x['name'], x['length']) for x in self.partitions]
 
-    def extractPartition(self, index):
+    def inflateChunk(self, chunk, out_path, out_offset=0):
         """
-        Extracts a partition from a compressed DZ file using ZLIB.
-        self function could be particularly memory-intensive when used with large segments,
-        as the entire compressed segment is loaded into RAM and decompressed.
-
-        A better way to do self would be to chunk the zlib compressed data and decompress it
-        with zlib.decompressor() and a while loop.
+        Decompresses one chunk into out_path at out_offset, READ_SIZE at a time, checking
+        its MD5 and CRC32 on the way. Returns an error message, or None if the chunk is good.
+        Each call uses its own file handles, so chunks can be inflated concurrently.
+        """
+        md5 = hashlib.md5()
+        crc = 0
+        written = 0
+        inflater = zlib.decompressobj()
+        with open(self.dzfile, 'rb') as infile, open(out_path, 'r+b') as outfile:
+            infile.seek(chunk['offset'])
+            outfile.seek(out_offset)
+            remaining = chunk['length']
+            data = b''
+            while not inflater.eof:
+                if not data and remaining:
+                    data = infile.read(min(READ_SIZE, remaining))
+                    remaining = remaining - len(data) if data else 0
+                # max_length keeps highly compressed (e.g. zero filled) data from expanding all at once
+                try:
+                    out = inflater.decompress(data, READ_SIZE)
+                except zlib.error as e:
+                    return f"{chunk['name'].decode()}: {e}"
+                data = inflater.unconsumed_tail
+                if not out and not data and not remaining:
+                    break
+                md5.update(out)
+                crc = zlib.crc32(out, crc)
+                outfile.write(out)
+                written += len(out)
+        name = chunk['name'].decode()
+        if not inflater.eof:
+            return f"{name}: compressed data is truncated"
+        if written != chunk['target_size']:
+            return f"{name}: got {written} bytes, expected {chunk['target_size']}"
+        if md5.digest() != chunk['checksum'] or crc != chunk['crc32']:
+            return f"{name}: checksum mismatch"
+        return None
 
-        I'm lazy though, and y'all have fast computers, so self is good enough.
+    def extractPartition(self, index):
+        """
+        Extracts a single chunk from a compressed DZ file to a file named after it.
         """
 
         currentPartition = self.partitions[index]
 
-        # Seek to the beginning of the compressed data in the specified partition
-        self.infile.seek(currentPartition['offset'])
-
         # Ensure that the output directory exists
         if not os.path.exists(self.outdir):
             os.makedirs(self.outdir)
 
-        # Open the new file for writing
-        outfile = open(os.path.join(self.outdir, currentPartition['name'].decode()), 'wb')
-
-        # Read the whole compressed segment into RAM
-        zdata = self.infile.read(currentPartition['length'])
+        out_path = os.path.join(self.outdir, currentPartition['name'].decode())
+        open(out_path, 'wb').close()
+        error = self.inflateChunk(currentPartition, out_path)
+        if error:
+            print(f"[!] {error}")
 
-        # Decompress the data, and write it to disk
-        outfile.write(zlib.decompress(zdata))
-
-        # Close the file
-        outfile.close()
-
-    def openFile(self, dzfile):
+    def loadBlockShift(self):
+        """
+        Returns blockShift from {outdir}/.dz.params (the parameter file mkdz builds from), or None.
+        """
+        path = os.path.join(self.outdir, ".dz.params")
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rt') as f:
+            for line in f:
+                var, sep, val = line.partition("#")[0].partition("=")
+                if sep and var.strip() in ('blockShift', 'block_shift'):
+                    try:
+                        return int(val.strip())
+                    except ValueError:
+                        print(f"[!] Bad blockShift in {path}: {val.strip()}")
+        return None
+
+    def blockShift(self):
+        """
+        The block size is not stored in the DZ file. An explicit block_shift, or one from .dz.params,
+        wins; otherwise a shift (512 to 4096 bytes) is kept only if every chunk's trim_count covers its
+        decompressed size and no two chunks of a slice overlap. Shifts at which some chunk fills exactly
+        its trim_count are preferred, as chunks are written back to back on the device.
+        """
+        shift = self.block_shift if self.block_shift is not None else self.loadBlockShift()
+        if shift is not None:
+            print(f"[+] Block size: {1 << shift} bytes (given)")
+            return shift
+
+        slices = OrderedDict()
+        for chunk in self.partitions:
+            slices.setdefault(chunk['type'], []).append(chunk)
+        for chunks in slices.values():
+            chunks.sort(key=lambda x: x['target_addr'])
+
+        def fits(s):
+            if any(x['trim_count'] << s < x['target_size'] for x in self.partitions):
+                return False
+            for chunks in slices.values():
+                for a, b in zip(chunks, chunks[1:]):
+                    if a['target_addr'] + (-(-a['target_size'] >> s)) > b['target_addr']:
+                        return False
+            return True
+
+        candidates = [s for s in range(9, 13) if fits(s)]
+        dense = [s for s in candidates if any(-(-x['target_size'] >> s) == x['trim_count'] for x in self.partitions)]
+        choices = dense or candidates
+        if not choices:
+            print("[!] No block size fits the chunk headers, assuming 4096 bytes")
+            return 12
+        shift = choices[0]
+        print(f"[+] Block size: {1 << shift} bytes")
+        if len(choices) > 1:
+            print(f"[!] Block size is ambiguous, {', '.join(str(1 << s) for s in choices)} all fit; "
+                  f"pass block_shift or set blockShift in .dz.params if the images are wrong")
+        return shift
+
+    def extractSlices(self):
+        """
+        Rebuilds each slice as {slice}.img: chunks are inflated concurrently straight to their
+        offsets in a preallocated (sparse) image, so the gaps between them stay unwritten.
+        """
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+        shift = self.blockShift()
+        slices = OrderedDict()
+        for chunk in self.partitions:
+            slices.setdefault(chunk['type'].decode(), []).append(chunk)
+
+        tasks = []
+        for name, chunks in slices.items():
+            start = min(x['target_addr'] for x in chunks)
+            end = max(x['target_addr'] + max(x['trim_count'], -(-x['target_size'] >> shift)) for x in chunks)
+            out_path = os.path.join(self.outdir, f"{name}.img")
+            print(f"[+] Extracting {name} ({len(chunks)} chunks) to {out_path}")
+            with open(out_path, 'wb') as f:
+                f.truncate((end - start) << shift)
+            tasks.extend((x, out_path, (x['target_addr'] - start) << shift) for x in chunks)
+
+        # Largest chunks first, so one big chunk does not end up running alone at the end
+        tasks.sort(key=lambda t: t[0]['length'], reverse=True)
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            errors = [e for e in executor.map(lambda t: self.inflateChunk(*t), tasks) if e]
+        for error in errors:
+            print(f"[!] {error}")
+        return not errors
+
+    def openFile(self, dzfile, offset=0, length=None):
         # Open the file
+        self.dzfile = dzfile
         self.infile = open(dzfile, "rb")
 
-        # Get length of whole file
+        # Get length of the DZ data, which starts at offset
         self.infile.seek(0, os.SEEK_END)
-        self.dz_length = self.infile.tell()
-        self.infile.seek(0)
+        self.dz_start = offset
+        self.dz_length = self.infile.tell() - offset if length is None else length
+        self.infile.seek(offset)
 
         # Verify DZ header
         verify_header = self.infile.read(4)
@@ -167,7 +293,7 @@ class DZFileTools:
             sys.exit(0)
 
         # Skip to end of DZ header
-        self.infile.seek(512)
+        self.infile.seek(offset + 512)
 
     def cmdListPartitions(self):
         print("[+] DZ Partition List\n=========================================")
@@ -176,12 +302,10 @@ class DZFileTools:
 
     def cmdExtractSingle(self, partID):
         print("[+] Extracting single partition!\n")
-        print("[+] Extracting {self.partList[partID][0].decode()} to " + os.path.join(self.outdir,
-                                                                                        self.partList[partID][0].decode(())))
+        print(f"[+] Extracting {self.partList[partID][0].decode()} to "
+              f"{os.path.join(self.outdir, self.partList[partID][0].decode())}")
         self.extractPartition(partID)
 
     def cmdExtractAll(self):
         print("[+] Extracting all partitions!\n")
-        for part in enumerate(self.partList):
-            print(f"[+] Extracting {part[1][0].decode()} to {os.path.join(self.outdir, part[1][0].decode())}")
-            self.extractPartition(part[0])
+        self.extractSlices()
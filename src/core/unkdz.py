@@ -22,7 +22,12 @@ from __future__ import print_function
 
 import os
 from binascii import b2a_hex
-from . import kdz
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from . import dz, kdz
+
+# Entries are copied with buffers of this size where copy_file_range is unavailable
+COPY_BUFFER_SIZE = 16 << 20
 
 
 # our tools are in "libexec"
@@ -35,10 +40,15 @@ class KDZFileTools(kdz.KDZFile):
 
     # Setup variables
     def __init__(self, kdzfile: str, outdir: str, extract_id: int = None, list_only: bool = False,
-                 extract_all: bool = False):
+                 extract_all: bool = False, skip_dz: bool = False, threads: int = None):
+        """
+        skip_dz leaves embedded DZ files inside the KDZ: pass dzEntries() to DZFileTools instead.
+        """
         super().__init__()
         self.partitions = []
         self.infile = None
+        self.skip_dz = skip_dz
+        self.threads = threads or cpu_count()
 
         self.kdz_header = {
             b'(\x05\x00\x0041%\x80': 0,
@@ -157,36 +167,47 @@ class KDZFileTools(kdz.KDZFile):
 
         currentPartition = self.partitions[index]
 
-        # Seek to the beginning of the compressed data in the specified partition
-        self.infile.seek(currentPartition['offset'], os.SEEK_SET)
-
         # Ensure that the output directory exists
-        if not os.path.exists(self.outdir):
-            os.makedirs(self.outdir)
-
-        # Open the new file for writing
-        outfile = open(os.path.join(self.outdir, currentPartition['name'].decode("utf8")), 'wb')
-
-        # Use 1024 byte chunks
-        chunkSize = 1024
-
-        # uncomment to prevent runaways
-        #for x in xrange(10):
-
-        while True:
-
-            # Read file in 1024 byte chunks
-            outfile.write(self.infile.read(chunkSize))
-
-            # If the output file + chunkSize would be larger than the input data
-            if outfile.tell() + chunkSize >= currentPartition['length']:
-                # Change the chunk size to be the difference between the length of the input and the current length of the output
-                outfile.write(self.infile.read(currentPartition['length'] - outfile.tell()))
-                # Prevent runaways!
-                break
-
-        # Close the file
-        outfile.close()
+        os.makedirs(self.outdir, exist_ok=True)
+
+        # Each call opens its own handles, so entries can be extracted concurrently
+        with open(self.kdzfile, 'rb') as infile, \
+                open(os.path.join(self.outdir, currentPartition['name'].decode("utf8")), 'wb') as outfile:
+            offset, length = currentPartition['offset'], currentPartition['length']
+            copied = 0
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while copied < length:
+                        count = os.copy_file_range(infile.fileno(), outfile.fileno(), length - copied,
+                                                   offset + copied)
+                        if not count:
+                            break
+                        copied += count
+                except OSError:
+                    # Unsupported across these filesystems, fall back to buffered copy for the rest
+                    pass
+            infile.seek(offset + copied)
+            outfile.seek(copied)
+            buffer = memoryview(bytearray(min(COPY_BUFFER_SIZE, max(length - copied, 1))))
+            while copied < length:
+                count = infile.readinto(buffer[:min(len(buffer), length - copied)])
+                if not count:
+                    break
+                outfile.write(buffer[:count])
+                copied += count
+        if copied != length:
+            print(f"[!] {currentPartition['name'].decode('utf8')}: KDZ ends {length - copied} bytes early")
+
+    def isDZ(self, index):
+        """Whether the entry is an embedded DZ file"""
+        self.infile.seek(self.partitions[index]['offset'], os.SEEK_SET)
+        return self.infile.read(len(dz.DZFile._dz_header)) == dz.DZFile._dz_header
+
+    def dzEntries(self):
+        """
+        (offset, length) of each DZ file embedded in the KDZ, so DZFileTools can read it in place
+        """
+        return [(x['offset'], x['length']) for i, x in enumerate(self.partitions) if self.isDZ(i)]
 
     def saveExtra(self):
         """Save the extra data that has appeared between headers&files"""
@@ -279,10 +300,17 @@ class KDZFileTools(kdz.KDZFile):
 
     def cmdExtractAll(self):
         print(f"[+] Extracting all partitions from v{self.header_type:d} file!\n")
+        indexes = []
         for part in enumerate(self.partList):
+            if self.skip_dz and self.isDZ(part[0]):
+                print("[+] Leaving " + part[1][0].decode("utf8") + " in place")
+                continue
             print("[+] Extracting " + part[1][0].decode("utf8") + " to " + os.path.join(self.outdir,
                                                                                         part[1][0].decode("utf8")))
-            self.extractPartition(part[0])
+            indexes.append(part[0])
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for future in [executor.submit(self.extractPartition, i) for i in indexes]:
+                future.result()
         self.saveExtra()
         self.saveParams()
 
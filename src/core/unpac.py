@@ -3,12 +3,24 @@
 # source from https://github.com/ilyakurdyukov/spreadtrum_flash/blob/main/unpac/unpac.c
 # rewritten to python by affggh
 import ctypes
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from io import SEEK_SET
-from os import makedirs
+from multiprocessing import cpu_count
+from os import makedirs, urandom
 from os.path import exists
 from os.path import join as path_join
 from enum import Enum
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Files are copied and checked in buffers of this size
+COPY_SIZE = 16 << 20
+
 
 class CommonStruct(ctypes.LittleEndianStructure):
     @property
@@ -84,7 +96,7 @@ class MODE(Enum):
     CHECK = 3
 
 
-def crc16(crc: int, src: bytes):
+def _crc16_bitwise(crc: int, src: bytes):
     for byte in src:
         crc ^= byte
         for _ in range(8):
@@ -92,6 +104,133 @@ def crc16(crc: int, src: bytes):
     return crc
 
 
+# CRC-16/ARC (reflected 0x8005), one entry per byte value
+CRC16_TABLE = [_crc16_bitwise(0, bytes([i])) for i in range(256)]
+# Rows of this many bytes are checksummed side by side by the vectorized engine
+CRC16_LANE = 1024
+
+
+def _crc16_table(crc: int, src: bytes):
+    table = CRC16_TABLE
+    for byte in src:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def _gf2_times(mat, vec: int):
+    s = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            s ^= mat[i]
+        vec >>= 1
+        i += 1
+    return s
+
+
+@lru_cache(maxsize=None)
+def _crc16_shift_tables(length: int):
+    """Tables for the state change of reading length zero bytes, by low and by high byte of the state."""
+    # Column i is what bit i of the state becomes after one zero byte, squared up to length
+    op = [(1 << i >> 8) ^ CRC16_TABLE[(1 << i) & 0xFF] for i in range(16)]
+    mat = [1 << i for i in range(16)]
+    while length:
+        if length & 1:
+            mat = [_gf2_times(op, mat[i]) for i in range(16)]
+        length >>= 1
+        op = [_gf2_times(op, op[i]) for i in range(16)]
+    return [_gf2_times(mat, b) for b in range(256)], [_gf2_times(mat, b << 8) for b in range(256)]
+
+
+def crc16_combine(crc1: int, crc2: int, len2: int):
+    """CRC of A + B from crc1, the CRC of A, and crc2, the CRC of B (of len2 bytes) started from 0."""
+    low, high = _crc16_shift_tables(len2)
+    return low[crc1 & 0xFF] ^ high[crc1 >> 8] ^ crc2
+
+
+@lru_cache(maxsize=None)
+def _crc16_word_table():
+    """State after two bytes, indexed by the state xor those bytes as a little endian word."""
+    table = CRC16_TABLE
+    words = []
+    for crc in range(0x10000):
+        crc = (crc >> 8) ^ table[crc & 0xFF]
+        words.append((crc >> 8) ^ table[crc & 0xFF])
+    return numpy.array(words, dtype=numpy.uint16)
+
+
+def _crc16_vector(crc: int, src: bytes):
+    # Rows are checksummed in parallel two bytes (a column) at a time, then chained together
+    rows = len(src) // CRC16_LANE
+    lanes = numpy.frombuffer(src, dtype='<u2', count=rows * CRC16_LANE // 2).reshape(rows, CRC16_LANE // 2)
+    lanes = numpy.ascontiguousarray(lanes.T)
+    table = _crc16_word_table()
+    crcs = numpy.zeros(rows, dtype=numpy.uint16)
+    for column in lanes:
+        crcs = table[crcs ^ column]
+    low, high = _crc16_shift_tables(CRC16_LANE)
+    for row_crc in crcs.tolist():
+        crc = low[crc & 0xFF] ^ high[crc >> 8] ^ row_crc
+    return _crc16_table(crc, src[rows * CRC16_LANE:])
+
+
+def crc16(crc: int, src: bytes):
+    if numpy is not None and len(src) >= CRC16_LANE * 64:
+        return _crc16_vector(crc, src)
+    return _crc16_table(crc, src)
+
+
+def crc16_file(image_path: str, start: int, end: int):
+    """CRC-16 of bytes start to end of a file, pieces are checksummed in parallel and combined."""
+    def piece_crc(offset, length):
+        data_crc = 0
+        with open(image_path, 'rb') as f:
+            f.seek(offset, SEEK_SET)
+            while length > 0:
+                buf = f.read(min(COPY_SIZE, length))
+                if not buf:
+                    break
+                data_crc = crc16(data_crc, buf)
+                length -= len(buf)
+        return data_crc
+
+    pieces = [(n, min(COPY_SIZE * 4, end - n)) for n in range(start, end, COPY_SIZE * 4)]
+    data_crc = 0
+    with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+        for (_, length), piece in zip(pieces, executor.map(lambda p: piece_crc(*p), pieces)):
+            data_crc = crc16_combine(data_crc, piece, length)
+    return data_crc
+
+
+def extract_file(image_path: str, out_path: str, offset: int, size: int, verify: bool = False):
+    """Copy size bytes at offset of the pac to out_path, returns their CRC-16 (from 0) when verify is set."""
+    data_crc = 0
+    with open(image_path, 'rb') as fi, open(out_path, 'wb') as fo:
+        fi.seek(offset, SEEK_SET)
+        while size > 0:
+            buf = fi.read(min(COPY_SIZE, size))
+            if not buf:
+                break
+            fo.write(buf)
+            if verify:
+                data_crc = crc16(data_crc, buf)
+            size -= len(buf)
+    return data_crc if verify else None
+
+
+def benchmark_crc16(size: int = 64 << 20):
+    """Print the throughput of each CRC-16 engine on random data."""
+    data = urandom(size)
+    engines = [("bitwise", _crc16_bitwise, size >> 8), ("table", _crc16_table, size >> 4)]
+    if numpy is not None:
+        engines.append(("vector", _crc16_vector, size))
+    for name, engine, length in engines:
+        start = time.perf_counter()
+        engine(0, data[:length])
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        print("%s: %.1f MiB/s" % (name, length / elapsed / (1 << 20)))
+
+
 def check_path(path):
     invalid_str = ["/", "\\", ":"]
     for s in invalid_str:
@@ -100,11 +239,12 @@ def check_path(path):
     return True
 
 
-def unpac(image_path: str, out_dir: str, mode: MODE = MODE.LIST):
+def unpac(image_path: str, out_dir: str, mode: MODE = MODE.LIST, verify: bool = False):
+    """verify with MODE.EXTRACT also checks data_crc, from the same reads as the extraction."""
     if not exists(out_dir):
         makedirs(out_dir, exist_ok=True)
-    chunk = 0x1000
     head = SprdHead()
+    files = []
     # file = sprd_file()
 
     with open(image_path, "rb") as fi:
@@ -170,42 +310,56 @@ def unpac(image_path: str, out_dir: str, mode: MODE = MODE.LIST):
                     file_name = convert_u16_to_string(file.name).strip("\0")
                     print(file_name)
 
-                    fi.seek(file.pac_offset, SEEK_SET)
                     if not check_path(file_name):
                         print("!!! unsafe filename detected!")
                         continue
 
-                    with open(path_join(out_dir, file_name), 'wb') as fo:
-                        l = file.size
-                        for n in range(0, l, chunk):
-                            buf = fi.read(chunk if l - n > chunk else l - n)
-                            fo.write(buf)
-
-                    fi.seek(len(head) + (i + 1) * len(file), SEEK_SET)
-
-        elif mode == MODE.CHECK:
+                    files.append((file_name, file.pac_offset, file.size))
+
+    if mode == MODE.EXTRACT:
+        # Each file is copied by its own worker with its own handle
+        with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+            crcs = list(executor.map(
+                lambda f: extract_file(image_path, path_join(out_dir, f[0]), f[1], f[2], verify), files))
+        if not verify:
+            return
+        # data_crc covers everything after the head, the parts no file was read from are checksummed here
+        l = head.pac_size
+        n = len(head)
+        data_crc = 0
+        for (_, offset, size), file_crc in sorted(zip(files, crcs), key=lambda f: f[0][1]):
+            if offset < n or offset + size > l:
+                # Overlapping or out of range files, check the whole pac instead
+                data_crc = crc16_file(image_path, len(head), l)
+                break
+            data_crc = crc16_combine(data_crc, crc16_file(image_path, n, offset), offset - n)
+            data_crc = crc16_combine(data_crc, file_crc, size)
+            n = offset + size
+        else:
+            data_crc = crc16_combine(data_crc, crc16_file(image_path, n, l), l - n)
+
+    if mode == MODE.CHECK or (mode == MODE.EXTRACT and verify):
+        if mode == MODE.CHECK:
             l = head.pac_size
-            data_crc = 0
             n = head._size
 
             if l < n:
                 raise Exception("unexpected pac size")
-            for n in range(0, l, chunk):
-                buf = fi.read(chunk if l - n > chunk else l - n)
-                data_crc = crc16(data_crc, buf)
+            data_crc = crc16_file(image_path, n, l)
 
-            print("data_crc: 0x%04x" % head.data_crc)
-            if head.data_crc != data_crc:
-                print("(ecpected 0x%04x)" % data_crc)
+        print("data_crc: 0x%04x" % head.data_crc)
+        if head.data_crc != data_crc:
+            print("(ecpected 0x%04x)" % data_crc)
 
 
 if __name__ == '__main__':
     import argparse
 
-    parser = argparse.ArgumentParser(prog="unpac", usage="<list|extract|check> -d out pac_file")
+    parser = argparse.ArgumentParser(prog="unpac", usage="<list|extract|check|bench> [-v] -d out pac_file")
     parser.add_argument("command")
     parser.add_argument("-d,--dir", metavar="outdir", dest="outdir")
-    parser.add_argument("pac_file")
+    parser.add_argument("-v,--verify", action="store_true", dest="verify", help="check data_crc while extracting")
+    parser.add_argument("pac_file", nargs="?")
 
     args = parser.parse_args()
 
@@ -218,7 +372,10 @@ if __name__ == '__main__':
 
     mode = MODE.NONE
 
-    if command == "list":
+    if command == "bench":
+        benchmark_crc16()
+        raise SystemExit(0)
+    elif command == "list":
         mode = MODE.LIST
     elif command == "check":
         mode = MODE.CHECK
@@ -230,4 +387,4 @@ if __name__ == '__main__':
     if not exists(outdir):
         makedirs(outdir)
 
-    unpac(pac_file, outdir, mode)
+    unpac(pac_file, outdir, mode, args.verify)
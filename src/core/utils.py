@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import hashlib
+import io
 import json
 import logging
 import os
@@ -30,6 +31,7 @@ import traceback
 import zipfile
 from difflib import SequenceMatcher
 from enum import IntEnum
+import lzma
 from lzma import LZMADecompressor
 from os import getcwd, cpu_count
 from os.path import exists
@@ -38,10 +40,19 @@ from shutil import rmtree
 from subprocess import Popen
 from threading import Thread
 
+import zstandard
+
 from src.core import blockimgdiff
+from src.core import ext4
 from src.core import sparse_img
 from src.core import update_metadata_pb2 as um
 from src.core.lpunpack import SparseImage
+from src.core.rangelib import RangeSet
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 DataImage = blockimgdiff.DataImage
 
@@ -242,17 +253,155 @@ class Unxz:
                     raw = b''
 
 
+class ChainedReader(io.RawIOBase):
+    """Read several streams back to back as one, e.g. segmented *.new.dat.N files."""
+
+    def __init__(self, streams: list):
+        super().__init__()
+        self._streams = list(streams)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._streams:
+            count = self._streams[0].readinto(b)
+            if count:
+                return count
+            self._streams.pop(0).close()
+        return 0
+
+    def close(self):
+        for stream in self._streams:
+            stream.close()
+        self._streams.clear()
+        super().close()
+
+
+class _BrotliReader(io.RawIOBase):
+    """A .br file decompressed as it is read, at most out_limit bytes of output per step."""
+
+    def __init__(self, file_path: str, buff_size: int = 65536, out_limit: int = 4 * 1024 * 1024):
+        super().__init__()
+        self._fd = open(file_path, 'rb')
+        self._dec = brotli.Decompressor()
+        self._buff_size = buff_size
+        self._out_limit = out_limit
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            # Input is only taken once the output of the previous one has been drained
+            if self._dec.can_accept_more_data():
+                raw = self._fd.read(self._buff_size)
+                if not raw:
+                    return 0
+            else:
+                raw = b''
+            self._pending = memoryview(self._dec.process(raw, output_buffer_limit=self._out_limit))
+        count = min(len(b), len(self._pending))
+        b[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+    def close(self):
+        self._fd.close()
+        super().close()
+
+
+class _PipeReader(io.RawIOBase):
+    """Stdout of a decompressing tool, so nothing is written to disk."""
+
+    def __init__(self, cmd: list):
+        super().__init__()
+        conf = subprocess.CREATE_NO_WINDOW if os.name != 'posix' else 0
+        self._proc = Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, creationflags=conf)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._proc.stdout.readinto(b)
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.stdout.close()
+            self._proc.wait()
+        super().close()
+
+
+def open_compressed(file_path: str):
+    """
+    Open a .br, .xz or .zst file (anything else as is) as a stream of its decompressed contents.
+    Brotli needs a module with bounded output (brotli >= 1.2), else the brotli tool is piped.
+    """
+    if file_path.endswith('.br'):
+        if brotli is not None and hasattr(brotli.Decompressor, 'can_accept_more_data'):
+            return _BrotliReader(file_path)
+        return _PipeReader([f'{tool_bin}brotli', '-dc', file_path])
+    if file_path.endswith('.xz'):
+        return lzma.open(file_path, 'rb')
+    if file_path.endswith('.zst'):
+        return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+    return open(file_path, 'rb')
+
+
+def unbrotli(file_path: str, remove_src: bool = True):
+    """Decompress name.br to name, like brotli -dj."""
+    out_file = file_path.rsplit('.br', 1)[0]
+    try:
+        with open_compressed(file_path) as src, open(out_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+    except Exception:
+        traceback.print_exc()
+        if exists(out_file):
+            os.remove(out_file)
+        return
+    if remove_src:
+        os.remove(file_path)
+
+
+def open_new_data(work: str, name: str):
+    """
+    Open {name}.new.dat (plain, .br, .xz or .zst, followed by any .new.dat.N segments) as one stream.
+    Return (stream, source files), or (None, []) if there is no new.dat.
+    """
+    base = os.path.join(work, f'{name}.new.dat')
+    streams, files = [], []
+    for first in (f'{base}.br', f'{base}.xz', f'{base}.zst', base):
+        if exists(first):
+            files.append(first)
+            streams.append(open_compressed(first))
+            break
+    for n in range(100):
+        if exists(f'{base}.{n}'):
+            files.append(f'{base}.{n}')
+            streams.append(open(f'{base}.{n}', 'rb'))
+    if not streams:
+        return None, []
+    # A lone plain file stays a real file so Sdat2img can use copy_file_range.
+    return (streams[0] if len(streams) == 1 else ChainedReader(streams)), files
+
+
 class Sdat2img:
-    def __init__(self, transfer_list_file, new_data_file, output_image_file):
-        print('sdat2img binary - version: 1.3\n')
+    # Whole ranges are copied with buffers of this size (or copy_file_range where available).
+    copy_buffer_size = 16 * 1024 * 1024
+
+    def __init__(self, transfer_list_file, new_data_file, output_image_file, block_size: int = 4096):
+        """new_data_file is a path or an already opened (possibly decompressing) binary stream."""
+        print('sdat2img binary - version: 1.4\n')
+        self.complete = False
         self.transfer_list_file = transfer_list_file
         self.new_data_file = new_data_file
         self.output_image_file = output_image_file
+        self.block_size = block_size
         self.list_file = self.parse_transfer_list_file()
-        block_size = 4096
         version: int = next(self.list_file)
         self.version: int = version
-        next(self.list_file)
+        self.new_blocks: int = next(self.list_file)
         versions = {
             1: "Lollipop 5.0",
             2: "Lollipop 5.1",
@@ -260,6 +409,8 @@ class Sdat2img:
             4: "Nougat 7.x / Oreo 8.x / Pie 9.x",
         }
         print("Android {} detected!\n".format(versions.get(version, f'Unknown version {version}!\n')))
+        self.commands = list(self.list_file)
+        self.verify_block_total()
         # Don't clobber existing files to avoid accidental data loss
         try:
             output_img = open(self.output_image_file, 'wb')
@@ -271,31 +422,99 @@ class Sdat2img:
             else:
                 print(e)
                 return
+        if isinstance(self.new_data_file, (str, os.PathLike)):
+            with output_img, open(self.new_data_file, 'rb') as new_data:
+                self.convert(new_data, output_img)
+        else:
+            with output_img:
+                self.convert(self.new_data_file, output_img)
+        if self.complete:
+            print(f'Done! Output image: {os.path.realpath(output_img.name)}')
 
-        new_data_file = open(self.new_data_file, 'rb')
-        max_file_size = 0
-
-        for cmd, block_list in self.list_file:
-            max_file_size = max(pair[1] for pair in block_list) * block_size
-            for begin, block_all in block_list:
-                block_count = block_all - begin
-                print(f'Copying {block_count} blocks into position {begin}...')
-
-                # Position output file
-                output_img.seek(begin * block_size)
-
-                # Copy one block at a time
-                while block_count > 0:
-                    output_img.write(new_data_file.read(block_size))
-                    block_count -= 1
-
-        # Make file larger if necessary
-        if output_img.tell() < max_file_size:
-            output_img.truncate(max_file_size)
+    def verify_block_total(self) -> bool:
+        """
+        The second line of the transfer list declares how many blocks the commands write.
+        Generators also count e.g. identity moves in it, so like the device updater a mismatch is only a warning.
+        """
+        new_total = sum(end - begin for cmd, ranges in self.commands if cmd == 'new' for begin, end in ranges)
+        zero_total = sum(end - begin for cmd, ranges in self.commands if cmd == 'zero' for begin, end in ranges)
+        if self.new_blocks not in (new_total, new_total + zero_total):
+            print(f'Warning: transfer list declares {self.new_blocks} blocks, but its commands write '
+                  f'{new_total + zero_total} ({new_total} new, {zero_total} zero)')
+            return False
+        return True
 
-        output_img.close()
-        new_data_file.close()
-        print(f'Done! Output image: {os.path.realpath(output_img.name)}')
+    def convert(self, new_data, output_img):
+        """
+        Write every command of the transfer list into output_img.
+        new_data is read sequentially; zero and erase ranges are left as holes of the preallocated image.
+        """
+        block_size = self.block_size
+        if not self.commands:
+            self.complete = True
+            return
+        max_file_size = max(end for _, ranges in self.commands for _, end in ranges) * block_size
+        # Preallocate; on most filesystems this leaves a sparse file, so untouched ranges cost nothing.
+        output_img.truncate(max_file_size)
+        written = RangeSet()
+        pending = []
+        for cmd, ranges in self.commands:
+            if cmd == 'new':
+                for begin, end in ranges:
+                    copied = self._copy_range(new_data, output_img, begin * block_size, (end - begin) * block_size)
+                    if copied != (end - begin) * block_size:
+                        print(f'Error: {getattr(new_data, "name", "new.dat")} ended early, block {begin + copied // block_size} '
+                              f'of range {begin}-{end} is missing')
+                        return
+                    pending.extend((begin, end))
+            else:
+                # Blocks are still zero unless an earlier command in this list wrote them.
+                if pending:
+                    written = written.union(RangeSet(data=pending))
+                    pending = []
+                overlap = RangeSet(data=[i for pair in ranges for i in pair]).intersect(written)
+                zeros = memoryview(bytes(min(self.copy_buffer_size, overlap.size() * block_size)))
+                for begin, end in overlap:
+                    output_img.seek(begin * block_size)
+                    remaining = (end - begin) * block_size
+                    while remaining:
+                        count = min(remaining, len(zeros))
+                        output_img.write(zeros[:count])
+                        remaining -= count
+        print(f'Copied {sum(end - begin for cmd, ranges in self.commands if cmd == "new" for begin, end in ranges)} '
+              f'blocks in {sum(len(ranges) for cmd, ranges in self.commands if cmd == "new")} ranges.')
+        self.complete = True
+
+    def _copy_range(self, src, dst, offset: int, length: int) -> int:
+        """Copy length bytes from the current position of src to offset in dst, return bytes copied."""
+        copied = 0
+        # Only plain seekable files qualify: decompressors such as LZMAFile also expose the fileno of their input.
+        if hasattr(os, 'copy_file_range') and isinstance(getattr(src, 'raw', src), io.FileIO) and src.seekable():
+            position = src.tell()
+            dst.flush()
+            try:
+                while copied < length:
+                    count = os.copy_file_range(src.fileno(), dst.fileno(), length - copied, position + copied,
+                                               offset + copied)
+                    if not count:
+                        break
+                    copied += count
+            except OSError:
+                # Unsupported across these filesystems, fall back to buffered copy for the rest.
+                pass
+            src.seek(position + copied)
+            if copied == length:
+                return copied
+        dst.seek(offset + copied)
+        buffer = bytearray(min(self.copy_buffer_size, length - copied))
+        view = memoryview(buffer)
+        while copied < length:
+            count = src.readinto(view[:min(len(buffer), length - copied)])
+            if not count:
+                break
+            dst.write(view[:count])
+            copied += count
+        return copied
 
     @staticmethod
     def rangeset(src):
@@ -322,13 +541,9 @@ class Sdat2img:
             for line in trans_list:
                 line = line.split(' ')
                 cmd = line[0]
-                if cmd == 'new':
-                    # if cmd in ['erase', 'new', 'zero']:
+                if cmd in ['erase', 'new', 'zero']:
                     yield [cmd, self.rangeset(line[1])]
                 else:
-                    if cmd in ['erase', 'new', 'zero']:
-                        print(f'Skipping command {cmd}...')
-                        continue
                     # Skip lines starting with numbers, they are not commands anyway
                     if not cmd[0].isdigit():
                         print(f'Command "{cmd}" is not valid.')
@@ -540,7 +755,79 @@ def simg2img(path: str):
         print(e)
 
 
-def img2sdat(input_image, out_dir='.', version=None, prefix='system'):
+def ext4_block_map(input_image) -> str | None:
+    """
+    Write the per-file block map of an ext4 image (raw or sparse) next to it as <name>.map,
+    in the format SparseImage.LoadFileBlockMap reads, so BlockImageDiff can match files.
+    The map's first line records the size and mtime of the image it was built from; it is
+    reused only while they still match, so a stale or foreign map is rebuilt.
+    :return: the map path, or None if the image is not a 4K-block ext4 filesystem
+    """
+    map_file = os.path.splitext(input_image)[0] + '.map'
+    st = os.stat(input_image)
+    stamp = f"# image {st.st_size} {st.st_mtime_ns}\n"
+    if os.path.isfile(map_file):
+        with open(map_file, 'r', encoding='utf-8', newline='\n') as f:
+            if f.readline() == stamp:
+                return map_file
+    image = None
+    try:
+        if gettype(input_image) == 'sparse':
+            image = sparse_img.SparseImage(input_image)
+            stream = io.BufferedReader(sparse_img.SparseReader(image), 1024 * 1024)
+            care_map = image.care_map
+            blocksize = image.blocksize
+        else:
+            stream = open(input_image, 'rb')
+            blocksize = 4096
+            care_map = RangeSet(data=(0, (os.path.getsize(input_image) + blocksize - 1) // blocksize))
+        with stream:
+            volume = ext4.Volume(stream)
+            if volume.block_size != blocksize:
+                return None
+            files = []
+            for path, inode in volume.walk_files():
+                # The map is whitespace separated; such files stay in the __NONZERO groups.
+                if any(c.isspace() for c in path):
+                    continue
+                # Keep the extents in file order, LoadFileBlockMap derives `monotonic` from it.
+                pieces = [RangeSet(data=(start, start + count)).intersect(care_map)
+                          for start, count in inode.block_ranges()]
+                pieces = [p for p in pieces if p]
+                if pieces:
+                    files.append((path, pieces))
+    except (ext4.Ext4Error, ValueError, OSError):
+        return None
+    finally:
+        if image:
+            image.simg_f.close()
+
+    # Block 0 is always clobbered. Blocks shared between files (e2fsdroid -c) go to the first owner.
+    spans = sorted((s, e) for _, pieces in files for piece in pieces for s, e in piece)
+    shared = any(s < prev_end for (_, prev_end), (s, _) in zip(spans, spans[1:]))
+    claimed = RangeSet(data=(0, 1))
+    lines = []
+    for path, pieces in files:
+        tokens = []
+        for piece in pieces:
+            if shared or piece.overlaps(claimed):
+                piece = piece.subtract(claimed)
+            tokens.extend(str(s) if e == s + 1 else f'{s}-{e - 1}' for s, e in piece)
+            if shared:
+                claimed = claimed.union(piece)
+        if tokens:
+            lines.append(f"{path} {' '.join(tokens)}\n")
+    with open(map_file + '.tmp', 'w', encoding='utf-8', newline='\n') as f:
+        f.write(stamp)
+        f.writelines(lines)
+    os.replace(map_file + '.tmp', map_file)
+    print(f"Block map: {len(lines)} files -> {map_file}")
+    return map_file
+
+
+def img2sdat(input_image, out_dir='.', version=None, prefix='system', brotli_quality=None):
+    """input_image may be sparse or raw.
+    With brotli_quality set, {prefix}.new.dat.br is written directly instead of {prefix}.new.dat."""
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
     versions = {
@@ -551,8 +838,16 @@ def img2sdat(input_image, out_dir='.', version=None, prefix='system'):
     if version not in versions.keys():
         version = 4
     print(f"Img2sdat(1.7):{versions[version]}")
-    blockimgdiff.BlockImageDiff(sparse_img.SparseImage(input_image, tempfile.mkstemp()[1], '0'), None, version).Compute(
-        f'{out_dir}/{prefix}')
+    # With a per-file map, files are diffed and stored individually instead of in __NONZERO groups.
+    file_map_fn = ext4_block_map(input_image)
+    if gettype(input_image) == 'sparse':
+        image = sparse_img.SparseImage(input_image, file_map_fn or tempfile.mkstemp()[1], '0')
+    else:
+        # Raw images are read in place; no img2simg round-trip is needed.
+        image = sparse_img.RawImage(input_image, '0', file_map_fn=file_map_fn)
+    blockimgdiff.BlockImageDiff(image, None, version,
+                                tool_path_resolver=lambda name: f'{tool_bin}{name}',
+                                brotli_quality=brotli_quality).Compute(f'{out_dir}/{prefix}')
 
 
 def findfile(file, dir_) -> str:
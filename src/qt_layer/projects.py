@@ -16,7 +16,8 @@ import extra
 import fspatch
 import tarsafe
 from qt_layer.log_box import LogMessageBoxBase
-from src.core.cpio import repack as cpio_repack
+from src.core.cpio import repack as cpio_repack, COMPRESSIONS as CPIO_COMPRESSIONS
+from src.core import lpmake
 from src.core.rsceutil import repack as rsceutil_repack
 from src.core.splash_editor.main import splash_repack
 from src.core.unpac import MODE as PACMODE
@@ -39,7 +40,7 @@ from unpac import unpac
 if os.name == 'nt':
     from ctypes import windll
 from shutil import rmtree
-from src.core.cpio import extract as cpio_extract
+from src.core.cpio import extract as cpio_extract, detect_compression as cpio_compression
 from src.core.rsceutil import unpack as rsceutil_unpack
 
 from PySide6.QtCore import Qt, QThread, Signal, QObject
@@ -234,7 +235,8 @@ def unpack_boot(name: str = 'boot', boot: str | None = None, work: str | None =
         print(f"Ramdisk is {comp}")
         with open(f"{work}/{name}/comp", "w", encoding='utf-8') as f:
             f.write(comp)
-        if comp != "unknown":
+        # The python cpio reads most compressed ramdisks as they are
+        if comp != "unknown" and not (cfg.cpioImpl.value == 'Python' and cpio_compression(f"{work}/{name}/ramdisk.cpio")):
             os.rename(f"{work}/{name}/ramdisk.cpio", f"{work}/{name}/ramdisk.cpio.comp")
             if call(["magiskboot", "decompress", f'{work}/{name}/ramdisk.cpio.comp',
                      f'{work}/{name}/ramdisk.cpio']) != 0:
@@ -459,14 +461,11 @@ class ProjectsPage(QWidget):
             cfg.set(cfg.currentProjectName, os.path.splitext(os.path.basename(ifile))[0])
             if not project_manger.exist():
                 utils.re_folder(project_manger.current_work_path())
-            KDZFileTools(ifile, project_manger.current_work_path(), extract_all=True)
-            for i in os.listdir(project_manger.current_work_path()):
-                file = project_manger.current_work_path() + os.sep + i
-                if not os.path.isfile(file):
-                    continue
-                if i.endswith('.dz') and gettype(file) == 'dz':
-                    DZFileTools(file, project_manger.current_work_path(),
-                                extract_all=True)
+            # Embedded DZ files are unpacked straight from the KDZ, without an intermediate .dz copy
+            kdz = KDZFileTools(ifile, project_manger.current_work_path(), extract_all=True, skip_dz=True)
+            for offset, length in kdz.dzEntries():
+                DZFileTools(ifile, project_manger.current_work_path(),
+                            extract_all=True, offset=offset, length=length)
             return
         # ofp
         if os.path.splitext(ifile)[1] == '.ofp':
@@ -866,7 +865,7 @@ class ProjectsPage(QWidget):
                 if src_format == 'br':
                     if os.access(f'{work}/{i}', os.F_OK):
                         print("正在解包：" + i)
-                        call(['brotli', '-dj', f'{work}/{i}'])
+                        utils.unbrotli(f'{work}/{i}')
                 if src_format == 'xz':
                     if os.access(f'{work}/{i}', os.F_OK):
                         print("正在解包：" + i)
@@ -877,8 +876,17 @@ class ProjectsPage(QWidget):
                         transferfile = os.path.abspath(
                             os.path.dirname(work)) + f"/{basename}.transfer.list"
                         if os.access(transferfile, os.F_OK) and os.path.getsize(f'{work}/{i}') != 0:
-                            utils.Sdat2img(transferfile, f'{work}/{i}', f"{work}/{basename}.img")
-                            if os.access(f"{work}/{basename}.img", os.F_OK):
+                            try:
+                                sdat = utils.Sdat2img(transferfile, f'{work}/{i}', f"{work}/{basename}.img")
+                            except (Exception, BaseException):
+                                logging.exception('Bugs')
+                                sdat = None
+                            # The image is preallocated, so it exists even after a short read;
+                            # only a complete conversion may replace the sources.
+                            if not (sdat and sdat.complete) and os.path.exists(f"{work}/{basename}.img"):
+                                print("File May Not Extracted.")
+                                os.remove(f"{work}/{basename}.img")
+                            if sdat and sdat.complete:
                                 os.remove(f'{work}/{i}')
                                 os.remove(transferfile)
                                 try:
@@ -894,26 +902,23 @@ class ProjectsPage(QWidget):
                         utils.img2simg(f'{work}/{basename}.img')
             elif dst_format == 'raw':
                 basename = os.path.basename(i).split('.')[0]
-                if src_format == 'br':
-                    if os.access(f'{work}/{i}', os.F_OK):
-                        print("正在解包：" + i)
-                        call(['brotli', '-dj', f'{work}/{i}'])
-                if src_format == 'xz':
-                    if os.access(f'{work}/{i}', os.F_OK):
-                        print("正在解包：" + i)
-                        utils.Unxz(f'{work}/{i}')
                 if src_format in ['dat', 'br', 'xz']:
                     if os.path.exists(work):
-                        if src_format == 'br':
-                            i = i.replace('.br', '')
-                        if src_format == 'xz':
-                            i = i.replace('.xz', '')
                         print("正在解包：" + f'{work}/{i}')
                         transferfile = os.path.abspath(
                             os.path.dirname(work)) + f"/{basename}.transfer.list"
                         if os.access(transferfile, os.F_OK) and os.path.getsize(f'{work}/{i}') != 0:
-                            utils.Sdat2img(transferfile, f'{work}/{i}', f"{work}/{basename}.img")
-                            if os.access(f"{work}/{basename}.img", os.F_OK):
+                            # .br and .xz are decompressed on the fly, no intermediate new.dat
+                            try:
+                                with utils.open_compressed(f'{work}/{i}') as new_data:
+                                    sdat = utils.Sdat2img(transferfile, new_data, f"{work}/{basename}.img")
+                            except (Exception, BaseException):
+                                logging.exception('Bugs')
+                                sdat = None
+                            if not (sdat and sdat.complete) and os.path.exists(f"{work}/{basename}.img"):
+                                print("File May Not Extracted.")
+                                os.remove(f"{work}/{basename}.img")
+                            if sdat and sdat.complete:
                                 try:
                                     os.remove(f'{work}/{i}')
                                     os.remove(transferfile)
@@ -926,20 +931,16 @@ class ProjectsPage(QWidget):
                 if src_format == 'sparse':
                     utils.simg2img(f'{work}/{i}')
             elif dst_format == 'dat':
-                if src_format == 'raw':
-                    utils.img2simg(f'{work}/{i}')
                 if src_format in ['raw', 'sparse']:
                     self.datbr(work, os.path.basename(i).split('.')[0], "dat")
                 if src_format == 'br':
                     print("正在解包：" + i)
-                    call(['brotli', '-dj', f'{work}/{i}'])
+                    utils.unbrotli(f'{work}/{i}')
                 if src_format == 'xz':
                     print("正在解包：" + i)
                     utils.Unxz(f'{work}/{i}')
 
             elif dst_format == 'br':
-                if src_format == 'raw':
-                    utils.img2simg(f'{work}/{i}')
                 if src_format in ['raw', 'sparse']:
                     self.datbr(work, os.path.basename(i).split('.')[0], 0)
                 if src_format in ['dat', 'xz']:
@@ -978,14 +979,13 @@ class ProjectsPage(QWidget):
                 dialog.type_group.checkedId(),
                 dialog.get_selected_items(),
                 dialog.switch_delete.isChecked(),
-                0, "none" if dialog.attrib_group.checkedId() else "readonly",None, None,dialog._block_device_name
+                "none" if dialog.attrib_group.checkedId() else "readonly",None, None,dialog._block_device_name
             )
             self.start_job(self.pack_super_task)
 
     def pack_super_exec(self, sparse: bool,
                         group_name: str, size: int,
                         super_type, part_list: list, del_: bool = False,
-                   return_cmd=0,
                    attrib='readonly',
                    output_dir: str = None, work: str = None, block_device_name: str = 'None'):
         if not block_device_name:
@@ -1007,46 +1007,23 @@ class ProjectsPage(QWidget):
                     os.rename(f'{work}/{part}_a.img', f'{work}/{part}.img')
                 except:
                     logging.exception('Bugs')
-        command = ['lpmake', '--metadata-size', '65536', '-super-name', block_device_name, '-metadata-slots']
-        if super_type == 1:
-            command += ['2', '-device', f'{block_device_name}:{size}', "--group", f"{group_name}:{size}"]
-            for part in part_list:
-                command += ['--partition', f"{part}:{attrib}:{os.path.getsize(f'{work}/{part}.img')}:{group_name}",
-                            '--image', f'{part}={work}/{part}.img']
-        else:
-            command += ["3", '-device', f'super:{size}', '--group', f"{group_name}_a:{size}"]
-            for part in part_list:
-                command += ['--partition',
-                            f"{part}_a:{attrib}:{os.path.getsize(f'{work}/{part}.img')}:{group_name}_a",
-                            '--image', f'{part}_a={work + part}.img']
-            command += ["--group", f"{group_name}_b:{size}"]
-            for part in part_list:
-                if not os.path.exists(f"{work + part}_b.img"):
-                    command += ['--partition', f"{part}_b:{attrib}:0:{group_name}_b"]
-                else:
-                    command += ['--partition',
-                                f"{part}_b:{attrib}:{os.path.getsize(f'{work}/{part}_b.img')}:{group_name}_b",
-                                '--image', f'{part}_b={work}/{part}_b.img']
-            if super_type == 2:
-                command += ["--virtual-ab"]
-        if sparse: command += ["--sparse"]
         output_super_path = f'{output_dir}/super.img'
-        command += ['--out', output_super_path]
-        if return_cmd == 1:
-            return command
-        if call(command, debug_binary=False) == 0:
-            if os.access(output_super_path, os.F_OK):
-                print("打包成功！输出：%s" % output_super_path)
-                if del_:
-                    for img in part_list:
-                        if os.path.exists(f"{work}/{img}.img"):
-                            try:
-                                os.remove(f"{work}/{img}.img")
-                            except Exception:
-                                logging.exception('Bugs')
-            else:
-                print("很抱歉，打包失败！")
+        try:
+            lpmake.build_super(output_super_path, work, part_list, group_name, size, super_type, attrib,
+                               block_device_name, sparse)
+        except (lpmake.LpMakeError, OSError):
+            logging.exception('Bugs')
+            print("很抱歉，打包失败！")
             return 1
+        if os.access(output_super_path, os.F_OK):
+            print("打包成功！输出：%s" % output_super_path)
+            if del_:
+                for img in part_list:
+                    if os.path.exists(f"{work}/{img}.img"):
+                        try:
+                            os.remove(f"{work}/{img}.img")
+                        except Exception:
+                            logging.exception('Bugs')
         else:
             print("很抱歉，打包失败！")
             return 1
@@ -1143,25 +1120,22 @@ class ProjectsPage(QWidget):
         if not os.path.exists(f"{work}/{name}.img"):
             print(f"{work}/{name}.img is not exist")
             return
-        else:
-            utils.img2sdat(f"{work}/{name}.img", work, dat_ver, name)
-        if os.access(f"{work}/{name}.new.dat", os.F_OK):
+        if brl != "dat":
+            print(f"Packing {name} to br")
+        # The brotli stream is produced in the same pass as new.dat, nothing uncompressed touches the disk.
+        utils.img2sdat(f"{work}/{name}.img", work, dat_ver, name, brotli_quality=None if brl == "dat" else int(brl))
+        if os.access(f"{work}/{name}.new.dat" if brl == "dat" else f"{work}/{name}.new.dat.br", os.F_OK):
             try:
                 os.remove(f"{work}/{name}.img")
             except Exception:
                 logging.exception('Bugs')
                 os.remove(f"{work}/{name}.img")
+            # The block map cached by img2sdat is useless without its image.
+            if os.path.exists(f"{work}/{name}.map"):
+                os.remove(f"{work}/{name}.map")
         if brl == "dat":
             print(f"Packing {name} to dat done")
         else:
-            print(f"Packing {name} to br")
-            call(['brotli', '-q', str(brl), '-j', '-w', '24', f"{work}/{name}.new.dat", '-o',
-                  f"{work}/{name}.new.dat.br"])
-            if os.access(f"{work}/{name}.new.dat", os.F_OK):
-                try:
-                    os.remove(f"{work}/{name}.new.dat")
-                except Exception:
-                    logging.exception('Bugs')
             print(f"Packing {name} to br done")
 
     def rdi(self, work: str, part_name: str) -> bool:
@@ -1322,8 +1296,13 @@ class ProjectsPage(QWidget):
             rsceutil_repack(f"{source}/second_dump", f"{source}/second", f"{source}/second_order")
             print("Repack Rk resource successfully...")
         if os.path.isdir(f"{source}/ramdisk"):
+            with open(f"{source}/comp", "r", encoding='utf-8') as compf:
+                comp = compf.read()
+            # The python cpio writes the compressed ramdisk itself, skipping magiskboot compress
+            direct = cfg.cpioImpl.value == 'Python' and comp in CPIO_COMPRESSIONS
             if cfg.cpioImpl.value == 'Python':
-                cpio_repack(f"{source}/ramdisk", f"{source}/ramdisk.txt", f"{source}/ramdisk-new.cpio")
+                cpio_repack(f"{source}/ramdisk", f"{source}/ramdisk.txt", f"{source}/ramdisk-new.cpio",
+                            compression=comp if direct else None)
             else:
                 cpio = os.path.join(cfg.tool_bin, 'cpio' if os.name != 'nt' else "cpio.exe")
                 cpio = os.path.realpath(cpio)
@@ -1332,11 +1311,9 @@ class ProjectsPage(QWidget):
 
                 os.chdir(f"{source}/ramdisk")
                 call(exe=["busybox", "ash", "-c", f"find | sed 1d | {cpio} -H newc -R 0:0 -o -F ../ramdisk-new.cpio"])
-            with open(f"{source}/comp", "r", encoding='utf-8') as compf:
-                comp = compf.read()
             print(f"Compressing:{comp}")
             os.chdir(source)
-            if comp != "unknown":
+            if comp != "unknown" and not direct:
                 if call(['magiskboot', f'compress={comp}', 'ramdisk-new.cpio']) != 0:
                     print("Failed to pack Ramdisk...")
                     os.remove("ramdisk-new.cpio")
@@ -1423,7 +1400,6 @@ class ProjectsPage(QWidget):
                             self.rdi(work, dname)
                         print("Packed successfully:{}".format(dname))
                         if format in ["dat", "br", "sparse"]:
-                            utils.img2simg(project_manger.current_work_output_path() + dname + ".img")
                             if format == 'dat':
                                 self.datbr(project_manger.current_work_output_path(), dname, "dat",
                                            int(parts_dict.get('dat_ver', 4)))
@@ -1431,6 +1407,7 @@ class ProjectsPage(QWidget):
                                 self.datbr(project_manger.current_work_output_path(), dname, scale,
                                            int(parts_dict.get('dat_ver', 4)))
                             else:
+                                utils.img2simg(project_manger.current_work_output_path() + dname + ".img")
                                 print("Packed successfully: {}!".format(dname))
                 elif parts_dict[dname] == 'f2fs':
                     if self.make_f2fs(dname, work=work, work_output=project_manger.current_work_output_path(),
@@ -1442,7 +1419,6 @@ class ProjectsPage(QWidget):
                             self.rdi(work, dname)
                         print("Packed successfully: {}!".format(dname))
                         if format in ["dat", "br", "sparse"]:
-                            utils.img2simg(project_manger.current_work_output_path() + dname + ".img")
                             if format == 'dat':
                                 self.datbr(project_manger.current_work_output_path(), dname, "dat",
                                            int(parts_dict.get('dat_ver', 4)))
@@ -1450,6 +1426,7 @@ class ProjectsPage(QWidget):
                                 self.datbr(project_manger.current_work_output_path(), dname, scale,
                                            int(parts_dict.get('dat_ver', 4)))
                             else:
+                                utils.img2simg(project_manger.current_work_output_path() + dname + ".img")
                                 print("Packed successfully: {}!".format(dname))
 
                 else:
@@ -1700,38 +1677,30 @@ class ProjectsPage(QWidget):
                 print(f"Decompressing {i}.zst")
                 utils.call(['zstd', '--rm', '-d', f"{work}/{i}.zst"])
                 return True
-            if os.access(f"{work}/{i}.new.dat.xz", os.F_OK):
-                print(f"Decompressing {i}.new.dat.xz")
-                utils.Unxz(f"{work}/{i}.new.dat.xz")
-            if os.access(f"{work}/{i}.new.dat.br", os.F_OK):
-                print(f"Decompressing  {i}.new.dat.br")
-                utils.call(['brotli', '-dj', f"{work}/{i}.new.dat.br"])
-            if os.access(f"{work}/{i}.new.dat.1", os.F_OK):
-                with open(f"{work}/{i}.new.dat", 'ab') as ofd:
-                    for n in range(100):
-                        if os.access(f"{work}/{i}.new.dat.{n}", os.F_OK):
-                            print("Merging %s to %s" % (f"{i}.new.dat.{n}", f"{i}.new.dat"))
-                            with open(f"{work}/{i}.new.dat.{n}", 'rb') as fd:
-                                ofd.write(fd.read())
-                            os.remove(f"{work}/{i}.new.dat.{n}")
-            if os.access(f"{work}/{i}.new.dat", os.F_OK):
-                print(f"Unpacking {work}/{i}.new.dat")
-                if os.path.getsize(f"{work}/{i}.new.dat") != 0:
-                    transferfile = f"{work}/{i}.transfer.list"
-                    if os.access(transferfile, os.F_OK):
-                        parts['dat_ver'] = utils.Sdat2img(transferfile, f"{work}/{i}.new.dat",
-                                                          f"{work}/{i}.img").version
-                        if os.access(f"{work}/{i}.img", os.F_OK):
-                            os.remove(f"{work}/{i}.new.dat")
-                            os.remove(transferfile)
-                            try:
-                                os.remove(f'{work}/{i}.patch.dat')
-                            except (Exception, BaseException):
-                                logging.exception('Bugs')
-                        else:
-                            print("File May Not Extracted.")
+            new_data, new_data_files = utils.open_new_data(work, i)
+            if new_data:
+                print(f"Unpacking {', '.join(os.path.basename(f) for f in new_data_files)}")
+                transferfile = f"{work}/{i}.transfer.list"
+                if os.access(transferfile, os.F_OK):
+                    try:
+                        with new_data:
+                            sdat = utils.Sdat2img(transferfile, new_data, f"{work}/{i}.img")
+                    except (Exception, BaseException):
+                        logging.exception('Bugs')
+                        sdat = None
+                    if sdat and sdat.complete:
+                        parts['dat_ver'] = sdat.version
+                        for file in new_data_files + [transferfile]:
+                            os.remove(file)
+                        try:
+                            os.remove(f'{work}/{i}.patch.dat')
+                        except (Exception, BaseException):
+                            logging.exception('Bugs')
                     else:
-                        print("transferfile's missing")
+                        print("File May Not Extracted.")
+                else:
+                    new_data.close()
+                    print("transferfile's missing")
             if os.access(f"{work}/{i}.img", os.F_OK):
                 try:
                     if i in parts:
@@ -1817,20 +1786,16 @@ class ProjectsPage(QWidget):
                     process_splashimg(os.path.join(project_manger.current_work_path(), f'{i}.img'),
                                       f"{work}/{i}/splash.png")
                 if file_type == 'gpt':
-                    reader = GPTReader(os.path.join(project_manger.current_work_path(), f'{i}.img'), sector_size=512)
+                    reader = GPTReader(os.path.join(project_manger.current_work_path(), f'{i}.img'))
+                    for problem in reader.partition_table.problems:
+                        print(f'[!] {problem}')
                     for partition in reader.partition_table.valid_entries():
                         print('guid/type={} first-block={} size={} name={}'.format(
                             partition.partition_type, partition.first_block, partition.length, partition.name))
-                        if True:
-                            file_base_name = partition.name if partition.name else str(partition.partition_id)
-
-                            out_file = os.path.join(work, f'{file_base_name}.img')
-                            print(f'Writing partition to file {out_file}')
-
-                            with open(out_file, 'wb+') as fout:
-                                for block in reader.block_reader.blocks_in_range(partition.first_block,
-                                                                                 partition.length):
-                                    fout.write(block)
+                    for out_file in reader.dump(work).values():
+                        print(f'Writing partition to file {out_file}')
+                    if reader.skipped:
+                        print(f"[!] Not in this image, skipped: {', '.join(reader.skipped)}")
 
                 if file_type == "erofs":
                     if utils.call(
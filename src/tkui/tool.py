@@ -73,7 +73,7 @@ from timeit import default_timer as dti
 start = dti()
 import zipfile
 from src.core.aml_image import main as aml_main
-from src.core.cpio import extract as cpio_extract, repack as cpio_repack
+from src.core.cpio import extract as cpio_extract, repack as cpio_repack, detect_compression as cpio_compression
 from io import BytesIO, StringIO
 from tkinter import (BOTH, LEFT, RIGHT, Canvas, Text, X, Y, BOTTOM, StringVar, IntVar, TOP, Toplevel,
                      HORIZONTAL, TclError, Frame, Label, DISABLED, Menu, BooleanVar, CENTER)
@@ -95,6 +95,7 @@ if os.name == 'nt':
     freeze_support()
 from src.core import imgextractor
 from src.core import lpunpack
+from src.core import lpmake
 from src.core import mkdtboimg
 from src.core import ozipdecrypt
 from src.core import splituapp
@@ -3455,7 +3456,7 @@ class PackSuper(Toplevel):
 
 
 @animation
-def pack_super(sparse: bool, group_name: str, size: int, super_type, part_list: list, del_: bool = False, return_cmd=0,
+def pack_super(sparse: bool, group_name: str, size: int, super_type, part_list: list, del_: bool = False,
                attrib='readonly',
                output_dir: str = None, work: str = None, block_device_name: str = 'None'):
     if not block_device_name:
@@ -3477,46 +3478,23 @@ def pack_super(sparse: bool, group_name: str, size: int, super_type, part_list:
                 os.rename(f'{work}/{part}_a.img', f'{work}/{part}.img')
             except:
                 logging.exception('Bugs')
-    command = ['lpmake', '--metadata-size', '65536', '-super-name', block_device_name, '-metadata-slots']
-    if super_type == 1:
-        command += ['2', '-device', f'{block_device_name}:{size}', "--group", f"{group_name}:{size}"]
-        for part in part_list:
-            command += ['--partition', f"{part}:{attrib}:{os.path.getsize(f'{work}/{part}.img')}:{group_name}",
-                        '--image', f'{part}={work}/{part}.img']
-    else:
-        command += ["3", '-device', f'super:{size}', '--group', f"{group_name}_a:{size}"]
-        for part in part_list:
-            command += ['--partition',
-                        f"{part}_a:{attrib}:{os.path.getsize(f'{work}/{part}.img')}:{group_name}_a",
-                        '--image', f'{part}_a={work + part}.img']
-        command += ["--group", f"{group_name}_b:{size}"]
-        for part in part_list:
-            if not os.path.exists(f"{work + part}_b.img"):
-                command += ['--partition', f"{part}_b:{attrib}:0:{group_name}_b"]
-            else:
-                command += ['--partition',
-                            f"{part}_b:{attrib}:{os.path.getsize(f'{work}/{part}_b.img')}:{group_name}_b",
-                            '--image', f'{part}_b={work}/{part}_b.img']
-        if super_type == 2:
-            command += ["--virtual-ab"]
-    if sparse: command += ["--sparse"]
     output_super_path = f'{output_dir}/super.img'
-    command += ['--out', output_super_path]
-    if return_cmd == 1:
-        return command
-    if call(command, debug_binary=states.development) == 0:
-        if os.access(output_super_path, os.F_OK):
-            print(lang.text59 % output_super_path)
-            if del_:
-                for img in part_list:
-                    if os.path.exists(f"{work}/{img}.img"):
-                        try:
-                            os.remove(f"{work}/{img}.img")
-                        except Exception:
-                            logging.exception('Bugs')
-        else:
-            win.message_pop(lang.warn10)
+    try:
+        lpmake.build_super(output_super_path, work, part_list, group_name, size, super_type, attrib,
+                           block_device_name, sparse)
+    except (lpmake.LpMakeError, OSError):
+        logging.exception('Bugs')
+        win.message_pop(lang.warn10)
         return 1
+    if os.access(output_super_path, os.F_OK):
+        print(lang.text59 % output_super_path)
+        if del_:
+            for img in part_list:
+                if os.path.exists(f"{work}/{img}.img"):
+                    try:
+                        os.remove(f"{work}/{img}.img")
+                    except Exception:
+                        logging.exception('Bugs')
     else:
         win.message_pop(lang.warn10)
         return 1
@@ -3632,7 +3610,8 @@ def unpack_boot(name: str = 'boot', boot: str | None = None, work: str | None =
         print(f"Ramdisk is {comp}")
         with open(f"{work}/{name}/comp", "w", encoding='utf-8') as f:
             f.write(comp)
-        if comp != "unknown":
+        # The python cpio reads most compressed ramdisks as they are
+        if comp != "unknown" and not (settings.cpio_impl == 'python' and cpio_compression(f"{work}/{name}/ramdisk.cpio")):
             os.rename(f"{work}/{name}/ramdisk.cpio", f"{work}/{name}/ramdisk.cpio.comp")
             if call(["magiskboot", "decompress", f'{work}/{name}/ramdisk.cpio.comp',
                      f'{work}/{name}/ramdisk.cpio']) != 0:
@@ -3975,14 +3954,11 @@ def unpackrom(ifile: str) -> None:
         current_project_name.set(os.path.splitext(os.path.basename(ifile))[0])
         if not project_manger.exist():
             re_folder(project_manger.current_work_path())
-        KDZFileTools(ifile, project_manger.current_work_path(), extract_all=True)
-        for i in os.listdir(project_manger.current_work_path()):
-            file = project_manger.current_work_path() + os.sep + i
-            if not os.path.isfile(file):
-                continue
-            if i.endswith('.dz') and gettype(file) == 'dz':
-                DZFileTools(file, project_manger.current_work_path(),
-                            extract_all=True)
+        # Embedded DZ files are unpacked straight from the KDZ, without an intermediate .dz copy
+        kdz = KDZFileTools(ifile, project_manger.current_work_path(), extract_all=True, skip_dz=True)
+        for offset, length in kdz.dzEntries():
+            DZFileTools(ifile, project_manger.current_work_path(),
+                        extract_all=True, offset=offset, length=length)
         return
     # ofp
     if os.path.splitext(ifile)[1] == '.ofp':
@@ -4185,24 +4161,22 @@ def datbr(work: str, name: str, brl: str | int, dat_ver: int = 4):
     if not os.path.exists(f"{work}/{name}.img"):
         print(f"{work}/{name}.img" + lang.text84)
         return
-    else:
-        utils.img2sdat(f"{work}/{name}.img", work, dat_ver, name)
-    if os.access(f"{work}/{name}.new.dat", os.F_OK):
+    if brl != "dat":
+        print(lang.text88 % (name, 'br'))
+    # The brotli stream is produced in the same pass as new.dat, nothing uncompressed touches the disk.
+    utils.img2sdat(f"{work}/{name}.img", work, dat_ver, name, brotli_quality=None if brl == "dat" else int(brl))
+    if os.access(f"{work}/{name}.new.dat" if brl == "dat" else f"{work}/{name}.new.dat.br", os.F_OK):
         try:
             os.remove(f"{work}/{name}.img")
         except Exception:
             logging.exception('Bugs')
             os.remove(f"{work}/{name}.img")
+        # The block map cached by img2sdat is useless without its image.
+        if os.path.exists(f"{work}/{name}.map"):
+            os.remove(f"{work}/{name}.map")
     if brl == "dat":
         print(lang.text87 % name)
     else:
-        print(lang.text88 % (name, 'br'))
-        call(['brotli', '-q', str(brl), '-j', '-w', '24', f"{work}/{name}.new.dat", '-o', f"{work}/{name}.new.dat.br"])
-        if os.access(f"{work}/{name}.new.dat", os.F_OK):
-            try:
-                os.remove(f"{work}/{name}.new.dat")
-            except Exception:
-                logging.exception('Bugs')
         print(lang.text89 % (name, 'br'))
 
 
@@ -4814,7 +4788,7 @@ class FormatConversion(ttk.LabelFrame):
                 if hget == 'br':
                     if os.access(f'{work}/{i}', os.F_OK):
                         print(lang.text79 + i)
-                        call(['brotli', '-dj', f'{work}/{i}'])
+                        utils.unbrotli(f'{work}/{i}')
                 if hget == 'xz':
                     if os.access(f'{work}/{i}', os.F_OK):
                         print(lang.text79 + i)
@@ -4825,8 +4799,17 @@ class FormatConversion(ttk.LabelFrame):
                         transferfile = os.path.abspath(
                             os.path.dirname(work)) + f"/{basename}.transfer.list"
                         if os.access(transferfile, os.F_OK) and os.path.getsize(f'{work}/{i}') != 0:
-                            Sdat2img(transferfile, f'{work}/{i}', f"{work}/{basename}.img")
-                            if os.access(f"{work}/{basename}.img", os.F_OK):
+                            try:
+                                sdat = Sdat2img(transferfile, f'{work}/{i}', f"{work}/{basename}.img")
+                            except (Exception, BaseException):
+                                logging.exception('Bugs')
+                                sdat = None
+                            # The image is preallocated, so it exists even after a short read;
+                            # only a complete conversion may replace the sources.
+                            if not (sdat and sdat.complete) and os.path.exists(f"{work}/{basename}.img"):
+                                print("File May Not Extracted.")
+                                os.remove(f"{work}/{basename}.img")
+                            if sdat and sdat.complete:
                                 os.remove(f'{work}/{i}')
                                 os.remove(transferfile)
                                 try:
@@ -4842,26 +4825,23 @@ class FormatConversion(ttk.LabelFrame):
                         img2simg(f'{work}/{basename}.img')
             elif f_get == 'raw':
                 basename = os.path.basename(i).split('.')[0]
-                if hget == 'br':
-                    if os.access(f'{work}/{i}', os.F_OK):
-                        print(lang.text79 + i)
-                        call(['brotli', '-dj', f'{work}/{i}'])
-                if hget == 'xz':
-                    if os.access(f'{work}/{i}', os.F_OK):
-                        print(lang.text79 + i)
-                        Unxz(f'{work}/{i}')
                 if hget in ['dat', 'br', 'xz']:
                     if os.path.exists(work):
-                        if hget == 'br':
-                            i = i.replace('.br', '')
-                        if hget == 'xz':
-                            i = i.replace('.xz', '')
                         print(lang.text79 + f'{work}/{i}')
                         transferfile = os.path.abspath(
                             os.path.dirname(work)) + f"/{basename}.transfer.list"
                         if os.access(transferfile, os.F_OK) and os.path.getsize(f'{work}/{i}') != 0:
-                            Sdat2img(transferfile, f'{work}/{i}', f"{work}/{basename}.img")
-                            if os.access(f"{work}/{basename}.img", os.F_OK):
+                            # .br and .xz are decompressed on the fly, no intermediate new.dat
+                            try:
+                                with utils.open_compressed(f'{work}/{i}') as new_data:
+                                    sdat = Sdat2img(transferfile, new_data, f"{work}/{basename}.img")
+                            except (Exception, BaseException):
+                                logging.exception('Bugs')
+                                sdat = None
+                            if not (sdat and sdat.complete) and os.path.exists(f"{work}/{basename}.img"):
+                                print("File May Not Extracted.")
+                                os.remove(f"{work}/{basename}.img")
+                            if sdat and sdat.complete:
                                 try:
                                     os.remove(f'{work}/{i}')
                                     os.remove(transferfile)
@@ -4874,20 +4854,16 @@ class FormatConversion(ttk.LabelFrame):
                 if hget == 'sparse':
                     utils.simg2img(f'{work}/{i}')
             elif f_get == 'dat':
-                if hget == 'raw':
-                    img2simg(f'{work}/{i}')
                 if hget in ['raw', 'sparse']:
                     datbr(work, os.path.basename(i).split('.')[0], "dat")
                 if hget == 'br':
                     print(lang.text79 + i)
-                    call(['brotli', '-dj', f'{work}/{i}'])
+                    utils.unbrotli(f'{work}/{i}')
                 if hget == 'xz':
                     print(lang.text79 + i)
                     Unxz(f'{work}/{i}')
 
             elif f_get == 'br':
-                if hget == 'raw':
-                    img2simg(f'{work}/{i}')
                 if hget in ['raw', 'sparse']:
                     datbr(work, os.path.basename(i).split('.')[0], 0)
                 if hget in ['dat', 'xz']: